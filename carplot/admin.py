@@ -3,7 +3,6 @@ __author__ = 'Roddy Mbogning'
 from django.conf import settings
 from django.contrib.auth.models import Permission, Group
 from djangotoolbox.admin import admin
-import MySQLdb
 from django.utils.translation import gettext_lazy as _
 from ikwen.core.utils import get_service_instance, add_database_to_settings
 
@@ -11,12 +10,11 @@ from ikwen.accesscontrol.models import Member
 from ikwen.billing.models import Invoice, Payment, Product, InvoicingConfig
 from ikwen.core.models import Application, Service, Config
 from carplot.models import Vehicle,Device, SMSCommand, DeviceType, OperatorProfile, IS_IKWEN, VehicleType, \
-    CustomerProfile
-
-GTS_HOST = "localhost"
-GTS_USER = "root"
-GTS_PWD = "admin"
-GTS_DB = "gts"
+    CustomerProfile, DeviceHealth
+from carplot.catalogue import invalidate_catalogue, invalidate_device_type
+from carplot.icons import invalidate_icon_table, invalidate_icon_atlas, rebuild_icon_atlas
+from carplot.propagation import propagate_in_background
+from carplot.provisioning import provision_device
 
 
 class CarplotAdmin(admin.ModelAdmin):
@@ -82,26 +80,9 @@ class DeviceAdmin(CarplotAdmin):
     ]
 
     def save_model(self, request, obj, form, change):
-
         super(DeviceAdmin, self).save_model(request, obj, form, change)
-        obj.uniqueID = 'tk_%s' % obj.imeiNumber
-        obj.vehicleID = 'tk_%s' % obj.imeiNumber
-        obj.deviceID = obj.id
-        obj.save()
-        try:
-            Device.objects.using('opengts').get(vehicleID=obj.vehicleID, imeiNumber=obj.imeiNumber, deviceID=obj.deviceID)
-        except Device.DoesNotExist:
-            obj.id = None
-            # I set a default integer value (5) to the field "device_type_id" because mysql data bases do not allow varchars as keys
-            obj.device_type_id = 5
-            obj.accountID = request.user.username
-            obj.save(using='opengts')
-        else:
-            with MySQLdb.connect(GTS_HOST, GTS_USER, GTS_PWD, GTS_DB) as cursor:
-                cursor.execute("UPDATE Device SET vehicleID = %s, description = %s, displayName =  %s, imeiNumber =  %s,"
-                               " simPhoneNumber =  %s WHERE deviceID = %s", [obj.vehicleID, obj.description,
-                                                                             obj.displayName, obj.imeiNumber,
-                                                                             obj.simPhoneNumber, obj.deviceID])
+        provision_device(obj, request.user.username)
+        invalidate_device_type(obj.id)
 
 
 class SMSCommandAdmin(CarplotAdmin):
@@ -109,6 +90,20 @@ class SMSCommandAdmin(CarplotAdmin):
     search_fields = ('action',)
     ordering = ('-id', )
 
+    def save_model(self, request, obj, form, change):
+        if change:
+            # The command may have been moved from another device type
+            invalidate_catalogue(SMSCommand.objects.get(pk=obj.pk).device_type_id)
+        super(SMSCommandAdmin, self).save_model(request, obj, form, change)
+        invalidate_catalogue(obj.device_type_id)
+        propagate_in_background(SMSCommand, [obj])
+
+    def delete_model(self, request, obj):
+        pk = obj.pk
+        super(SMSCommandAdmin, self).delete_model(request, obj)
+        invalidate_catalogue(obj.device_type_id)
+        propagate_in_background(SMSCommand, deleted_ids=[pk])
+
 
 class OperatorProfileAdmin(CarplotAdmin):
     list_display = ('project_name', 'company_name', 'operator_name', 'cost_per_vehicle', 'active_vehicle_count')
@@ -125,23 +120,51 @@ class DeviceTypeAdmin(CarplotAdmin):
     list_display = ('name', )
     search_fields = ('name',)
 
+    def save_model(self, request, obj, form, change):
+        super(DeviceTypeAdmin, self).save_model(request, obj, form, change)
+        invalidate_catalogue(obj.id)
+        propagate_in_background(DeviceType, [obj])
+
+    def delete_model(self, request, obj):
+        pk = obj.pk
+        device_ids = list(Device.objects.filter(device_type=obj).values_list('id', flat=True))
+        super(DeviceTypeAdmin, self).delete_model(request, obj)
+        invalidate_catalogue(pk)
+        invalidate_device_type(*device_ids)
+        propagate_in_background(DeviceType, deleted_ids=[pk])
+
 
 class VehicleTypeAdmin(CarplotAdmin):
     list_display = ('name', )
     search_fields = ('name',)
 
-    # def save_model(self, request, obj, form, change):
-    #     app = Application.object.get(slug='carplot')
-    #     services = Service.objects.filter(app=app)
-    #     for service in services:
-    #         add_database_to_settings(service.database)
-    #         obj.save.using(service.database)
+    def save_model(self, request, obj, form, change):
+        super(VehicleTypeAdmin, self).save_model(request, obj, form, change)
+        invalidate_icon_table(obj.id)
+        rebuild_icon_atlas(obj)
+        propagate_in_background(VehicleType, [obj])
+
+    def delete_model(self, request, obj):
+        pk = obj.pk
+        invalidate_icon_table(pk)
+        invalidate_icon_atlas(pk)
+        super(VehicleTypeAdmin, self).delete_model(request, obj)
+        propagate_in_background(VehicleType, deleted_ids=[pk])
 
 
 class CustomerProfileAdmin(CarplotAdmin):
     list_display = ('customer', 'max_sms_limit')
 
 
+class DeviceHealthAdmin(CarplotAdmin):
+    list_display = ('device', 'is_functional', 'last_report', 'changed_on')
+    list_filter = ('is_functional',)
+    readonly_fields = ('device', 'is_functional', 'last_report', 'changed_on')
+
+    def has_add_permission(self, request):
+        return False
+
+
 if IS_IKWEN:
     admin.site.register(VehicleType, VehicleTypeAdmin)
     admin.site.register(OperatorProfile, OperatorProfileAdmin)
@@ -152,6 +175,7 @@ else:
     admin.site.register(DeviceType, DeviceTypeAdmin)
     admin.site.register(CustomerProfile, CustomerProfileAdmin)
     admin.site.register(OperatorProfile, OperatorProfileAdmin)
+    admin.site.register(DeviceHealth, DeviceHealthAdmin)
 # admin.site.unregister(Member)
 # admin.site.unregister(Product)
 # admin.site.unregister(Payment)
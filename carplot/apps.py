@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+from django.apps import AppConfig
+
+
+class CarplotConfig(AppConfig):
+    name = 'carplot'
+
+    def ready(self):
+        # Connects the receivers keeping the fleet search and marker indexes up to date
+        import carplot.markers
+        import carplot.search
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import math
+import os
+import struct
+import time
+import zlib
+from array import array
+from collections import namedtuple, deque
+from datetime import datetime
+
+from django.conf import settings
+
+from carplot.models import EventData, GTS
+from carplot.queries import iter_event_data, after_cursor, iter_positions, iter_moved_positions, \
+    iter_sampled_positions, MoveFilter, CURSOR_FIELDS
+
+ARCHIVE_ROOT = getattr(settings, 'CARPLOT_ARCHIVE_ROOT',
+                       os.path.join(getattr(settings, 'MEDIA_ROOT', ''), 'event_archives'))
+# Events older than this number of days are moved from the database to the archives
+ARCHIVE_AGE = getattr(settings, 'CARPLOT_ARCHIVE_AGE', 90)
+ARCHIVE_MAGIC = b'CPEV'
+ARCHIVE_VERSION = 2
+HEADER = struct.Struct('<4sBI')
+# Archived EventData columns with their array typecode
+ARCHIVE_COLUMNS = (
+    ('creationTime', 'i'),
+    ('timestamp', 'i'),
+    ('statusCode', 'I'),
+    ('latitude', 'd'),
+    ('longitude', 'd'),
+    ('speedKPH', 'f'),
+    ('heading', 'f'),
+)
+ARCHIVE_FIELDS = tuple(name for name, typecode in ARCHIVE_COLUMNS)
+# Columns of the archives written by previous versions; the columns they miss are read as 0
+LEGACY_COLUMNS = {
+    1: tuple(column for column in ARCHIVE_COLUMNS if column[0] != 'statusCode'),
+}
+
+ArchivedEvent = namedtuple('ArchivedEvent', ('deviceID',) + ARCHIVE_FIELDS + ('address',))
+
+
+def _to_bytes(values):
+    if struct.pack('=i', 1) != struct.pack('<i', 1):
+        values.byteswap()
+    return values.tobytes() if hasattr(values, 'tobytes') else values.tostring()
+
+
+def _from_bytes(typecode, data):
+    values = array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    if struct.pack('=i', 1) != struct.pack('<i', 1):
+        values.byteswap()
+    return values
+
+
+def get_month(creation_time):
+    return datetime.fromtimestamp(creation_time).strftime('%Y-%m')
+
+
+def _get_month_bounds(month):
+    year, month = [int(value) for value in month.split('-')]
+    start = datetime(year, month, 1)
+    end = datetime(year + 1, 1, 1) if month == 12 else datetime(year, month + 1, 1)
+    return int(time.mktime(start.timetuple())), int(time.mktime(end.timetuple()))
+
+
+def get_archive_path(device_id, month):
+    return os.path.join(ARCHIVE_ROOT, str(device_id), '%s.evz' % month)
+
+
+def list_archived_months(device_id):
+    folder = os.path.join(ARCHIVE_ROOT, str(device_id))
+    if not os.path.isdir(folder):
+        return []
+    return sorted(name[:-4] for name in os.listdir(folder) if name.endswith('.evz'))
+
+
+def write_month(device_id, month, columns):
+    """
+    Writes columns, a dict of name -> list of values of ARCHIVE_COLUMNS, as a zlib compressed file
+    made of a header followed by each column stored contiguously.
+    """
+    path = get_archive_path(device_id, month)
+    folder = os.path.dirname(path)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    count = len(columns['creationTime'])
+    data = [HEADER.pack(ARCHIVE_MAGIC, ARCHIVE_VERSION, count)]
+    for name, typecode in ARCHIVE_COLUMNS:
+        data.append(_to_bytes(array(typecode, columns[name])))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(zlib.compress(b''.join(data), 6))
+    os.rename(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def read_month(device_id, month):
+    """
+    Returns the columns of an archive as a dict of name -> array
+    """
+    with open(get_archive_path(device_id, month), 'rb') as f:
+        data = zlib.decompress(f.read())
+    magic, version, count = HEADER.unpack_from(data)
+    offset = HEADER.size
+    columns = {}
+    for name, typecode in LEGACY_COLUMNS.get(version, ARCHIVE_COLUMNS):
+        size = array(typecode).itemsize * count
+        columns[name] = _from_bytes(typecode, data[offset:offset + size])
+        offset += size
+    for name, typecode in ARCHIVE_COLUMNS:
+        if name not in columns:
+            columns[name] = array(typecode, [0] * count)
+    return columns
+
+
+def _merge_month(device_id, month, columns):
+    """
+    Adds columns to the archive of the month if one exists, keeping events sorted and unique
+    on (creationTime, timestamp, statusCode), which also tells apart events sent at the same second.
+    """
+    if month not in list_archived_months(device_id):
+        return columns
+    existing = read_month(device_id, month)
+    events = {}
+    for values in (existing, columns):
+        for event in zip(*[values[name] for name in ARCHIVE_FIELDS]):
+            events[event[:3]] = event
+    events = [events[key] for key in sorted(events.keys())]
+    return dict((name, [event[i] for event in events]) for i, name in enumerate(ARCHIVE_FIELDS))
+
+
+def archive_device(device_id, cutoff, delete=True, using=GTS):
+    """
+    Moves the events of a device older than cutoff from the database to its monthly archives.
+    Only one month of events is held in memory at a time.
+
+    @param cutoff: creationTime before which events are archived
+    @param delete: remove the archived events from the database
+    this function returns the number of events archived and the number of bytes written
+    """
+    count, size = 0, 0
+    month, columns = None, None
+
+    def flush():
+        written = write_month(device_id, month, _merge_month(device_id, month, columns))
+        if delete:
+            month_start, month_end = _get_month_bounds(month)
+            EventData.objects.using(using).filter(deviceID=device_id, creationTime__gte=month_start,
+                                                  creationTime__lt=min(month_end, cutoff)).delete()
+        return written
+
+    for row in iter_event_data([device_id], end_date=cutoff, using=using, fields=ARCHIVE_FIELDS):
+        row_month = get_month(row['creationTime'])
+        if row_month != month:
+            if month is not None:
+                size += flush()
+            month, columns = row_month, dict((name, []) for name in ARCHIVE_FIELDS)
+        for name in ARCHIVE_FIELDS:
+            columns[name].append(row[name] or 0)
+        count += 1
+    if month is not None:
+        size += flush()
+    return count, size
+
+
+def get_archived_until(device_id):
+    """
+    creationTime of the latest archived event of a device, None if it has no archive
+    """
+    months = list_archived_months(device_id)
+    if not months:
+        return None
+    creation_times = read_month(device_id, months[-1])['creationTime']
+    return max(creation_times) if creation_times else None
+
+
+def iter_archived_events(device_id, start_date=None, end_date=None):
+    """
+    Yields as ArchivedEvent the archived events of a device between start_date and end_date
+    """
+    start_month = get_month(start_date) if start_date else None
+    end_month = get_month(end_date - 1) if end_date else None
+    for month in list_archived_months(device_id):
+        if (start_month and month < start_month) or (end_month and month > end_month):
+            continue
+        columns = read_month(device_id, month)
+        for values in zip(*[columns[name] for name in ARCHIVE_FIELDS]):
+            creation_time = values[0]
+            if (start_date and creation_time < start_date) or (end_date and creation_time >= end_date):
+                continue
+            yield ArchivedEvent(*((device_id,) + tuple(values) + ('',)))
+
+
+def iter_history(device_id, start_date=None, end_date=None, using=GTS):
+    """
+    Yields in chronological order the events of a device between start_date and end_date,
+    from the archives then from the database, as Position tuples. Archived events have an empty address.
+    """
+    cursor = None
+    for event in iter_archived_events(device_id, start_date, end_date):
+        cursor = event.creationTime, event.timestamp, event.statusCode
+        yield event
+    positions = EventData.objects.using(using).filter(deviceID=device_id)
+    if start_date:
+        positions = positions.filter(creationTime__gte=start_date)
+    if end_date:
+        positions = positions.filter(creationTime__lt=end_date)
+    if cursor:
+        positions = after_cursor(positions, cursor)
+    for event in iter_positions(positions.order_by(*CURSOR_FIELDS)):
+        yield event
+
+
+def iter_moved_history(device_id, start_date=None, end_date=None, using=GTS):
+    """
+    Same as iter_history without null coordinates nor positions that did not move, see MoveFilter.
+    The events of the database are filtered by the database itself when it can.
+    """
+    move_filter = MoveFilter()
+    for event in move_filter.filter(iter_archived_events(device_id, start_date, end_date)):
+        yield event
+    last = move_filter.last
+    cursor = (last.creationTime, last.timestamp, last.statusCode) if last else None
+    for event in iter_moved_positions(device_id, start_date, end_date, using, cursor, last):
+        yield event
+
+
+def get_sampled_history(device_id, start_date, end_date, max_points, using=GTS):
+    """
+    Same as iter_moved_history, spread over the whole period when it holds more than max_points events:
+    only the first position of each time bucket of (end_date - start_date) / max_points seconds is then
+    kept, so that the end of the period is read as well as its start. The database is only asked for
+    the positions kept.
+
+    this function returns the list of positions and whether some were dropped
+    """
+    count = EventData.objects.using(using).filter(deviceID=device_id, creationTime__gte=start_date,
+                                                  creationTime__lt=end_date).count()
+    bucket = max(1, int(math.ceil((end_date - start_date) / float(max_points))))
+    positions, truncated, last_bucket = [], False, None
+    move_filter = MoveFilter()
+    for event in move_filter.filter(iter_archived_events(device_id, start_date, end_date)):
+        event_bucket = event.creationTime - event.creationTime % bucket
+        if event_bucket == last_bucket:
+            truncated = True
+            continue
+        last_bucket = event_bucket
+        positions.append(event)
+    last = move_filter.last
+    if count <= max_points:
+        cursor = (last.creationTime, last.timestamp, last.statusCode) if last else None
+        positions.extend(iter_moved_positions(device_id, start_date, end_date, using, cursor, last))
+    else:
+        # Events archived with --keep-rows are also in the database
+        start_date = max(start_date, last.creationTime + 1) if last else start_date
+        positions.extend(iter_sampled_positions(device_id, start_date, end_date, bucket, using))
+        truncated = True
+    return positions, truncated
+
+
+def get_latest_history(device_id, start_date, end_date, limit, using=GTS):
+    """
+    Latest limit events of a device between start_date and end_date in chronological order,
+    completed with archived events when the database does not hold enough of them.
+    """
+    positions = EventData.objects.using(using).filter(deviceID=device_id, creationTime__gte=start_date,
+                                                      creationTime__lt=end_date)
+    positions = positions.order_by(*['-%s' % field for field in CURSOR_FIELDS])
+    positions = list(iter_positions(positions[:limit]))[::-1]
+    if len(positions) < limit:
+        archived = iter_archived_events(device_id, start_date, end_date)
+        if positions:
+            # Events archived with --keep-rows are also in the database
+            oldest = positions[0].creationTime, positions[0].timestamp, positions[0].statusCode
+            archived = (event for event in archived
+                        if (event.creationTime, event.timestamp, event.statusCode) < oldest)
+        archived = deque(archived, maxlen=limit - len(positions))
+        positions = list(archived) + positions
+    return positions
+
+
+def iter_history_rows(device_ids, start_date=None, end_date=None, fields=ARCHIVE_FIELDS, using=GTS):
+    """
+    Same as iter_history for many devices, yielding dicts of fields. Fields that are
+    not archived are None in the rows coming from the archives.
+    """
+    for device_id in device_ids:
+        cursor = None
+        for event in iter_archived_events(device_id, start_date, end_date):
+            cursor = event.creationTime, event.timestamp, event.statusCode
+            event = event._asdict()
+            yield dict((field, event.get(field)) for field in fields)
+        for row in iter_event_data([device_id], start_date, end_date, using=using, fields=fields, cursor=cursor):
+            yield row
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import json
+import math
+import random
+import time
+from datetime import datetime
+
+from django.core.urlresolvers import reverse
+from django.db import connections
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from ikwen.accesscontrol.models import Member
+from carplot.icons import HEADING_ICON_FIELDS, STATIC_ICON_FIELD
+from carplot.models import Device, DeviceType, EventData, SMSCommand, Vehicle, VehicleType, GTS
+from carplot.provisioning import upsert_gts_devices
+
+BENCHMARK_PASSWORD = 'benchmark'
+BENCHMARK_PREFIX = 'bench'
+EVENT_INTERVAL = 30
+EVENT_BATCH_SIZE = 1000
+# Starting points of the synthetic routes: Douala, Yaounde, Bafoussam, Garoua
+CITIES = ((4.05, 9.70), (3.87, 11.52), (5.48, 10.42), (9.30, 13.40))
+
+
+def _iter_route(rnd, device_id, account_id, start_time, count):
+    """
+    Yields EventData of a vehicle driving with a persistent heading, slowing down
+    and stopping from time to time like in city traffic.
+    """
+    lat, lng = rnd.choice(CITIES)
+    lat, lng = lat + rnd.uniform(-0.05, 0.05), lng + rnd.uniform(-0.05, 0.05)
+    heading, speed, stopped_for = rnd.uniform(0, 360), 0.0, 0
+    creation_time = start_time
+    odometer = rnd.uniform(1000, 100000)
+    for i in range(count):
+        if stopped_for > 0:
+            stopped_for -= 1
+            speed = 0.0
+        elif rnd.random() < 0.01:
+            stopped_for = rnd.randint(5, 60)
+            speed = 0.0
+        else:
+            speed = max(0.0, min(110.0, speed + rnd.uniform(-8, 10)))
+            heading = (heading + rnd.gauss(0, 12)) % 360
+        distance = speed * EVENT_INTERVAL / 3600.0
+        lat += distance / 111.0 * math.cos(math.radians(heading))
+        lng += distance / 111.0 * math.sin(math.radians(heading)) / math.cos(math.radians(lat))
+        odometer += distance
+        creation_time += EVENT_INTERVAL
+        yield EventData(accountID=account_id, deviceID=device_id, timestamp=creation_time - 2, statusCode=61714,
+                        latitude=lat, longitude=lng, gpsAge=0, speedKPH=speed, heading=heading, altitude=20,
+                        transportID='', inputMask=0, outputMask=0, seatbeltMask=0, address='', dataSource='',
+                        rawData='', distanceKM=distance, odometerKM=odometer, odometerOffsetKM=0, geozoneIndex=0,
+                        geozoneID=0, creationTime=creation_time)
+
+
+def generate_fleet(owners, vehicles_per_owner, events_per_vehicle, seed=1):
+    """
+    Creates owners with their vehicles, devices and event data in the default and opengts databases.
+    Events end now and go back in time at one event every EVENT_INTERVAL seconds.
+    Returns the number of events created.
+    """
+    rnd = random.Random(seed)
+    device_type, created = DeviceType.objects.get_or_create(name='%s tracker' % BENCHMARK_PREFIX)
+    for action in ('stop', 'resume', 'locate'):
+        SMSCommand.objects.get_or_create(action=action, sms_content='%s123456' % action, device_type=device_type)
+    icon = 'device_img/%s.png' % BENCHMARK_PREFIX
+    vehicle_type, created = VehicleType.objects.get_or_create(
+        name='%s car' % BENCHMARK_PREFIX,
+        defaults=dict((field, icon) for field in HEADING_ICON_FIELDS + (STATIC_ICON_FIELD,))
+    )
+    start_time = int(time.time()) - events_per_vehicle * EVENT_INTERVAL
+    event_count = 0
+    for i in range(owners):
+        username = '%s_owner_%d' % (BENCHMARK_PREFIX, i)
+        owner = Member.objects.create_user(username, BENCHMARK_PASSWORD)
+        devices = []
+        for j in range(vehicles_per_owner):
+            imei = '%s%05d%05d' % (BENCHMARK_PREFIX, i, j)
+            device = Device.objects.create(accountID=username, imeiNumber=imei, simPhoneNumber='2376%08d' % j,
+                                           displayName='TK %d-%d' % (i, j), device_type=device_type)
+            device.deviceID = str(device.id)
+            device.uniqueID = device.vehicleID = 'tk_%s' % imei
+            device.save()
+            Vehicle.objects.create(name='Vehicle %d-%d' % (i, j), photo=icon, type=vehicle_type,
+                                   description='Plate CE %03d%s' % (j, chr(65 + j % 26)), device=device, owner=owner)
+            devices.append(device)
+        upsert_gts_devices(devices, username)
+        for device in devices:
+            batch, event = [], None
+            route = _iter_route(rnd, device.deviceID, username, start_time, events_per_vehicle)
+            for event in route:
+                batch.append(event)
+                if len(batch) == EVENT_BATCH_SIZE:
+                    EventData.objects.using(GTS).bulk_create(batch)
+                    event_count += len(batch)
+                    batch = []
+            EventData.objects.using(GTS).bulk_create(batch)
+            event_count += len(batch)
+            if event:
+                Device.objects.using(GTS).filter(deviceID=device.deviceID)\
+                    .update(lastValidLatitude=event.latitude, lastValidLongitude=event.longitude)
+    return event_count
+
+
+def _percentile(values, percent):
+    values = sorted(values)
+    index = min(len(values) - 1, int(math.ceil(percent / 100.0 * len(values))) - 1)
+    return values[max(index, 0)]
+
+
+def _get_endpoints(owner):
+    vehicle = Vehicle.objects.filter(owner=owner)[0]
+    device_id = vehicle.device_id
+    today = datetime.now().strftime('%d/%m/%Y')
+    return (
+        ('home', reverse('home'), {}),
+        ('device_position', reverse('device_position'),
+         {'device_id': device_id, 'string_date': '%s 00:00 - %s 23:59' % (today, today)}),
+        ('device_position_live', reverse('device_position'), {'device_id': device_id}),
+        ('search', reverse('search'), {'query': 'Vehicle 0-1'}),
+        ('get_sms_command', reverse('get_sms_command'), {'device_id': device_id}),
+    )
+
+
+def run_benchmark(runs=20, username='%s_owner_0' % BENCHMARK_PREFIX):
+    """
+    Calls the hot endpoints as the given benchmark owner and measures them.
+
+    this function returns a dict of endpoint name -> dict of: p50, p95 and p99 latency in ms,
+    number of queries per database alias and payload size in bytes
+    """
+    client = Client()
+    client.login(username=username, password=BENCHMARK_PASSWORD)
+    owner = Member.objects.get(username=username)
+    results = {}
+    for name, url, params in _get_endpoints(owner):
+        timings = []
+        for i in range(runs):
+            contexts = dict((alias, CaptureQueriesContext(connections[alias])) for alias in connections)
+            for context in contexts.values():
+                context.__enter__()
+            start = time.time()
+            response = client.get(url, params)
+            timings.append((time.time() - start) * 1000)
+            for context in contexts.values():
+                context.__exit__(None, None, None)
+        results[name] = {
+            'p50': _percentile(timings, 50),
+            'p95': _percentile(timings, 95),
+            'p99': _percentile(timings, 99),
+            'queries': dict((alias, len(context)) for alias, context in contexts.items()),
+            'bytes': len(response.content),
+        }
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2):
+    """
+    Lists the metrics of results exceeding their baseline value by more than tolerance (0.2 for 20%).
+    Query counts are compared strictly.
+    """
+    regressions = []
+    for name, metrics in results.items():
+        reference = baseline.get(name)
+        if not reference:
+            continue
+        for metric in ('p50', 'p95', 'bytes'):
+            if metrics[metric] > reference[metric] * (1 + tolerance):
+                regressions.append((name, metric, reference[metric], metrics[metric]))
+        for alias, count in metrics['queries'].items():
+            if count > reference['queries'].get(alias, 0):
+                regressions.append((name, 'queries[%s]' % alias, reference['queries'].get(alias, 0), count))
+    return regressions
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_baseline(path, results):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
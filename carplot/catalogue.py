@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+from django.conf import settings
+from django.core.cache import cache
+
+from ikwen.foundation.core.utils import to_dict
+from carplot.models import Device, DeviceType, SMSCommand
+from carplot.versions import get_version, bump_version
+
+CATALOGUE_TIMEOUT = getattr(settings, 'CARPLOT_CATALOGUE_TIMEOUT', 24 * 3600)
+HITS_KEY = 'carplot:sms_catalogue:hits'
+MISSES_KEY = 'carplot:sms_catalogue:misses'
+# Stored as device type of devices without one, None meaning not cached
+NO_DEVICE_TYPE = 0
+
+
+def _get_version_key(device_type_id):
+    return 'carplot:sms_catalogue:version:%s' % device_type_id
+
+
+def _get_device_key(device_id):
+    return 'carplot:device_type:%s' % device_id
+
+
+def _count(key):
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.add(key, 1, None)
+
+
+def build_catalogue(device_type_id):
+    """
+    Serializes the SMS commands of a device type the same way as SMSCommand.to_dict,
+    the device type being serialized once for all of them.
+    """
+    device_type = DeviceType.objects.get(pk=device_type_id).to_dict()
+    catalogue = []
+    for sms_command in SMSCommand.objects.filter(device_type=device_type_id):
+        var = to_dict(sms_command)
+        var['device_type'] = device_type
+        catalogue.append(var)
+    return catalogue
+
+
+def get_catalogue(device_type_id):
+    """
+    Serialized SMS commands of a device type. Lists are cached under the current version
+    of their device type, so invalidating only takes to bump the version.
+    """
+    key = 'carplot:sms_catalogue:%s:%d' % (device_type_id, get_version(_get_version_key(device_type_id)))
+    catalogue = cache.get(key)
+    if catalogue is None:
+        _count(MISSES_KEY)
+        catalogue = build_catalogue(device_type_id)
+        cache.set(key, catalogue, CATALOGUE_TIMEOUT)
+    else:
+        _count(HITS_KEY)
+    return catalogue
+
+
+def invalidate_catalogue(device_type_id):
+    bump_version(_get_version_key(device_type_id))
+
+
+def get_device_type_id(device_id):
+    key = _get_device_key(device_id)
+    device_type_id = cache.get(key)
+    if device_type_id is None:
+        device_type_id = Device.objects.filter(pk=device_id).values_list('device_type', flat=True)[0]
+        device_type_id = device_type_id or NO_DEVICE_TYPE
+        cache.set(key, device_type_id, CATALOGUE_TIMEOUT)
+    return device_type_id
+
+
+def get_device_catalogue(device_id):
+    device_type_id = get_device_type_id(device_id)
+    if device_type_id == NO_DEVICE_TYPE:
+        return []
+    return get_catalogue(device_type_id)
+
+
+def invalidate_device_type(*device_ids):
+    cache.delete_many([_get_device_key(device_id) for device_id in device_ids])
+
+
+def get_catalogue_stats():
+    stats = cache.get_many([HITS_KEY, MISSES_KEY])
+    return {'hits': stats.get(HITS_KEY, 0), 'misses': stats.get(MISSES_KEY, 0)}
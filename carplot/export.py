@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import csv
+import json
+
+from carplot.archive import iter_history_rows
+
+EXPORT_FIELDS = ('deviceID', 'creationTime', 'timestamp', 'latitude', 'longitude', 'speedKPH', 'heading',
+                 'altitude', 'odometerKM', 'address')
+EXPORT_CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'geojson': 'application/geo+json',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+class _Echo(object):
+    """
+    File-like object handing back what is written to it, so that csv.writer can feed a generator.
+    """
+    def write(self, value):
+        return value
+
+
+def _encode(values):
+    if bytes is str:
+        # Python 2 csv module only writes bytes, it fails on non ASCII unicode
+        return [value.encode('utf-8') if isinstance(value, type(u'')) else value for value in values]
+    return values
+
+
+def export_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        yield writer.writerow(_encode([row[field] for field in EXPORT_FIELDS]))
+
+
+def export_ndjson(rows):
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+def export_geojson(rows):
+    yield '{"type": "FeatureCollection", "features": ['
+    separator = ''
+    for row in rows:
+        properties = dict((key, value) for key, value in row.items() if key not in ('latitude', 'longitude'))
+        feature = {
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [row['longitude'], row['latitude']]},
+            'properties': properties
+        }
+        yield separator + json.dumps(feature)
+        separator = ',\n'
+    yield ']}\n'
+
+
+EXPORTERS = {
+    'csv': export_csv,
+    'geojson': export_geojson,
+    'ndjson': export_ndjson,
+}
+
+
+def export_event_data(device_ids, export_format, start_date=None, end_date=None):
+    """
+    Returns a generator of the chunks of text of the export in the given format
+    """
+    rows = iter_history_rows(device_ids, start_date, end_date, EXPORT_FIELDS)
+    return EXPORTERS[export_format](rows)
@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import csv
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from carplot.geofence import Zone, ZoneIndex, distance_between, meters_to_degrees
+from carplot.models import Device, Geozone, GTS
+
+# Local file of places as CSV with latitude, longitude and name columns, and optionally country
+GAZETTEER_PATH = getattr(settings, 'CARPLOT_GAZETTEER_PATH', None)
+# Places further than this number of meters from a position are not used to name it
+GEOCODE_MAX_DISTANCE = getattr(settings, 'CARPLOT_GEOCODE_MAX_DISTANCE', 2000)
+# Number of decimals positions are rounded to before lookup; 4 decimals is about 11m
+GEOCODE_PRECISION = getattr(settings, 'CARPLOT_GEOCODE_PRECISION', 4)
+GEOCODE_CACHE_SIZE = getattr(settings, 'CARPLOT_GEOCODE_CACHE_SIZE', 50000)
+# Number of seconds after which the index is rebuilt to pick up new Geozones
+GEOCODE_INDEX_TTL = getattr(settings, 'CARPLOT_GEOCODE_INDEX_TTL', 3600)
+
+
+def format_address(*parts):
+    return ', '.join(part for part in parts if part)
+
+
+class PlaceIndex(object):
+    """
+    Uniform grid of named places for nearest neighbour lookups. Cells are as large as the
+    maximum distance, so the nearest place is always in the cell of the point or one of its 8 neighbours.
+    """
+    def __init__(self, places, max_distance=GEOCODE_MAX_DISTANCE):
+        self.max_distance = max_distance
+        self.cell_size = meters_to_degrees(max_distance)
+        self.cells = {}
+        for lat, lng, name in places:
+            self.cells.setdefault(self._cell(lat, lng), []).append((lat, lng, name))
+
+    def _cell(self, lat, lng):
+        # Longitude cells are widened with the latitude so that they stay at least max_distance wide
+        cos_lat = max(math.cos(math.radians(lat)), 0.01)
+        return int(math.floor(lat / self.cell_size)), int(math.floor(lng * cos_lat / self.cell_size))
+
+    def nearest(self, lat, lng):
+        i, j = self._cell(lat, lng)
+        best, best_distance = None, self.max_distance
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                for place_lat, place_lng, name in self.cells.get((i + di, j + dj), ()):
+                    distance = distance_between(lat, lng, place_lat, place_lng)
+                    if distance <= best_distance:
+                        best, best_distance = name, distance
+        return best
+
+
+class ReverseGeocoder(object):
+    """
+    Names positions offline: positions inside a Geozone flagged reverseGeocode take its address,
+    the others the address of the nearest Geozone, or else gazetteer place, within GEOCODE_MAX_DISTANCE.
+    Results are memoized on coordinates rounded to GEOCODE_PRECISION decimals in a bounded LRU.
+    """
+    def __init__(self, zones, addresses, places, gazetteer=None, cache_size=GEOCODE_CACHE_SIZE):
+        self.zone_index = ZoneIndex(zones)
+        self.addresses = addresses
+        self.place_index = PlaceIndex(places)
+        self.gazetteer = gazetteer
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, lat, lng):
+        zone_ids = self.zone_index.find(lat, lng)
+        if zone_ids:
+            return self.addresses[min(zone_ids)]
+        address = self.place_index.nearest(lat, lng)
+        if not address and self.gazetteer is not None:
+            address = self.gazetteer.nearest(lat, lng)
+        return address or ''
+
+    def reverse(self, lat, lng):
+        key = round(lat, GEOCODE_PRECISION), round(lng, GEOCODE_PRECISION)
+        with self.lock:
+            address = self.cache.pop(key, None)
+            if address is not None:
+                self.cache[key] = address
+                self.hits += 1
+                return address
+        address = self._lookup(*key)
+        with self.lock:
+            self.misses += 1
+            self.cache[key] = address
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return address
+
+    def reverse_many(self, coordinates):
+        """
+        Names a whole track at once: positions are rounded and deduplicated first, so a vehicle
+        standing still or crawling costs a single lookup.
+
+        @param coordinates: list of (latitude, longitude)
+        this function returns the list of addresses in the same order
+        """
+        keys = [(round(lat, GEOCODE_PRECISION), round(lng, GEOCODE_PRECISION)) for lat, lng in coordinates]
+        addresses = dict((key, self.reverse(*key)) for key in set(keys))
+        return [addresses[key] for key in keys]
+
+
+def read_gazetteer(path):
+    places = []
+    with open(path) as f:
+        for row in csv.DictReader(f):
+            places.append((float(row['latitude']), float(row['longitude']),
+                           format_address(row['name'], row.get('country'))))
+    return places
+
+
+_gazetteer = None
+
+
+def get_gazetteer_index():
+    """
+    Places of the gazetteer file, shared by the geocoders of all the accounts
+    """
+    global _gazetteer
+    if _gazetteer is None and GAZETTEER_PATH:
+        _gazetteer = PlaceIndex(read_gazetteer(GAZETTEER_PATH))
+    return _gazetteer
+
+
+def build_geocoder(account_id, using=GTS):
+    """
+    Geocoder of the Geozones of an account, so that positions are never named after another account's zones
+    """
+    zones, addresses, places = [], {}, []
+    geozones = Geozone.objects.using(using).filter(accountID=account_id, isActive=True)\
+        .exclude(city='', streetAddress='')
+    for geozone in geozones:
+        zone = Zone.from_geozone(geozone)
+        if zone is None:
+            continue
+        address = format_address(geozone.streetAddress, geozone.city, geozone.country)
+        if geozone.reverseGeocode:
+            zone.geozone_id = geozone.geozoneID
+            addresses[zone.geozone_id] = address
+            zones.append(zone)
+        lats = [vertex[0] for vertex in zone.vertices]
+        lngs = [vertex[1] for vertex in zone.vertices]
+        places.append((sum(lats) / len(lats), sum(lngs) / len(lngs), address))
+    return ReverseGeocoder(zones, addresses, places, get_gazetteer_index())
+
+
+_geocoders = {}
+_rebuilding = set()
+_geocoders_lock = threading.Lock()
+
+
+def get_geocoder(account_id):
+    """
+    Geocoder of an account, rebuilt every GEOCODE_INDEX_TTL seconds. The rebuild runs outside
+    the lock: while it runs, the other requests of the account keep using the previous geocoder.
+    """
+    with _geocoders_lock:
+        geocoder, built_on = _geocoders.get(account_id, (None, 0))
+        rebuild = time.time() - built_on > GEOCODE_INDEX_TTL and \
+            (geocoder is None or account_id not in _rebuilding)
+        if rebuild:
+            _rebuilding.add(account_id)
+    if not rebuild:
+        return geocoder
+    try:
+        geocoder = build_geocoder(account_id)
+        with _geocoders_lock:
+            _geocoders[account_id] = geocoder, time.time()
+    finally:
+        with _geocoders_lock:
+            _rebuilding.discard(account_id)
+    return geocoder
+
+
+def get_account_id(device, using=GTS):
+    """
+    opengts accountID of an app device. Devices provisioned before the app copy got its accountID
+    have it blank, the accountID of their opengts copy is used then.
+    """
+    if device.accountID:
+        return device.accountID
+    account_ids = Device.objects.using(using).filter(deviceID=device.deviceID).values_list('accountID', flat=True)
+    return account_ids[0] if account_ids else ''
+
+
+def fill_addresses(points, account_id):
+    """
+    Sets the address of the track points that have none, in a single batch lookup
+    among the Geozones of the account of the device
+    """
+    missing = [point for point in points if not point.get('address')]
+    if missing:
+        geocoder = get_geocoder(account_id)
+        addresses = geocoder.reverse_many([(point['latitude'], point['longitude']) for point in missing])
+        for point, address in zip(missing, addresses):
+            point['address'] = address
+    return points
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import json
+import math
+from collections import namedtuple
+
+from django.conf import settings
+
+from carplot.live import fetch_latest_event, get_cursor
+from carplot.models import Geozone, Watermark, GTS
+from carplot.queries import iter_event_data, get_row_cursor
+
+# Side in degrees of the cells of the grid index, about 1km at the equator
+GEOFENCE_CELL_SIZE = getattr(settings, 'CARPLOT_GEOFENCE_CELL_SIZE', 0.01)
+# Most cells a zone is registered in; larger zones go to a grid of coarser cells
+GEOFENCE_MAX_ZONE_CELLS = getattr(settings, 'CARPLOT_GEOFENCE_MAX_ZONE_CELLS', 64)
+MAX_VERTICES = 10
+EARTH_RADIUS = 6371000.0
+
+# OpenGTS Geozone.zoneType values
+POINT_RADIUS = 0
+BOUNDED_RECT = 1
+SWEPT_POINT_RADIUS = 2
+POLYGON = 3
+
+WATERMARK_JOB = 'geofence'
+SWEEP_FIELDS = ('creationTime', 'timestamp', 'statusCode', 'latitude', 'longitude')
+
+Transition = namedtuple('Transition', 'device_id geozone_id event creation_time')
+ENTER = 'enter'
+EXIT = 'exit'
+
+
+def meters_to_degrees(meters):
+    return meters / EARTH_RADIUS * 180 / math.pi
+
+
+def distance_between(lat1, lng1, lat2, lng2):
+    """
+    Equirectangular distance in meters, accurate enough at the scale of a geozone.
+    """
+    x = math.radians(lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.hypot(x, y) * EARTH_RADIUS
+
+
+def _distance_to_segment(lat, lng, a, b):
+    cos_lat = math.cos(math.radians(lat))
+    ax, ay = (a[1] - lng) * cos_lat, a[0] - lat
+    bx, by = (b[1] - lng) * cos_lat, b[0] - lat
+    dx, dy = bx - ax, by - ay
+    length = dx * dx + dy * dy
+    t = 0 if length == 0 else max(0, min(1, -(ax * dx + ay * dy) / length))
+    return math.radians(math.hypot(ax + t * dx, ay + t * dy)) * EARTH_RADIUS
+
+
+def _point_in_polygon(lat, lng, vertices):
+    inside = False
+    j = len(vertices) - 1
+    for i in range(len(vertices)):
+        lat_i, lng_i = vertices[i]
+        lat_j, lng_j = vertices[j]
+        if (lat_i > lat) != (lat_j > lat) and \
+                lng < (lng_j - lng_i) * (lat - lat_i) / (lat_j - lat_i) + lng_i:
+            inside = not inside
+        j = i
+    return inside
+
+
+class Zone(object):
+    """
+    Geometry of a Geozone, detached from the model so that it can be tested cheaply.
+    """
+    def __init__(self, geozone_id, zone_type, vertices, radius=0):
+        self.geozone_id = geozone_id
+        self.zone_type = zone_type
+        self.vertices = vertices
+        self.radius = radius or 0
+        margin = meters_to_degrees(self.radius) if zone_type in (POINT_RADIUS, SWEPT_POINT_RADIUS) else 0
+        lats = [vertex[0] for vertex in vertices]
+        lngs = [vertex[1] for vertex in vertices]
+        cos_lat = max(math.cos(math.radians(max(abs(lat) for lat in lats))), 0.01)
+        self.bounds = (min(lats) - margin, max(lats) + margin,
+                       min(lngs) - margin / cos_lat, max(lngs) + margin / cos_lat)
+
+    @classmethod
+    def from_geozone(cls, geozone):
+        vertices = []
+        for i in range(1, MAX_VERTICES + 1):
+            lat, lng = getattr(geozone, 'latitude%d' % i), getattr(geozone, 'longitude%d' % i)
+            if lat or lng:
+                vertices.append((lat, lng))
+        if not vertices:
+            return None
+        return cls(geozone.geozoneID, geozone.zoneType, vertices, geozone.radius)
+
+    def contains(self, lat, lng):
+        min_lat, max_lat, min_lng, max_lng = self.bounds
+        if not (min_lat <= lat <= max_lat and min_lng <= lng <= max_lng):
+            return False
+        if self.zone_type == BOUNDED_RECT:
+            return True
+        if self.zone_type == POLYGON:
+            return _point_in_polygon(lat, lng, self.vertices)
+        if self.zone_type == SWEPT_POINT_RADIUS and len(self.vertices) > 1:
+            return any(_distance_to_segment(lat, lng, a, b) <= self.radius
+                       for a, b in zip(self.vertices[:-1], self.vertices[1:]))
+        return any(distance_between(lat, lng, v_lat, v_lng) <= self.radius for v_lat, v_lng in self.vertices)
+
+
+class ZoneIndex(object):
+    """
+    Uniform grids of zones: each zone is registered in every cell its bounding box overlaps,
+    so a point is only tested against the zones of its own cells. A zone covering more than
+    max_zone_cells cells goes to a grid whose cells are twice as large, as many times as needed,
+    so that the memory of the index does not grow with the area of the zones.
+    """
+    def __init__(self, zones, cell_size=GEOFENCE_CELL_SIZE, max_zone_cells=GEOFENCE_MAX_ZONE_CELLS):
+        self.cell_size = cell_size
+        # Grid level -> cells of the grid, the cells of level k being 2 ** k times larger
+        self.grids = {}
+        for zone in zones:
+            min_lat, max_lat, min_lng, max_lng = zone.bounds
+            level = 0
+            while (self._cell(max_lat, level) - self._cell(min_lat, level) + 1) * \
+                    (self._cell(max_lng, level) - self._cell(min_lng, level) + 1) > max_zone_cells:
+                level += 1
+            cells = self.grids.setdefault(level, {})
+            for i in range(self._cell(min_lat, level), self._cell(max_lat, level) + 1):
+                for j in range(self._cell(min_lng, level), self._cell(max_lng, level) + 1):
+                    cells.setdefault((i, j), []).append(zone)
+
+    def _cell(self, value, level=0):
+        return int(math.floor(value / (self.cell_size * 2 ** level)))
+
+    def find(self, lat, lng):
+        """
+        Returns the set of geozoneID of the zones containing the point.
+        """
+        found = set()
+        for level, cells in self.grids.items():
+            for zone in cells.get((self._cell(lat, level), self._cell(lng, level)), ()):
+                if zone.contains(lat, lng):
+                    found.add(zone.geozone_id)
+        return found
+
+
+def load_zone_index(account_id, using=GTS):
+    geozones = Geozone.objects.using(using).filter(accountID=account_id, isActive=True)
+    zones = [Zone.from_geozone(geozone) for geozone in geozones]
+    return ZoneIndex([zone for zone in zones if zone is not None])
+
+
+def iter_transitions(index, positions, state):
+    """
+    Tests positions against the zones of the index and yields the zone crossings as Transition.
+
+    @param index: ZoneIndex of the zones to test
+    @param positions: iterable of (deviceID, creationTime, latitude, longitude) in chronological order per device
+    @param state: dict of deviceID -> set of geozoneID the device is in, updated as positions are read
+    """
+    for device_id, creation_time, lat, lng in positions:
+        # Null as in queries.MoveFilter: a fix with either coordinate at 0 has no position
+        if lat == 0.0 or lng == 0.0:
+            continue
+        zones = index.find(lat, lng)
+        previous = state.get(device_id, set())
+        if zones != previous:
+            for geozone_id in previous - zones:
+                yield Transition(device_id, geozone_id, EXIT, creation_time)
+            for geozone_id in zones - previous:
+                yield Transition(device_id, geozone_id, ENTER, creation_time)
+            state[device_id] = zones
+
+
+def evaluate(index, positions, state=None):
+    """
+    Same as iter_transitions, collected in a list.
+
+    @param state: dict of deviceID -> set of geozoneID the device was in at the end of the previous sweep
+    this function returns the list of Transition and the state to give to the next sweep
+    """
+    state = dict(state or {})
+    transitions = list(iter_transitions(index, positions, state))
+    return transitions, state
+
+
+def sweep_device(index, device, since=None, using=GTS):
+    """
+    Yields the zone crossings of the events a device sent since the previous sweep. The position
+    of the sweep and the zones the device is in are kept in its Watermark, so that a sweep never
+    reads more than the new events. The first sweep of a device only notes the zones of its latest
+    event, unless since is set.
+
+    @param device: app Device, its opengts deviceID being its primary key
+    @param since: creationTime to start the first sweep of the device from
+    """
+    device_id = str(device.id)
+    watermark = Watermark.objects.filter(job=WATERMARK_JOB, device=device).first()
+    if watermark is None:
+        watermark = Watermark(job=WATERMARK_JOB, device=device)
+        if since is None:
+            event = fetch_latest_event(device_id, using)
+            if event is not None:
+                zones = index.find(event.latitude, event.longitude) if event.latitude and event.longitude else set()
+                watermark.creationTime, watermark.timestamp, watermark.statusCode = get_cursor(event)
+                watermark.state = json.dumps(sorted(zones))
+                watermark.save()
+            return
+        rows = iter_event_data([device_id], start_date=since, using=using, fields=SWEEP_FIELDS)
+    else:
+        rows = iter_event_data([device_id], using=using, fields=SWEEP_FIELDS, cursor=watermark.cursor)
+    state = {device_id: set(json.loads(watermark.state)) if watermark.state else set()}
+    start_cursor = watermark.cursor
+
+    def iter_rows():
+        for row in rows:
+            watermark.creationTime, watermark.timestamp, watermark.statusCode = get_row_cursor(row)
+            yield device_id, row['creationTime'], row['latitude'], row['longitude']
+
+    try:
+        for transition in iter_transitions(index, iter_rows(), state):
+            yield transition
+    finally:
+        if watermark.cursor != start_cursor:
+            watermark.state = json.dumps(sorted(state.get(device_id, ())))
+            watermark.save()
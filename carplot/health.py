@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.db.models import Max
+
+from carplot.models import Device, DeviceHealth, EventData, GTS
+from carplot.queries import MAX_QUERY_PARAMS
+
+HEALTH_BATCH_SIZE = getattr(settings, 'CARPLOT_HEALTH_BATCH_SIZE', 1000)
+
+HealthReport = namedtuple('HealthReport', 'scanned non_functional changed duration')
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def get_last_reports(device_ids, batch_size=HEALTH_BATCH_SIZE, using=GTS):
+    """
+    Latest creationTime of each device, with one grouped query per batch of devices.
+    The (deviceID, creationTime) index lets the database answer it without reading the events.
+    """
+    last_reports = {}
+    for chunk in _chunks(device_ids, batch_size):
+        rows = EventData.objects.using(using).filter(deviceID__in=chunk).values('deviceID')\
+            .annotate(last_report=Max('creationTime'))
+        for row in rows:
+            last_reports[row['deviceID']] = row['last_report']
+    return last_reports
+
+
+def check_device_health(config, batch_size=HEALTH_BATCH_SIZE):
+    """
+    Flags as non functional the active devices that did not report for more than the
+    maximum_latency of the operator, and records the changes of status in DeviceHealth.
+    last_report is refreshed on every sweep, with one update per distinct value rather than one
+    per device. The statuses of the devices no longer active are dropped.
+
+    @param config: OperatorProfile of the operator
+    this function returns a HealthReport of: devices checked, non functional devices,
+    changes of status and duration in seconds
+    """
+    start = time.time()
+    now = int(start)
+    max_latency = (config.maximum_latency or 0) / 1000.0
+    device_ids = [str(pk) for pk in Device.objects.filter(isActive=True).values_list('id', flat=True)]
+    last_reports = get_last_reports(device_ids, batch_size)
+    statuses = dict((str(device_id), (is_functional, last_report)) for device_id, is_functional, last_report in
+                    DeviceHealth.objects.values_list('device', 'is_functional', 'last_report'))
+    created, non_functional = [], 0
+    # Devices grouped by their new (is_functional, last_report), and by their new last_report
+    # when their status did not change: the default nonrel database cannot run conditional updates
+    changed, reported = {}, {}
+    for device_id in device_ids:
+        last_report = last_reports.get(device_id) or 0
+        is_functional = bool(last_report) and now - last_report <= max_latency
+        if not is_functional:
+            non_functional += 1
+        status = statuses.get(device_id)
+        if status is None:
+            created.append(DeviceHealth(device_id=device_id, last_report=last_report,
+                                        is_functional=is_functional, changed_on=now))
+        elif status[0] != is_functional:
+            changed.setdefault((is_functional, last_report), []).append(device_id)
+        elif status[1] != last_report:
+            reported.setdefault(last_report, []).append(device_id)
+    DeviceHealth.objects.bulk_create(created)
+    for (is_functional, last_report), changed_ids in changed.items():
+        for chunk in _chunks(changed_ids, MAX_QUERY_PARAMS):
+            DeviceHealth.objects.filter(device__in=chunk)\
+                .update(last_report=last_report, is_functional=is_functional, changed_on=now)
+    for last_report, reported_ids in reported.items():
+        for chunk in _chunks(reported_ids, MAX_QUERY_PARAMS):
+            DeviceHealth.objects.filter(device__in=chunk).update(last_report=last_report)
+    # Without joins, the statuses to drop are found against the ids of the active devices
+    active_ids = set(device_ids)
+    inactive_ids = [device_id for device_id in statuses if device_id not in active_ids]
+    for chunk in _chunks(inactive_ids, MAX_QUERY_PARAMS):
+        DeviceHealth.objects.filter(device__in=chunk).delete()
+    changed_count = sum(len(changed_ids) for changed_ids in changed.values())
+    return HealthReport(len(device_ids), non_functional, changed_count + len(created), time.time() - start)
+
+
+def get_non_functional_devices(device_ids):
+    return set(str(device_id) for device_id in DeviceHealth.objects
+               .filter(device__in=device_ids, is_functional=False).values_list('device', flat=True))
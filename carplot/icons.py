@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import hashlib
+import logging
+from io import BytesIO
+
+from PIL import Image
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.urlresolvers import reverse
+
+from carplot.metrics import phase
+from carplot.models import VehicleType
+
+logger = logging.getLogger(__name__)
+
+ICON_TABLE_TIMEOUT = getattr(settings, 'CARPLOT_ICON_TABLE_TIMEOUT', 24 * 3600)
+# Side in pixels of an icon in the atlas
+ATLAS_ICON_SIZE = getattr(settings, 'CARPLOT_ATLAS_ICON_SIZE', 48)
+# Number of heading slots of the atlas. Above 8, the headings are the North icon rotated
+# by 360 / ATLAS_HEADING_STEPS degrees steps instead of the 8 heading icons of the type.
+ATLAS_HEADING_STEPS = getattr(settings, 'CARPLOT_ATLAS_HEADING_STEPS', 8)
+ATLAS_FOLDER = 'icon_atlas'
+# Seconds during which a type whose atlas failed to build is served icon URLs before trying again
+ATLAS_FAILURE_TIMEOUT = getattr(settings, 'CARPLOT_ATLAS_FAILURE_TIMEOUT', 300)
+# Stored in place of the atlas of a type that could not be built
+ATLAS_FAILED = 'failed'
+# Image.ANTIALIAS was removed in Pillow 10, Image.LANCZOS is the same filter since Pillow 2.7
+LANCZOS = Image.LANCZOS if hasattr(Image, 'LANCZOS') else Image.ANTIALIAS
+
+# Active icon fields of VehicleType ordered clockwise from North, one per 45° sector
+HEADING_ICON_FIELDS = (
+    'active_icon_img_north',
+    'active_icon_img_north_east',
+    'active_icon_img_east',
+    'active_icon_img_south_east',
+    'active_icon_img_south',
+    'active_icon_img_south_west',
+    'active_icon_img_west',
+    'active_icon_img_north_west',
+)
+STATIC_ICON_FIELD = 'static_icon_img'
+
+
+def _get_cache_key(vehicle_type_id):
+    return 'carplot:icon_table:%s' % vehicle_type_id
+
+
+def _get_url(image):
+    return image.url if image else ''
+
+
+def build_icon_table(vehicle_type):
+    """
+    Resolves all icon URLs of a VehicleType once.
+    Headings whose image is missing fall back to the static icon so that every heading has an icon.
+    """
+    static_url = _get_url(getattr(vehicle_type, STATIC_ICON_FIELD))
+    headings = [_get_url(getattr(vehicle_type, field)) or static_url for field in HEADING_ICON_FIELDS]
+    return {'static': static_url, 'headings': headings}
+
+
+def get_icon_table(vehicle_type_id):
+    key = _get_cache_key(vehicle_type_id)
+    icon_table = cache.get(key)
+    if icon_table is None:
+        vehicle_type = VehicleType.objects.get(pk=vehicle_type_id)
+        with phase('image_urls'):
+            icon_table = build_icon_table(vehicle_type)
+        cache.set(key, icon_table, ICON_TABLE_TIMEOUT)
+    return icon_table
+
+
+def invalidate_icon_table(vehicle_type_id):
+    cache.delete(_get_cache_key(vehicle_type_id))
+
+
+def get_heading_slot(heading, steps=len(HEADING_ICON_FIELDS)):
+    """
+    Quantizes a heading in degrees to the index of its sector of 360 / steps degrees, 0 being North.
+    Headings out of [0, 360[ are wrapped so that every value maps to a sector.
+    """
+    sector = 360.0 / steps
+    return int(((heading or 0) % 360 + sector / 2) // sector) % steps
+
+
+def get_heading_icon(icon_table, heading):
+    return icon_table['headings'][get_heading_slot(heading)]
+
+
+def _open_icon(image):
+    image.open('rb')
+    try:
+        icon = Image.open(BytesIO(image.read())).convert('RGBA')
+    finally:
+        image.close()
+    icon.thumbnail((ATLAS_ICON_SIZE, ATLAS_ICON_SIZE), LANCZOS)
+    # Icons are centered in their square so that rotations and offsets stay regular
+    square = Image.new('RGBA', (ATLAS_ICON_SIZE, ATLAS_ICON_SIZE), (0, 0, 0, 0))
+    square.paste(icon, ((ATLAS_ICON_SIZE - icon.size[0]) // 2, (ATLAS_ICON_SIZE - icon.size[1]) // 2))
+    return square
+
+
+def render_icon_atlas(vehicle_type, steps=ATLAS_HEADING_STEPS):
+    """
+    Renders the icons of a VehicleType side by side in a single PNG: heading slots from 0
+    (North) clockwise, then the static icon in slot steps. Missing icons fall back like in build_icon_table.
+    """
+    static_image = getattr(vehicle_type, STATIC_ICON_FIELD)
+    static = _open_icon(static_image) if static_image else None
+    if steps == len(HEADING_ICON_FIELDS):
+        headings = [_open_icon(getattr(vehicle_type, field)) if getattr(vehicle_type, field) else static
+                    for field in HEADING_ICON_FIELDS]
+    else:
+        north_image = getattr(vehicle_type, HEADING_ICON_FIELDS[0])
+        north = _open_icon(north_image) if north_image else static
+        # PIL rotates counterclockwise while headings go clockwise
+        headings = [north.rotate(-360.0 * i / steps, resample=Image.BICUBIC) if north else None
+                    for i in range(steps)]
+    atlas = Image.new('RGBA', (ATLAS_ICON_SIZE * (steps + 1), ATLAS_ICON_SIZE), (0, 0, 0, 0))
+    for slot, icon in enumerate(headings + [static]):
+        if icon is not None:
+            atlas.paste(icon, (slot * ATLAS_ICON_SIZE, 0))
+    buf = BytesIO()
+    atlas.save(buf, 'PNG', optimize=True)
+    return buf.getvalue()
+
+
+def get_atlas_path(vehicle_type_id, digest):
+    return '%s/%s-%s.png' % (ATLAS_FOLDER, vehicle_type_id, digest)
+
+
+def build_icon_atlas(vehicle_type, steps=ATLAS_HEADING_STEPS):
+    """
+    Renders and stores the atlas of a VehicleType under a content hashed name, so that it can
+    be cached forever by browsers: a change of icons gives a new name.
+
+    this function returns the description of the atlas as a dict of: type_id, url, size of an icon,
+    number of heading steps and slot of the static icon
+    """
+    data = render_icon_atlas(vehicle_type, steps)
+    digest = hashlib.sha1(data).hexdigest()[:12]
+    path = get_atlas_path(vehicle_type.id, digest)
+    if not default_storage.exists(path):
+        default_storage.save(path, ContentFile(data))
+    atlas = {
+        'type_id': vehicle_type.id,
+        'url': reverse('icon_atlas', args=(vehicle_type.id, digest)),
+        'size': ATLAS_ICON_SIZE,
+        'steps': steps,
+        'static_slot': steps,
+    }
+    cache.set(_get_atlas_cache_key(vehicle_type.id), atlas, None)
+    return atlas
+
+
+def _get_atlas_cache_key(vehicle_type_id):
+    return 'carplot:icon_atlas:%s' % vehicle_type_id
+
+
+def get_icon_atlas(vehicle_type_id):
+    """
+    this function returns the description of the atlas of a vehicle type, or None if it could
+    not be built, in which case the icons are to be served as URLs
+    """
+    atlas = cache.get(_get_atlas_cache_key(vehicle_type_id))
+    if atlas is None:
+        atlas = _try_build_icon_atlas(VehicleType.objects.get(pk=vehicle_type_id))
+    if atlas == ATLAS_FAILED:
+        return None
+    return atlas
+
+
+def _try_build_icon_atlas(vehicle_type):
+    """
+    A failure is remembered for ATLAS_FAILURE_TIMEOUT seconds, so that the requests
+    do not render every icon again and log the same error until it is fixed.
+    """
+    try:
+        return build_icon_atlas(vehicle_type)
+    except Exception:
+        logger.exception("Icon atlas of vehicle type %s could not be built", vehicle_type.id)
+        cache.set(_get_atlas_cache_key(vehicle_type.id), ATLAS_FAILED, ATLAS_FAILURE_TIMEOUT)
+        return ATLAS_FAILED
+
+
+def invalidate_icon_atlas(vehicle_type_id):
+    cache.delete(_get_atlas_cache_key(vehicle_type_id))
+
+
+def rebuild_icon_atlas(vehicle_type):
+    """
+    Called when the icons of a type change. A failure, like a missing image file,
+    only leaves the type without atlas until ATLAS_FAILURE_TIMEOUT expires.
+    """
+    invalidate_icon_atlas(vehicle_type.id)
+    _try_build_icon_atlas(vehicle_type)
+
+
+def get_atlas_slot(atlas, speed, heading):
+    if speed > 0:
+        return get_heading_slot(heading, atlas['steps'])
+    return atlas['static_slot']
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import logging
+import threading
+import time
+from collections import deque
+
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db.models import Q
+
+from carplot.models import EventData, GTS, MAX_STATUS_CODE
+from carplot.queries import iter_positions, after_cursor, get_after_cursor_q, CURSOR_FIELDS
+
+logger = logging.getLogger(__name__)
+
+LIVE_POLL_INTERVAL = getattr(settings, 'CARPLOT_LIVE_POLL_INTERVAL', 2)
+LIVE_BATCH_SIZE = getattr(settings, 'CARPLOT_LIVE_BATCH_SIZE', 500)
+LIVE_BUFFER_SIZE = getattr(settings, 'CARPLOT_LIVE_BUFFER_SIZE', 200)
+LIVE_MAX_SUBSCRIBERS = getattr(settings, 'CARPLOT_LIVE_MAX_SUBSCRIBERS', 200)
+LIVE_WATCH_TTL = getattr(settings, 'CARPLOT_LIVE_WATCH_TTL', 60)
+
+
+class TooManySubscribers(Exception):
+    pass
+
+
+def get_cursor(event):
+    return event.creationTime, event.timestamp, event.statusCode
+
+
+def parse_cursor(string_cursor):
+    """
+    Turns a "creationTime,timestamp,statusCode" string sent by the client into a comparable tuple.
+    Cursors without statusCode, handed out by previous versions, stand for the whole second.
+    Raises ValueError if the cursor is malformed.
+    """
+    if not string_cursor:
+        return None
+    values = [int(value) for value in string_cursor.split(',')]
+    if len(values) == 2:
+        values.append(MAX_STATUS_CODE)
+    if len(values) != 3:
+        raise ValueError("Malformed cursor %s" % string_cursor)
+    return tuple(values)
+
+
+def format_cursor(cursor):
+    if cursor is None:
+        return None
+    return '%d,%d,%d' % cursor
+
+
+def parse_cursors(string_cursors, device_ids):
+    """
+    Turns a "deviceID:cursor;deviceID:cursor" string sent by the client into a dict of deviceID -> cursor.
+    Events of different devices are not inserted in creationTime order, so each device is read from its own cursor.
+    A single cursor, handed out by previous versions, is used for all the devices.
+    Raises ValueError if the cursors are malformed.
+    """
+    if not string_cursors:
+        return {}
+    if ':' not in string_cursors:
+        cursor = parse_cursor(string_cursors)
+        return dict((device_id, cursor) for device_id in device_ids)
+    cursors = {}
+    for item in string_cursors.split(';'):
+        device_id, cursor = item.split(':')
+        cursors[device_id] = parse_cursor(cursor)
+    return cursors
+
+
+def format_cursors(cursors):
+    return ';'.join('%s:%s' % (device_id, format_cursor(cursor)) for device_id, cursor in sorted(cursors.items()))
+
+
+def fetch_events_since(device_ids, cursor, limit=LIVE_BATCH_SIZE, using=GTS):
+    """
+    Grabs in (creationTime, timestamp, statusCode) order the events of the devices that came after the cursor,
+    as Position.
+    """
+    positions = EventData.objects.using(using).filter(deviceID__in=device_ids)
+    if cursor is not None:
+        positions = after_cursor(positions, cursor)
+    return list(iter_positions(positions.order_by(*CURSOR_FIELDS)[:limit]))
+
+
+def fetch_fleet_events_since(cursors, limit=LIVE_BATCH_SIZE, using=GTS):
+    """
+    Same as fetch_events_since with a cursor per device, in a single query.
+
+    @param cursors: dict of deviceID -> cursor
+    """
+    if not cursors:
+        return []
+    conditions = reduce(or_, [Q(deviceID=device_id) & get_after_cursor_q(cursor)
+                              for device_id, cursor in cursors.items()])
+    positions = EventData.objects.using(using).filter(conditions)
+    return list(iter_positions(positions.order_by(*CURSOR_FIELDS)[:limit]))
+
+
+def fetch_latest_event(device_id, using=GTS):
+    positions = EventData.objects.using(using).filter(deviceID=device_id)
+    positions = list(iter_positions(positions.order_by(*['-%s' % field for field in CURSOR_FIELDS])[:1]))
+    return positions[0] if positions else None
+
+
+class _DeviceFeed(object):
+    """
+    Latest events of a watched device. Clients whose cursor is older than floor may have
+    missed events, either sent before the device was watched or evicted from the buffer.
+    cursor is the last event of the device read by the poller, which reads each device from its own cursor.
+    """
+    def __init__(self, floor):
+        self.floor = floor
+        self.cursor = floor
+        self.events = deque()
+        self.last_access = time.time()
+
+    def append(self, event):
+        if len(self.events) >= LIVE_BUFFER_SIZE:
+            self.floor = get_cursor(self.events.popleft())
+        self.events.append(event)
+        self.cursor = get_cursor(event)
+
+    def since(self, cursor):
+        return [event for event in self.events if get_cursor(event) > cursor]
+
+
+class EventPoller(object):
+    """
+    Reads new EventData of all the watched devices in batches and fans them out to the
+    requests waiting on them, so that N viewers of a fleet cost a single query per poll.
+    """
+    def __init__(self, using=GTS, interval=LIVE_POLL_INTERVAL, batch_size=LIVE_BATCH_SIZE,
+                 max_subscribers=LIVE_MAX_SUBSCRIBERS):
+        self.using = using
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_subscribers = max_subscribers
+        self.feeds = {}
+        self.subscribers = 0
+        self.condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self.condition:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='carplot-event-poller')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll_once()
+            except Exception:
+                logger.exception("EventData polling failed")
+            time.sleep(self.interval)
+
+    def _watch(self, device_ids):
+        """
+        Feeds of the devices, created for those not watched yet. Their latest event is read
+        before taking the lock, so that the waiting requests do not stall on the database.
+        """
+        now = time.time()
+        with self.condition:
+            missing = []
+            for device_id in device_ids:
+                feed = self.feeds.get(device_id)
+                if feed is None:
+                    missing.append(device_id)
+                else:
+                    # Keeps the feed from being dropped before it is used
+                    feed.last_access = now
+        latest = dict((device_id, fetch_latest_event(device_id, self.using)) for device_id in missing)
+        with self.condition:
+            for device_id, event in latest.items():
+                if device_id not in self.feeds:
+                    # OpenGTS stamps creationTime on insertion, so a device without events
+                    # can only send events newer than now
+                    floor = get_cursor(event) if event else (int(now), 0, 0)
+                    self.feeds[device_id] = _DeviceFeed(floor)
+            return [self.feeds[device_id] for device_id in device_ids]
+
+    def poll_once(self):
+        """
+        Reads the new events of the watched devices, each from its own cursor, until every one of them
+        is buffered. A device that stays idle keeps its cursor and does not make the others read their
+        history again. Returns the number of events read.
+        """
+        now = time.time()
+        with self.condition:
+            for device_id, feed in list(self.feeds.items()):
+                if now - feed.last_access > LIVE_WATCH_TTL:
+                    del self.feeds[device_id]
+            if not self.feeds:
+                return 0
+            cursors = dict((device_id, feed.cursor) for device_id, feed in self.feeds.items())
+        count = 0
+        while True:
+            events = fetch_fleet_events_since(cursors, self.batch_size, self.using)
+            if not events:
+                break
+            with self.condition:
+                for event in events:
+                    feed = self.feeds.get(event.deviceID)
+                    if feed is not None and get_cursor(event) > feed.cursor:
+                        feed.append(event)
+                        count += 1
+                self.condition.notify_all()
+            for event in events:
+                cursors[event.deviceID] = get_cursor(event)
+            if len(events) < self.batch_size:
+                break
+        return count
+
+    def wait(self, cursors, timeout):
+        """
+        Blocks until events newer than their cursor are available for one of the devices or timeout expires.
+        Returns None if the buffers can not tell what happened since the cursors, the caller
+        must then read the events from the database.
+
+        @param cursors: dict of deviceID -> cursor of the last event of the device received by the client
+        """
+        if not cursors:
+            return []
+        device_ids = list(cursors.keys())
+        with self.condition:
+            if self.subscribers >= self.max_subscribers:
+                raise TooManySubscribers()
+            self.subscribers += 1
+        try:
+            self.start()
+            deadline = time.time() + timeout
+            feeds = self._watch(device_ids)
+            with self.condition:
+                while True:
+                    now = time.time()
+                    for feed in feeds:
+                        feed.last_access = now
+                    # A feed dropped while idle is put back: it goes on from its own cursor
+                    feeds = [self.feeds.setdefault(device_id, feed) for device_id, feed in zip(device_ids, feeds)]
+                    if any(cursors[device_id] < feed.floor for device_id, feed in zip(device_ids, feeds)):
+                        return None
+                    events = []
+                    for device_id, feed in zip(device_ids, feeds):
+                        events.extend(feed.since(cursors[device_id]))
+                    remaining = deadline - time.time()
+                    if events or remaining <= 0:
+                        return sorted(events, key=get_cursor)
+                    self.condition.wait(remaining)
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def get_poller():
+    global _poller
+    with _poller_lock:
+        if _poller is None:
+            _poller = EventPoller()
+        return _poller
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from carplot.archive import archive_device, ARCHIVE_AGE
+from carplot.models import Device
+
+
+class Command(BaseCommand):
+    help = "Moves old event data from the opengts database to compressed monthly archives."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=ARCHIVE_AGE,
+                            help="Events older than this number of days are archived.")
+        parser.add_argument('--device', action='append', dest='devices', default=[],
+                            help="Id of a device to archive. All devices if not set.")
+        parser.add_argument('--keep-rows', action='store_true',
+                            help="Write the archives without deleting the events from the database.")
+
+    def handle(self, *args, **options):
+        start = time.time()
+        cutoff = int(start - options['days'] * 24 * 3600)
+        device_ids = options['devices'] or [str(pk) for pk in Device.objects.values_list('pk', flat=True)]
+        total_count, total_size = 0, 0
+        for device_id in device_ids:
+            count, size = archive_device(device_id, cutoff, delete=not options['keep_rows'])
+            total_count += count
+            total_size += size
+        self.stdout.write("%d event(s) archived in %d bytes in %.3fs" % (total_count, total_size, time.time() - start))
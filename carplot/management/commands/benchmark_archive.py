@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from carplot.archive import iter_archived_events, list_archived_months, get_archive_path, ARCHIVE_FIELDS
+from carplot.models import EventData, GTS
+from carplot.queries import iter_event_data
+
+
+def get_avg_row_length(connection):
+    """
+    Average size in bytes of an EventData row as reported by the database, None if the backend has no such statistic
+    """
+    table = EventData._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'mysql':
+            cursor.execute("SHOW TABLE STATUS LIKE %s", [table])
+            columns = [column[0] for column in cursor.description]
+            return dict(zip(columns, cursor.fetchone()))['Avg_row_length']
+        if connection.vendor == 'postgresql':
+            cursor.execute("SELECT pg_total_relation_size(%s) / GREATEST(reltuples, 1) FROM pg_class "
+                           "WHERE oid = %s::regclass", [connection.ops.quote_name(table)] * 2)
+            return int(cursor.fetchone()[0])
+    return None
+
+
+class Command(BaseCommand):
+    help = "Compares scan speed and space of the archives of a device against its rows in the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('device_id')
+
+    def handle(self, *args, **options):
+        device_id = options['device_id']
+        months = list_archived_months(device_id)
+        archive_size = sum(os.path.getsize(get_archive_path(device_id, month)) for month in months)
+
+        start = time.time()
+        archived_count = sum(1 for event in iter_archived_events(device_id))
+        archive_time = time.time() - start
+
+        start = time.time()
+        db_count = sum(1 for row in iter_event_data([device_id], fields=ARCHIVE_FIELDS))
+        db_time = time.time() - start
+
+        avg_row_length = get_avg_row_length(connections[GTS])
+
+        self.stdout.write("archives  %8d events in %d month(s)  %10d bytes (%.1f bytes/event)  scan %.3fs (%.0f events/s)" %
+                          (archived_count, len(months), archive_size, archive_size / float(archived_count or 1),
+                           archive_time, archived_count / (archive_time or 1)))
+        if avg_row_length is None:
+            self.stdout.write("database  %8d events  size not measured on %s  scan %.3fs (%.0f events/s)" %
+                              (db_count, connections[GTS].vendor, db_time, db_count / (db_time or 1)))
+        else:
+            self.stdout.write("database  %8d events  ~%10d bytes (%d bytes/row)  scan %.3fs (%.0f events/s)" %
+                              (db_count, db_count * avg_row_length, avg_row_length, db_time,
+                               db_count / (db_time or 1)))
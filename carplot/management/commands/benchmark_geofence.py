@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import random
+import time
+
+from django.core.management.base import BaseCommand
+
+from carplot.geofence import Zone, ZoneIndex, POINT_RADIUS, BOUNDED_RECT, POLYGON
+
+
+def _random_zone(rnd, geozone_id, lat, lng):
+    zone_type = rnd.choice((POINT_RADIUS, BOUNDED_RECT, POLYGON))
+    if zone_type == POINT_RADIUS:
+        return Zone(geozone_id, zone_type, [(lat, lng)], rnd.randint(50, 500))
+    size = rnd.uniform(0.001, 0.01)
+    if zone_type == BOUNDED_RECT:
+        return Zone(geozone_id, zone_type, [(lat, lng), (lat + size, lng + size)])
+    vertices = [(lat, lng), (lat + size, lng + size / 2), (lat + size / 2, lng + size), (lat - size / 3, lng + size)]
+    return Zone(geozone_id, zone_type, vertices)
+
+
+class Command(BaseCommand):
+    help = "Compares the grid geofence index with a naive all zones loop on synthetic data."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--zones', type=int, default=2000)
+        parser.add_argument('--points', type=int, default=200000)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        # Zones and points spread over a 100km wide area around Douala
+        zones = [_random_zone(rnd, 'zone%d' % i, 4.05 + rnd.uniform(-0.5, 0.5), 9.7 + rnd.uniform(-0.5, 0.5))
+                 for i in range(options['zones'])]
+        points = [(4.05 + rnd.uniform(-0.5, 0.5), 9.7 + rnd.uniform(-0.5, 0.5)) for i in range(options['points'])]
+
+        start = time.time()
+        index = ZoneIndex(zones)
+        build_time = time.time() - start
+        start = time.time()
+        indexed = [index.find(lat, lng) for lat, lng in points]
+        indexed_time = time.time() - start
+
+        start = time.time()
+        naive = [set(zone.geozone_id for zone in zones if zone.contains(lat, lng)) for lat, lng in points]
+        naive_time = time.time() - start
+
+        self.stdout.write("%d zones, %d points" % (len(zones), len(points)))
+        self.stdout.write("grid index  build %.3fs  lookup %.3fs" % (build_time, indexed_time))
+        self.stdout.write("naive loop  lookup %.3fs" % naive_time)
+        self.stdout.write("results match: %s" % (indexed == naive))
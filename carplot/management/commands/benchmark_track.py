@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import json
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+
+from carplot.icons import get_icon_table
+from carplot.models import Device, EventData, Vehicle, GTS
+from carplot.tracks import zoom_to_tolerance
+from carplot.views import get_latest_track, get_simplified_track, to_map_point
+
+
+class Command(BaseCommand):
+    help = "Compares payload size and latency of the latest 1000 points against the simplified track."
+
+    def add_arguments(self, parser):
+        parser.add_argument('device_id')
+        parser.add_argument('--start', required=True, help="Start date formatted as dd-mm-YYYY HH:MM")
+        parser.add_argument('--end', required=True, help="End date formatted as dd-mm-YYYY HH:MM")
+        parser.add_argument('--zoom', type=int, default=14)
+        parser.add_argument('--runs', type=int, default=5)
+
+    def handle(self, *args, **options):
+        device_id = options['device_id']
+        device = Device.objects.get(pk=device_id)
+        vehicle = Vehicle.objects.get(device=device)
+        icon_table = get_icon_table(vehicle.type_id)
+        start_date = int(time.mktime(datetime.strptime(options['start'], '%d-%m-%Y %H:%M').timetuple()))
+        end_date = int(time.mktime(datetime.strptime(options['end'], '%d-%m-%Y %H:%M').timetuple()))
+        positions = EventData.objects.using(GTS).filter(deviceID=device_id, creationTime__gte=start_date,
+                                                        creationTime__lt=end_date)
+        tolerance = zoom_to_tolerance(options['zoom'])
+        self.stdout.write("%d event data in range, tolerance %.1fm" % (positions.count(), tolerance))
+        paths = [
+            ('latest 1000', lambda: get_latest_track(device_id, start_date, end_date, icon_table)),
+            ('simplified', lambda: get_simplified_track(device_id, start_date, end_date, icon_table, tolerance)[0]),
+        ]
+        for name, build in paths:
+            timings = []
+            for i in range(options['runs']):
+                start = time.time()
+                event_data = [to_map_point(point, device, vehicle) for point in build()]
+                payload = json.dumps({'event_data': event_data})
+                timings.append(time.time() - start)
+            span = ''
+            if event_data:
+                span = "%s -> %s" % (event_data[0]['dateTime'], event_data[-1]['dateTime'])
+            self.stdout.write("%-12s %6d points %9d bytes  min %.3fs  avg %.3fs  %s" %
+                              (name, len(event_data), len(payload), min(timings),
+                               sum(timings) / len(timings), span))
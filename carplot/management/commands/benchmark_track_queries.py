@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+
+from carplot.models import EventData, GTS
+from carplot.queries import iter_positions, iter_moved_positions, supports_window_functions, MoveFilter, \
+    CURSOR_FIELDS
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+class Command(BaseCommand):
+    help = "Compares rows materialized, peak memory and latency of reading a track as EventData instances, " \
+           "as Position tuples filtered in Python and as Position tuples filtered by the database."
+
+    def add_arguments(self, parser):
+        parser.add_argument('device_id')
+        parser.add_argument('--start', required=True, help="Start date formatted as dd-mm-YYYY HH:MM")
+        parser.add_argument('--end', required=True, help="End date formatted as dd-mm-YYYY HH:MM")
+        parser.add_argument('--runs', type=int, default=5)
+
+    def handle(self, *args, **options):
+        device_id = options['device_id']
+        start_date = int(time.mktime(datetime.strptime(options['start'], '%d-%m-%Y %H:%M').timetuple()))
+        end_date = int(time.mktime(datetime.strptime(options['end'], '%d-%m-%Y %H:%M').timetuple()))
+        positions = EventData.objects.using(GTS).filter(deviceID=device_id, creationTime__gte=start_date,
+                                                        creationTime__lt=end_date)\
+            .order_by(*CURSOR_FIELDS)
+        self.stdout.write("%d event data in range" % positions.count())
+
+        def read_models(counter):
+            rows = list(positions)
+            counter.append(len(rows))
+            return list(MoveFilter().filter(rows))
+
+        def read_lean(counter):
+            def count(rows):
+                for row in rows:
+                    counter.append(1)
+                    yield row
+            return list(MoveFilter().filter(count(iter_positions(positions))))
+
+        def read_window(counter):
+            rows = list(iter_moved_positions(device_id, start_date, end_date))
+            counter.append(len(rows))
+            return rows
+
+        paths = [('models', read_models), ('values_list', read_lean)]
+        if supports_window_functions(GTS):
+            paths.append(('window', read_window))
+        else:
+            self.stdout.write("Window functions not available on %s, database filtering skipped" % GTS)
+        for name, read in paths:
+            timings = []
+            for i in range(options['runs']):
+                start = time.time()
+                read([])
+                timings.append(time.time() - start)
+            # Memory is measured apart since tracing slows allocations down
+            counter = []
+            if tracemalloc:
+                tracemalloc.start()
+            points = read(counter)
+            peak = 'n/a'
+            if tracemalloc:
+                peak = '%.1fKB' % (tracemalloc.get_traced_memory()[1] / 1024.0)
+                tracemalloc.stop()
+            self.stdout.write("%-12s %6d rows materialized %6d points  peak %10s  min %.3fs  avg %.3fs" %
+                              (name, sum(counter), len(points), peak, min(timings), sum(timings) / len(timings)))
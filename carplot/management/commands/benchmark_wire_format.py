@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import gzip
+import json
+import time
+from datetime import datetime
+from io import BytesIO
+
+from django.core.management.base import BaseCommand
+
+from carplot.icons import get_icon_table
+from carplot.models import Device, EventData, Vehicle, GTS
+from carplot.views import iter_track_points, to_map_point
+from carplot.wire import encode_columnar
+
+
+def _gzipped_size(payload):
+    buf = BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+        f.write(payload.encode('utf-8'))
+    return len(buf.getvalue())
+
+
+class Command(BaseCommand):
+    help = "Compares size and encode time of the dict per point and columnar event data formats."
+
+    def add_arguments(self, parser):
+        parser.add_argument('device_id')
+        parser.add_argument('--start', required=True, help="Start date formatted as dd-mm-YYYY HH:MM")
+        parser.add_argument('--end', required=True, help="End date formatted as dd-mm-YYYY HH:MM")
+        parser.add_argument('--runs', type=int, default=5)
+
+    def handle(self, *args, **options):
+        device_id = options['device_id']
+        device = Device.objects.get(pk=device_id)
+        vehicle = Vehicle.objects.get(device=device)
+        icon_table = get_icon_table(vehicle.type_id)
+        start_date = int(time.mktime(datetime.strptime(options['start'], '%d-%m-%Y %H:%M').timetuple()))
+        end_date = int(time.mktime(datetime.strptime(options['end'], '%d-%m-%Y %H:%M').timetuple()))
+        positions = EventData.objects.using(GTS).filter(deviceID=device_id, creationTime__gte=start_date,
+                                                        creationTime__lt=end_date).order_by('creationTime')
+        points = list(iter_track_points(positions.iterator(), icon_table))
+        description = vehicle.name + " / " + device.displayName
+        self.stdout.write("%d points" % len(points))
+        encoders = [
+            ('dict', lambda: [to_map_point(point, device, vehicle) for point in points]),
+            ('columnar', lambda: encode_columnar(points, device.displayName, description)),
+        ]
+        for name, encode in encoders:
+            timings = []
+            for i in range(options['runs']):
+                start = time.time()
+                payload = json.dumps({'event_data': encode()})
+                timings.append(time.time() - start)
+            self.stdout.write("%-9s %10d bytes %9d gzipped  min %.4fs  avg %.4fs" %
+                              (name, len(payload), _gzipped_size(payload), min(timings),
+                               sum(timings) / len(timings)))
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from ikwen.core.utils import get_service_instance
+from carplot.health import check_device_health, HEALTH_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Flags the devices that did not report within the maximum latency of the operator."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=HEALTH_BATCH_SIZE,
+                            help="Number of devices sent in a single grouped opengts query.")
+        parser.add_argument('--interval', type=int, default=0,
+                            help="Seconds to wait between two sweeps. Runs a single sweep if 0.")
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            config = get_service_instance().config
+            report = check_device_health(config, options['batch_size'])
+            self.stdout.write("%d/%d device(s) non functional, %d status change(s), checked in %.3fs" %
+                              (report.non_functional, report.scanned, report.changed, report.duration))
+            if not interval:
+                break
+            time.sleep(interval)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from carplot.models import GTS
+
+# The opengts tables are created by OpenGTS itself, so indexes declared
+# on the models are not applied there. (table, index name, columns)
+GTS_INDEXES = (
+    ('EventData', 'carplot_eventdata_device_creation', ('deviceID', 'creationTime')),
+)
+
+
+class Command(BaseCommand):
+    help = "Creates on the opengts database the indexes the tracking views rely on."
+
+    def handle(self, *args, **options):
+        cursor = connections[GTS].cursor()
+        for table, name, columns in GTS_INDEXES:
+            cursor.execute("SHOW INDEX FROM %s WHERE Key_name = %%s" % table, [name])
+            if cursor.fetchall():
+                self.stdout.write("%s already exists on %s" % (name, table))
+                continue
+            cursor.execute("CREATE INDEX %s ON %s (%s)" % (name, table, ', '.join(columns)))
+            self.stdout.write("Created %s on %s" % (name, table))
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import sys
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from carplot.export import export_event_data, EXPORTERS
+from carplot.models import Vehicle
+
+
+class Command(BaseCommand):
+    help = "Exports the event data of devices as CSV, GeoJSON or NDJSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--device', action='append', dest='devices', default=[],
+                            help="Id of a device to export. Can be repeated.")
+        parser.add_argument('--owner', help="Id of a member whose whole fleet is exported.")
+        parser.add_argument('--start', help="Start date formatted as dd-mm-YYYY HH:MM")
+        parser.add_argument('--end', help="End date formatted as dd-mm-YYYY HH:MM")
+        parser.add_argument('--format', default='csv', choices=sorted(EXPORTERS.keys()))
+        parser.add_argument('--output', help="File to write to. Standard output if not set.")
+
+    def handle(self, *args, **options):
+        device_ids = options['devices']
+        if options['owner']:
+            vehicles = Vehicle.objects.filter(owner=options['owner'])
+            device_ids.extend(str(vehicle.device_id) for vehicle in vehicles)
+        if not device_ids:
+            raise CommandError("Give at least one --device or an --owner")
+        start_date, end_date = None, None
+        if options['start']:
+            start_date = int(time.mktime(datetime.strptime(options['start'], '%d-%m-%Y %H:%M').timetuple()))
+        if options['end']:
+            end_date = int(time.mktime(datetime.strptime(options['end'], '%d-%m-%Y %H:%M').timetuple()))
+        output = open(options['output'], 'w') if options['output'] else sys.stdout
+        try:
+            for chunk in export_event_data(device_ids, options['format'], start_date, end_date):
+                output.write(chunk)
+        finally:
+            if output is not sys.stdout:
+                output.close()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from carplot.benchmark import generate_fleet
+
+
+class Command(BaseCommand):
+    help = "Fills the default and opengts databases with a synthetic fleet for benchmarks. " \
+           "Refuses to run against non SQLite databases unless --force is given."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--owners', type=int, default=10)
+        parser.add_argument('--vehicles', type=int, default=20, help="Vehicles per owner")
+        parser.add_argument('--events', type=int, default=5000, help="Events per vehicle")
+        parser.add_argument('--seed', type=int, default=1)
+        parser.add_argument('--force', action='store_true')
+
+    def handle(self, *args, **options):
+        if not options['force']:
+            for alias in connections:
+                if connections[alias].vendor != 'sqlite':
+                    raise CommandError("Database %s is not SQLite, use conf.benchmark_settings or --force" % alias)
+        start = time.time()
+        count = generate_fleet(options['owners'], options['vehicles'], options['events'], options['seed'])
+        self.stdout.write("%d owners, %d vehicles and %d events generated in %.1fs" %
+                          (options['owners'], options['owners'] * options['vehicles'], count, time.time() - start))
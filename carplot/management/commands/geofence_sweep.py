@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from carplot.geofence import load_zone_index, sweep_device
+from carplot.models import Device, GTS
+
+
+class Command(BaseCommand):
+    help = "Evaluates the new positions of the devices of an account against its geozones."
+
+    def add_arguments(self, parser):
+        parser.add_argument('account_id')
+        parser.add_argument('--since', type=int,
+                            help="creationTime to start from for the devices swept for the first time. "
+                                 "They start from their latest event if not set.")
+
+    def handle(self, *args, **options):
+        account_id = options['account_id']
+        start = time.time()
+        index = load_zone_index(account_id)
+        device_ids = list(Device.objects.using(GTS).filter(accountID=account_id).values_list('deviceID', flat=True))
+        count = 0
+        for device in Device.objects.filter(pk__in=device_ids):
+            for transition in sweep_device(index, device, options['since']):
+                self.stdout.write("%s %s %s at %d" % (transition.device_id, transition.event,
+                                                      transition.geozone_id, transition.creation_time))
+                count += 1
+        self.stdout.write("%d device(s), %d transition(s) in %.3fs" % (len(device_ids), count, time.time() - start))
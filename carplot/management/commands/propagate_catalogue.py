@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+from django.core.management.base import BaseCommand
+
+from carplot.propagation import propagate_catalogue, PROPAGATION_WORKERS
+
+
+class Command(BaseCommand):
+    help = "Pushes the DeviceType, SMSCommand and VehicleType rows to the databases of the carplot services."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', action='append',
+                            help="Alias of a database to update; can be repeated. All the services if not set.")
+        parser.add_argument('--workers', type=int, default=PROPAGATION_WORKERS)
+
+    def handle(self, *args, **options):
+        results = propagate_catalogue(options['database'], options['workers'])
+        for result in results:
+            if result.error:
+                self.stdout.write("%s: FAILED %s" % (result.database, result.error))
+            else:
+                self.stdout.write("%s: %d created, %d updated, %d deleted in %.3fs" %
+                                  (result.database, result.created, result.updated, result.deleted, result.duration))
+        self.stdout.write("%d database(s), %d failure(s)" %
+                          (len(results), len([result for result in results if result.error])))
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+from django.core.management.base import BaseCommand
+
+from carplot.provisioning import read_batch, provision_devices
+
+
+class Command(BaseCommand):
+    help = "Creates or updates in the app and opengts databases the devices of a CSV or JSON file."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV with imei, sim, type and name columns, or JSON list of objects")
+        parser.add_argument('--account', required=True, help="opengts accountID of the devices")
+        parser.add_argument('--format', choices=('csv', 'json'),
+                            help="Format of the file. Guessed from its extension if not set.")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        batch_format = options['format'] or ('json' if path.endswith('.json') else 'csv')
+        with open(path, 'rb') as f:
+            rows = read_batch(f.read(), batch_format)
+        report = provision_devices(rows, options['account'])
+        for line, message in report.errors:
+            self.stderr.write("Row %d: %s" % (line, message))
+        count = report.created + report.updated
+        self.stdout.write("%d created, %d updated, %d error(s) in %.3fs (%.1f devices/s)" %
+                          (report.created, report.updated, len(report.errors), report.duration,
+                           count / report.duration if report.duration else 0))
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+from django.core.management.base import BaseCommand
+
+from carplot.reconcile import reconcile_devices, RECONCILE_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = "Finds and fixes the differences between the app Device table and the opengts Device table."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--account', required=True, help="opengts accountID of the devices")
+        parser.add_argument('--dry-run', action='store_true', help="Only report the differences.")
+        parser.add_argument('--chunk-size', type=int, default=RECONCILE_CHUNK_SIZE)
+        parser.add_argument('--max-chunks', type=int,
+                            help="Stop after that many chunks; the next run resumes from there.")
+        parser.add_argument('--full', action='store_true',
+                            help="Walk every device, not only those changed since the last complete walk.")
+
+    def handle(self, *args, **options):
+        report = reconcile_devices(options['account'], options['dry_run'], options['chunk_size'],
+                                   options['max_chunks'], options['full'])
+        for divergence in report.divergences:
+            self.stdout.write("%s device=%s imei=%s %s" % (divergence.kind, divergence.device_id, divergence.imei,
+                                                           ', '.join(divergence.fields)))
+        status = "complete" if report.completed else "partial, will resume on next run"
+        if report.incremental:
+            status = "changed devices only, " + status
+        self.stdout.write("%d device(s) scanned in %d chunk(s), %d divergence(s), %d fixed in %.3fs (%s)" %
+                          (report.scanned, report.chunks, len(report.divergences), report.fixed,
+                           report.duration, status))
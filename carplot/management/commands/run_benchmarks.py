@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from carplot.benchmark import run_benchmark, compare_to_baseline, load_baseline, save_baseline
+
+
+class Command(BaseCommand):
+    help = "Measures latency percentiles, query counts and payload sizes of the hot endpoints " \
+           "on a fleet created by generate_fleet and compares them to a stored baseline."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=20)
+        parser.add_argument('--baseline', default='benchmark_baseline.json')
+        parser.add_argument('--save-baseline', action='store_true',
+                            help="Store the results as the new baseline instead of comparing")
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help="Relative increase of latency or payload size reported as a regression")
+
+    def handle(self, *args, **options):
+        results = run_benchmark(options['runs'])
+        self.stdout.write("%-22s %9s %9s %9s %9s  %s" % ('endpoint', 'p50 ms', 'p95 ms', 'p99 ms', 'bytes', 'queries'))
+        for name in sorted(results.keys()):
+            metrics = results[name]
+            queries = ', '.join('%s=%d' % item for item in sorted(metrics['queries'].items()))
+            self.stdout.write("%-22s %9.1f %9.1f %9.1f %9d  %s" % (name, metrics['p50'], metrics['p95'],
+                                                                   metrics['p99'], metrics['bytes'], queries))
+        path = options['baseline']
+        if options['save_baseline']:
+            save_baseline(path, results)
+            self.stdout.write("Baseline saved to %s" % path)
+            return
+        if not os.path.exists(path):
+            self.stdout.write("No baseline at %s, run with --save-baseline to create one" % path)
+            return
+        regressions = compare_to_baseline(results, load_baseline(path), options['tolerance'])
+        for name, metric, reference, value in regressions:
+            self.stdout.write("REGRESSION %s %s: %s -> %s" % (name, metric, reference, value))
+        if regressions:
+            raise CommandError("%d regression(s) against %s" % (len(regressions), path))
+        self.stdout.write("No regression against %s" % path)
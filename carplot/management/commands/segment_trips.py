@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+from django.core.management.base import BaseCommand
+
+from carplot.trips import segment_all_devices
+
+
+class Command(BaseCommand):
+    help = "Splits the new event data of every active device into trips and stops."
+
+    def handle(self, *args, **options):
+        count, duration = segment_all_devices()
+        self.stdout.write("%d trip(s) and stop(s) recorded in %.3fs" % (count, duration))
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from carplot.sync import sync_last_positions, SYNC_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Mirrors the last valid position of opengts devices into the app Device table."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=SYNC_BATCH_SIZE,
+                            help="Number of devices fetched from opengts in a single query.")
+        parser.add_argument('--interval', type=int, default=0,
+                            help="Seconds to wait between two sweeps. Runs a single sweep if 0.")
+
+    def handle(self, *args, **options):
+        interval = options['interval']
+        while True:
+            report = sync_last_positions(batch_size=options['batch_size'])
+            self.stdout.write("%d/%d device position(s) changed in %.3fs" %
+                              (report.changed, report.scanned, report.duration))
+            if not interval:
+                break
+            time.sleep(interval)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import time
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand
+
+from carplot.models import Device
+from carplot.rollups import update_all_rollups, rebuild_device_rollups
+
+
+class Command(BaseCommand):
+    help = "Adds the new event data to the daily rollups, or rebuilds the rollups of a date range."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild-start', help="First day to rebuild formatted as dd-mm-YYYY")
+        parser.add_argument('--rebuild-end', help="Last day to rebuild formatted as dd-mm-YYYY")
+        parser.add_argument('--device', action='append', dest='devices', default=[],
+                            help="Id of a device to rebuild. All active devices if not set.")
+
+    def handle(self, *args, **options):
+        if not options['rebuild_start']:
+            count, duration = update_all_rollups()
+            self.stdout.write("%d event(s) rolled up in %.3fs" % (count, duration))
+            return
+        start_day = datetime.strptime(options['rebuild_start'], '%d-%m-%Y').date()
+        end_day = datetime.strptime(options['rebuild_end'] or options['rebuild_start'], '%d-%m-%Y').date()
+        devices = Device.objects.filter(isActive=True)
+        if options['devices']:
+            devices = Device.objects.filter(pk__in=options['devices'])
+        start = time.time()
+        for device in devices:
+            first_day = rebuild_device_rollups(device, start_day, end_day)
+            if first_day > start_day:
+                self.stdout.write("Device %s: rollups up to %s kept, its events are archived" %
+                                  (device.id, first_day - timedelta(days=1)))
+        self.stdout.write("Rollups from %s to %s rebuilt in %.3fs" % (start_day, end_day, time.time() - start))
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import math
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+
+from carplot.icons import get_icon_table
+from carplot.metrics import phase
+from carplot.models import Device, Vehicle
+from carplot.versions import get_version, bump_version
+
+# Vehicles are shown one by one from this zoom level
+CLUSTER_MAX_ZOOM = getattr(settings, 'CARPLOT_CLUSTER_MAX_ZOOM', 15)
+# Width in pixels of the cells markers are grouped in
+CLUSTER_CELL_PIXELS = getattr(settings, 'CARPLOT_CLUSTER_CELL_PIXELS', 64)
+# The index of an owner is cached as a single value of a few hundred bytes per vehicle. Past a few
+# thousand vehicles it goes over the 1 MB items memcached takes by default, which then silently drops
+# it and the index is rebuilt on every request: start memcached with a larger -I for such fleets.
+MARKER_INDEX_TIMEOUT = getattr(settings, 'CARPLOT_MARKER_INDEX_TIMEOUT', 24 * 3600)
+# Size in degrees of the buckets of the index: the cluster cell at CLUSTER_MAX_ZOOM.
+# The cell at a lower zoom z is made of 2 ** (CLUSTER_MAX_ZOOM - z) buckets on each side.
+BUCKET_SIZE = 360.0 / 2 ** CLUSTER_MAX_ZOOM * CLUSTER_CELL_PIXELS / 256
+
+
+def _get_version_key(owner_id):
+    return 'carplot:marker_index:version:%s' % owner_id
+
+
+def _get_cache_key(owner_id, version):
+    return 'carplot:marker_index:%s:%d' % (owner_id, version)
+
+
+def get_bucket(lat, lng):
+    return int(math.floor(lat / BUCKET_SIZE)), int(math.floor(lng / BUCKET_SIZE))
+
+
+def _has_position(marker):
+    # Devices that never reported have no position or a 0.0 one
+    return marker['latitude'] not in (None, 0.0) and marker['longitude'] not in (None, 0.0)
+
+
+def _add_to_bucket(index, vehicle_id):
+    marker = index['markers'][vehicle_id]
+    if not _has_position(marker):
+        return
+    bucket = index['buckets'].setdefault(get_bucket(marker['latitude'], marker['longitude']), [0, 0.0, 0.0, []])
+    bucket[0] += 1
+    bucket[1] += marker['latitude']
+    bucket[2] += marker['longitude']
+    bucket[3].append(vehicle_id)
+
+
+def _remove_from_bucket(index, vehicle_id):
+    marker = index['markers'][vehicle_id]
+    if not _has_position(marker):
+        return
+    key = get_bucket(marker['latitude'], marker['longitude'])
+    bucket = index['buckets'][key]
+    bucket[3].remove(vehicle_id)
+    if not bucket[3]:
+        del index['buckets'][key]
+        return
+    bucket[0] -= 1
+    bucket[1] -= marker['latitude']
+    bucket[2] -= marker['longitude']
+
+
+def build_marker_index(owner_id):
+    """
+    Markers of the active vehicles of an owner, grouped in buckets of BUCKET_SIZE degrees
+    holding: number of markers, sum of their latitudes, sum of their longitudes and vehicle ids.
+    """
+    vehicles = list(Vehicle.objects.filter(status=Vehicle.ACTIVE, owner=owner_id))
+    devices = Device.objects.in_bulk([vehicle.device_id for vehicle in vehicles])
+    index = {'markers': {}, 'devices': {}, 'buckets': {}}
+    for vehicle in vehicles:
+        device = devices.get(vehicle.device_id)
+        if device is None:
+            continue
+        with phase('image_urls'):
+            photo = vehicle.photo.url if vehicle.photo else ''
+        index['markers'][vehicle.id] = {
+            'id': vehicle.id,
+            'name': vehicle.name,
+            'description': vehicle.description,
+            'vehicle_img': photo,
+            'latitude': device.lastValidLatitude,
+            'longitude': device.lastValidLongitude,
+            'displayName': device.displayName,
+            'icon': get_icon_table(vehicle.type_id)['static'],
+            'photo': photo,
+        }
+        index['devices'][str(device.id)] = vehicle.id
+        _add_to_bucket(index, vehicle.id)
+    return index
+
+
+def get_marker_index(owner_id):
+    """
+    Marker index of an owner. Indexes are cached under the current version of their
+    owner, so invalidating only takes to bump the version.
+    """
+    key = _get_cache_key(owner_id, get_version(_get_version_key(owner_id)))
+    index = cache.get(key)
+    if index is None:
+        index = build_marker_index(owner_id)
+        cache.set(key, index, MARKER_INDEX_TIMEOUT)
+    return index
+
+
+def invalidate_marker_index(owner_id):
+    bump_version(_get_version_key(owner_id))
+
+
+def get_markers(owner_id):
+    """
+    Markers of all the active vehicles of an owner having a position
+    """
+    return [marker for marker in get_marker_index(owner_id)['markers'].values() if _has_position(marker)]
+
+
+def get_clusters(owner_id, south, west, north, east, zoom):
+    """
+    Markers of the vehicles of an owner in a bounding box. Below CLUSTER_MAX_ZOOM, markers
+    sharing a cell of CLUSTER_CELL_PIXELS are grouped in a cluster; lone markers stay markers.
+
+    this function returns a list of clusters as dicts of: count, latitude and longitude of their centroid,
+    and the list of markers shown one by one
+    """
+    index = get_marker_index(owner_id)
+    min_bucket, max_bucket = get_bucket(south, west), get_bucket(north, east)
+    shift = max(CLUSTER_MAX_ZOOM - int(zoom), 0)
+    cells = {}
+    for key, bucket in index['buckets'].items():
+        if not (min_bucket[0] <= key[0] <= max_bucket[0] and min_bucket[1] <= key[1] <= max_bucket[1]):
+            continue
+        cell = cells.setdefault((key[0] >> shift, key[1] >> shift), [0, 0.0, 0.0, []])
+        cell[0] += bucket[0]
+        cell[1] += bucket[1]
+        cell[2] += bucket[2]
+        cell[3].append(bucket[3])
+    clusters, markers = [], []
+    for count, sum_lat, sum_lng, vehicle_ids in cells.values():
+        if count == 1 or shift == 0:
+            markers.extend(index['markers'][vehicle_id] for ids in vehicle_ids for vehicle_id in ids)
+        else:
+            clusters.append({'count': count, 'latitude': sum_lat / count, 'longitude': sum_lng / count})
+    return clusters, markers
+
+
+def refresh_marker_positions(positions):
+    """
+    Moves the markers of devices whose position changed to their new bucket. The index is
+    written back under the version it was read from: if it was invalidated meanwhile, the
+    rewritten copy is never read and the next request rebuilds it with the new positions.
+
+    @param positions: dict of device id -> (latitude, longitude)
+    """
+    owners = {}
+    for owner_id, device_id in Vehicle.objects.filter(device__in=list(positions.keys()))\
+            .values_list('owner', 'device'):
+        owners.setdefault(owner_id, []).append(str(device_id))
+    for owner_id, device_ids in owners.items():
+        key = _get_cache_key(owner_id, get_version(_get_version_key(owner_id)))
+        index = cache.get(key)
+        if index is None:
+            continue
+        for device_id in device_ids:
+            vehicle_id = index['devices'].get(device_id)
+            if vehicle_id is None:
+                continue
+            _remove_from_bucket(index, vehicle_id)
+            marker = index['markers'][vehicle_id]
+            marker['latitude'], marker['longitude'] = positions[device_id]
+            _add_to_bucket(index, vehicle_id)
+        cache.set(key, index, MARKER_INDEX_TIMEOUT)
+
+
+def _on_vehicle_changed(sender, instance, **kwargs):
+    invalidate_marker_index(instance.owner_id)
+
+
+def _on_device_saved(sender, instance, using, **kwargs):
+    if using != 'default':
+        return
+    for owner_id in Vehicle.objects.filter(device=instance.pk).values_list('owner', flat=True):
+        invalidate_marker_index(owner_id)
+
+
+post_save.connect(_on_vehicle_changed, sender=Vehicle)
+post_delete.connect(_on_vehicle_changed, sender=Vehicle)
+post_save.connect(_on_device_saved, sender=Device)
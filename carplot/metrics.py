@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Nothing is recorded unless MetricsMiddleware is installed. In production, add it to the
+# MIDDLEWARE_CLASSES of conf/settings.py, and set CARPLOT_METRICS_TOKEN for the scraper:
+#   MIDDLEWARE_CLASSES = tuple(MIDDLEWARE_CLASSES) + ('carplot.metrics.MetricsMiddleware',)
+#   CARPLOT_METRICS_TOKEN = '<secret passed as ?token= by Prometheus>'
+# The histograms are kept per process: every worker is to be scraped on its own.
+
+# Requests longer than this number of milliseconds are logged with their queries
+SLOW_REQUEST_THRESHOLD = getattr(settings, 'CARPLOT_SLOW_REQUEST_THRESHOLD', 1000)
+METRICS_TOKEN = getattr(settings, 'CARPLOT_METRICS_TOKEN', None)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+METRICS = (
+    ('carplot_request_duration_seconds', "Wall time of requests", DURATION_BUCKETS),
+    ('carplot_db_queries', "Number of queries per request and database alias", COUNT_BUCKETS),
+    ('carplot_db_duration_seconds', "Time spent in queries per request and database alias", DURATION_BUCKETS),
+    ('carplot_response_bytes', "Size of response bodies", SIZE_BUCKETS),
+    ('carplot_phase_duration_seconds', "Time spent in the phases timed by the views", DURATION_BUCKETS),
+)
+_buckets = dict((name, buckets) for name, description, buckets in METRICS)
+
+_local = threading.local()
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+            self.sum += value
+            self.count += 1
+
+    def snapshot(self):
+        """
+        Returns the cumulative count of each bucket, the sum and the count of the observed values
+        """
+        with self.lock:
+            cumulative, total = [], 0
+            for count in self.counts:
+                total += count
+                cumulative.append(total)
+            return cumulative, self.sum, self.count
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def observe(metric, value, **labels):
+    key = (metric, tuple(sorted(labels.items())))
+    histogram = _histograms.get(key)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = _histograms.setdefault(key, Histogram(_buckets[metric]))
+    histogram.observe(value)
+
+
+@contextmanager
+def phase(name):
+    """
+    Times the enclosed block as a phase of the current request
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        phases = getattr(_local, 'phases', None)
+        if phases is not None:
+            phases[name] = phases.get(name, 0) + time.time() - start
+
+
+def dumps(obj):
+    with phase('json_encode'):
+        return json.dumps(obj)
+
+
+def _format_labels(labels, **extra):
+    labels = list(labels) + sorted(extra.items())
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('"', '\\"')) for key, value in labels)
+
+
+def render_metrics():
+    """
+    this function returns the histograms in Prometheus text exposition format
+    """
+    lines = []
+    with _histograms_lock:
+        items = sorted(_histograms.items())
+    for name, description, buckets in METRICS:
+        lines.append('# HELP %s %s' % (name, description))
+        lines.append('# TYPE %s histogram' % name)
+        for (metric, labels), histogram in items:
+            if metric != name:
+                continue
+            cumulative, total, count = histogram.snapshot()
+            for bound, value in zip(buckets, cumulative):
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labels, le=bound), value))
+            lines.append('%s_bucket%s %d' % (name, _format_labels(labels, le='+Inf'), count))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labels), total))
+            lines.append('%s_count%s %d' % (name, _format_labels(labels), count))
+    return '\n'.join(lines) + '\n'
+
+
+def render_counter(name, description, value):
+    """
+    this function returns a counter in Prometheus text exposition format
+    """
+    return '# HELP %s %s\n# TYPE %s counter\n%s %s\n' % (name, description, name, name, value)
+
+
+class MetricsMiddleware(object):
+    """
+    Records for every view: wall time, number of queries and DB time per database alias,
+    response bytes and the phases timed by the view. Requests slower than SLOW_REQUEST_THRESHOLD
+    are logged with their queries. Goes in MIDDLEWARE_CLASSES as 'carplot.metrics.MetricsMiddleware'.
+    """
+    def process_request(self, request):
+        request._carplot_start = time.time()
+        request._carplot_queries = {}
+        for alias in connections:
+            connection = connections[alias]
+            request._carplot_queries[alias] = (connection.force_debug_cursor, len(connection.queries_log))
+            connection.force_debug_cursor = True
+        _local.phases = {}
+
+    def process_response(self, request, response):
+        start = getattr(request, '_carplot_start', None)
+        if start is None:
+            return response
+        duration = time.time() - start
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match and match.url_name else 'other'
+        observe('carplot_request_duration_seconds', duration, view=view)
+        queries = []
+        for alias, (force_debug_cursor, offset) in request._carplot_queries.items():
+            connection = connections[alias]
+            alias_queries = list(connection.queries_log)[offset:]
+            connection.force_debug_cursor = force_debug_cursor
+            observe('carplot_db_queries', len(alias_queries), view=view, alias=alias)
+            observe('carplot_db_duration_seconds', sum(float(query['time']) for query in alias_queries),
+                    view=view, alias=alias)
+            queries.extend((alias, query) for query in alias_queries)
+        if not getattr(response, 'streaming', False):
+            observe('carplot_response_bytes', len(response.content), view=view)
+        for name, value in (getattr(_local, 'phases', None) or {}).items():
+            observe('carplot_phase_duration_seconds', value, view=view, phase=name)
+        _local.phases = None
+        if duration * 1000 >= SLOW_REQUEST_THRESHOLD:
+            logger.warning("Slow request %s %s: %.0fms, %d queries\n%s", request.method, request.get_full_path(),
+                           duration * 1000, len(queries),
+                           '\n'.join('[%s] %ss %s' % (alias, query['time'], query['sql']) for alias, query in queries))
+        return response
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 __author__ = 'Roddy Mbogning'
 
+import time
 from django.db import models
 from datetime import datetime
 import datetime
@@ -14,6 +15,8 @@ from ikwen.foundation.core.context_processors import project_settings
 
 
 GTS = 'opengts'
+# EventData.statusCode is an unsigned 32 bits integer in opengts
+MAX_STATUS_CODE = 0xFFFFFFFF
 IS_IKWEN = getattr(settings, 'IS_IKWEN', False)
 
 
@@ -85,6 +88,8 @@ class Device(models.Model):
     lastValidLongitude = models.FloatField(blank=True, null=True, default=0.0)
     device_type = models.ForeignKey(DeviceType, null=True, blank=True, help_text=
                     _('Type of device'))
+    # Column of the opengts Device table, also stamped on the app devices to find those changed
+    lastUpdateTime = models.IntegerField(default=0, editable=False)
 
     class Meta:
         db_table = 'Device'
@@ -97,6 +102,10 @@ class Device(models.Model):
     def __unicode__(self):
         return self.displayName
 
+    def save(self, *args, **kwargs):
+        self.lastUpdateTime = int(time.time())
+        super(Device, self).save(*args, **kwargs)
+
     def to_dict(self):
         var = to_dict(self)
         # var['created_on'] = self.view_when
@@ -174,6 +183,7 @@ class EventData(models.Model):
     class Meta:
         db_table = 'EventData'
         unique_together = (("accountID", "deviceID", "timestamp", "statusCode"),)
+        index_together = (("deviceID", "creationTime"),)
 
     def _get_when(self):
         created_on = datetime.datetime.fromtimestamp(self.creationTime)
@@ -259,4 +269,92 @@ class Geozone(models.Model):
     creationTime = models.IntegerField(blank=True)
 
     class Meta:
-        db_table = 'Geozone'
\ No newline at end of file
+        db_table = 'Geozone'
+
+
+class Watermark(models.Model):
+    """
+    Position of an incremental job in the EventData of a device, so that
+    each run only processes the events that came after the previous one.
+    Jobs that walk the whole fleet keep a single Watermark without device.
+    """
+    job = models.CharField(max_length=60)
+    device = models.ForeignKey(Device, blank=True, null=True)
+    creationTime = models.IntegerField(default=0)
+    timestamp = models.IntegerField(default=0)
+    statusCode = models.IntegerField(blank=True, null=True, help_text=
+                    _("None on watermarks saved before statusCode was kept, they cover every event of their second"))
+    state = models.TextField(blank=True, help_text=_("JSON state of the job carried from a run to the next"))
+
+    class Meta:
+        unique_together = (("job", "device"),)
+
+    def _get_cursor(self):
+        status_code = MAX_STATUS_CODE if self.statusCode is None else self.statusCode
+        return self.creationTime, self.timestamp, status_code
+    cursor = property(_get_cursor)
+
+
+class Trip(models.Model):
+    TRIP = 'Trip'
+    STOP = 'Stop'
+    KIND_CHOICES = (
+        (TRIP, _('Trip')),
+        (STOP, _('Stop')),
+    )
+    device = models.ForeignKey(Device)
+    kind = models.CharField(max_length=10, choices=KIND_CHOICES, default=TRIP)
+    start_time = models.IntegerField(help_text=_("creationTime of the first event of the trip or stop"))
+    end_time = models.IntegerField(help_text=_("creationTime of the last event of the trip or stop"))
+    start_latitude = models.FloatField()
+    start_longitude = models.FloatField()
+    end_latitude = models.FloatField()
+    end_longitude = models.FloatField()
+    distance = models.FloatField(default=0, help_text=_("Distance covered in km"))
+    max_speed = models.FloatField(default=0)
+    avg_speed = models.FloatField(default=0)
+    idle_duration = models.IntegerField(default=0, help_text=_("Time spent stopped in seconds"))
+
+    class Meta:
+        index_together = (("device", "start_time"),)
+
+    def to_dict(self):
+        var = to_dict(self)
+        return var
+
+
+class DailyRollup(models.Model):
+    """
+    Aggregates of the EventData of a device over a day, kept up to date by carplot.rollups
+    """
+    device = models.ForeignKey(Device)
+    day = models.DateField()
+    event_count = models.IntegerField(default=0)
+    distance = models.FloatField(default=0, help_text=_("Distance covered in km"))
+    max_speed = models.FloatField(default=0)
+    speed_sum = models.FloatField(default=0, help_text=_("Sum of the speeds of the moving events, to compute averages"))
+    moving_count = models.IntegerField(default=0)
+    moving_duration = models.IntegerField(default=0, help_text=_("Time spent moving in seconds"))
+    max_odometer = models.FloatField(default=0)
+
+    class Meta:
+        unique_together = (("device", "day"),)
+
+    def _get_avg_speed(self):
+        return self.speed_sum / self.moving_count if self.moving_count else 0
+    avg_speed = property(_get_avg_speed)
+
+
+class DeviceHealth(models.Model):
+    """
+    Status of a device checked against OperatorProfile.maximum_latency by carplot.health.
+    last_report is refreshed by every sweep; changed_on only moves when the status changes.
+    """
+    device = models.OneToOneField(Device)
+    last_report = models.IntegerField(default=0, help_text=_("creationTime of the last event data of the device"))
+    is_functional = models.BooleanField(default=False)
+    changed_on = models.IntegerField(default=0, help_text=_("Time at which the device got its current status"))
+
+    def _get_latency(self):
+        return int(time.time()) - self.last_report if self.last_report else None
+    latency = property(_get_latency)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import heapq
+import json
+import math
+from collections import deque
+
+from django.conf import settings
+
+from carplot.archive import iter_archived_events
+from carplot.queries import iter_fleet_event_data
+from carplot.trips import MAX_EVENT_GAP
+
+PLAYBACK_FIELDS = ('deviceID', 'creationTime', 'timestamp', 'statusCode', 'latitude', 'longitude', 'speedKPH',
+                   'heading')
+# Length in seconds of the time windows the playback is streamed in
+PLAYBACK_WINDOW = getattr(settings, 'CARPLOT_PLAYBACK_WINDOW', 900)
+# The step of the time grid is raised so that a playback never has more frames than this
+PLAYBACK_MAX_FRAMES = getattr(settings, 'CARPLOT_PLAYBACK_MAX_FRAMES', 20000)
+
+
+def _iter_archived_rows(device_id, start_date, end_date):
+    for event in iter_archived_events(device_id, start_date, end_date):
+        yield dict((field, getattr(event, field)) for field in PLAYBACK_FIELDS)
+
+
+def _decorate(stream, index):
+    # Rows are decorated with their sort key and stream since dicts cannot be compared.
+    # A device can send several events at the same second with different statusCode
+    for row in stream:
+        yield (row['creationTime'], row['timestamp'], row['deviceID'], row['statusCode']), index, row
+
+
+def iter_playback_rows(device_ids, start_date, end_date):
+    """
+    Yields the positions of all the devices in chronological order: the archived ones
+    merged with those read from the database in a single ordered query.
+    Positions without coordinates are skipped.
+    """
+    streams = [_iter_archived_rows(device_id, start_date, end_date) for device_id in device_ids]
+    streams.append(iter_fleet_event_data(device_ids, start_date, end_date, fields=PLAYBACK_FIELDS))
+    decorated = [_decorate(stream, i) for i, stream in enumerate(streams)]
+    previous_key = None
+    for key, i, row in heapq.merge(*decorated):
+        # Events archived with --keep-rows are also in the database
+        if key != previous_key and row['latitude'] and row['longitude']:
+            yield row
+        previous_key = key
+
+
+def _interpolate_heading(heading0, heading1, ratio):
+    """
+    Interpolates along the shortest arc, so that 350° to 10° goes through 0° and not 180°
+    """
+    delta = ((heading1 or 0) - (heading0 or 0) + 180) % 360 - 180
+    return ((heading0 or 0) + delta * ratio) % 360
+
+
+class Resampler(object):
+    """
+    Resamples the interleaved positions of many devices onto a common time grid of step seconds.
+
+    Between two positions less than max_gap seconds apart, the position is linearly interpolated;
+    after a longer gap the vehicle is held at its last position with a null speed. A frame is only
+    final once positions max_gap seconds after it have been read, so just the positions of that
+    lookahead are kept in memory.
+    """
+    def __init__(self, device_ids, start_date, end_date, step, max_gap=MAX_EVENT_GAP):
+        self.device_ids = list(device_ids)
+        self.end_date = end_date
+        self.step = step
+        self.max_gap = max_gap
+        self.next_time = start_date
+        self.points = dict((device_id, deque()) for device_id in self.device_ids)
+
+    def _get_value(self, device_id, frame_time):
+        points = self.points[device_id]
+        while len(points) > 1 and points[1]['creationTime'] <= frame_time:
+            points.popleft()
+        if not points or points[0]['creationTime'] > frame_time:
+            return None
+        previous = points[0]
+        if len(points) > 1 and points[1]['creationTime'] - previous['creationTime'] <= self.max_gap:
+            following = points[1]
+            ratio = (frame_time - previous['creationTime']) / float(following['creationTime'] -
+                                                                   previous['creationTime'])
+            return (previous['latitude'] + (following['latitude'] - previous['latitude']) * ratio,
+                    previous['longitude'] + (following['longitude'] - previous['longitude']) * ratio,
+                    (previous['speedKPH'] or 0) + ((following['speedKPH'] or 0) - (previous['speedKPH'] or 0)) * ratio,
+                    _interpolate_heading(previous['heading'], following['heading'], ratio))
+        if frame_time - previous['creationTime'] <= self.max_gap:
+            return previous['latitude'], previous['longitude'], previous['speedKPH'] or 0, previous['heading'] or 0
+        return previous['latitude'], previous['longitude'], 0, previous['heading'] or 0
+
+    def _get_frame(self):
+        frame_time = self.next_time
+        self.next_time += self.step
+        return frame_time, dict((device_id, self._get_value(device_id, frame_time)) for device_id in self.device_ids)
+
+    def feed(self, row):
+        """
+        Adds a position and yields the frames that became final as (time, dict of device id -> value),
+        value being (latitude, longitude, speed, heading) or None before the first position of the device
+        """
+        points = self.points.get(row['deviceID'])
+        if points is None:
+            return
+        points.append(row)
+        while self.next_time < self.end_date and self.next_time + self.max_gap < row['creationTime']:
+            yield self._get_frame()
+
+    def flush(self):
+        while self.next_time < self.end_date:
+            yield self._get_frame()
+
+
+def _encode_window(window_start, frames, device_ids):
+    tracks = {}
+    for device_id in device_ids:
+        values = [frame[1][device_id] for frame in frames]
+        tracks[device_id] = {
+            'latitude': [value[0] if value else None for value in values],
+            'longitude': [value[1] if value else None for value in values],
+            'speed': [value[2] if value else None for value in values],
+            'heading': [value[3] if value else None for value in values],
+        }
+    return json.dumps({'start': window_start, 'times': [frame[0] for frame in frames], 'tracks': tracks}) + '\n'
+
+
+def iter_resampled_windows(device_ids, start_date, end_date, step, window=PLAYBACK_WINDOW):
+    """
+    Yields NDJSON lines, one per time window, holding the grid times and for every device
+    the parallel arrays of latitude, longitude, speed and heading at these times.
+    """
+    resampler = Resampler(device_ids, start_date, end_date, step)
+    window_start, frames = start_date, []
+
+    def iter_frames():
+        for row in iter_playback_rows(device_ids, start_date, end_date):
+            for frame in resampler.feed(row):
+                yield frame
+        for frame in resampler.flush():
+            yield frame
+
+    for frame in iter_frames():
+        while frame[0] >= window_start + window:
+            if frames:
+                yield _encode_window(window_start, frames, device_ids)
+            window_start, frames = window_start + window, []
+        frames.append(frame)
+    if frames:
+        yield _encode_window(window_start, frames, device_ids)
+
+
+def iter_raw_windows(device_ids, start_date, end_date, window=PLAYBACK_WINDOW):
+    """
+    Yields NDJSON lines, one per time window having positions, holding the positions of each device
+    """
+    window_start, events = start_date, {}
+    for row in iter_playback_rows(device_ids, start_date, end_date):
+        if row['creationTime'] >= window_start + window:
+            if events:
+                yield json.dumps({'start': window_start, 'events': events}) + '\n'
+            # Straight to the window of the row, over the empty ones
+            window_start += (row['creationTime'] - window_start) // window * window
+            events = {}
+        events.setdefault(row['deviceID'], []).append(
+            dict((field, row[field]) for field in PLAYBACK_FIELDS if field != 'deviceID'))
+    if events:
+        yield json.dumps({'start': window_start, 'events': events}) + '\n'
+
+
+def iter_playback(devices, start_date, end_date, step=None, window=PLAYBACK_WINDOW):
+    """
+    Streams the synchronized history of many devices as NDJSON: a header line describing the
+    devices and the grid, then a line per time window.
+
+    @param devices: dict of device id -> dict describing the device sent in the header
+    @param step: step of the time grid in seconds; raw positions are streamed if None
+    @param window: length in seconds of the time windows; must be positive
+    """
+    if window <= 0:
+        raise ValueError("window must be a positive number of seconds")
+    device_ids = sorted(devices.keys())
+    if step:
+        step = max(int(step), int(math.ceil((end_date - start_date) / float(PLAYBACK_MAX_FRAMES))), 1)
+    yield json.dumps({'devices': devices, 'start': start_date, 'end': end_date, 'step': step,
+                      'window': window}) + '\n'
+    if step:
+        windows = iter_resampled_windows(device_ids, start_date, end_date, step, window)
+    else:
+        windows = iter_raw_windows(device_ids, start_date, end_date, window)
+    for line in windows:
+        yield line
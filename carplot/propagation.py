@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import logging
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connections, transaction
+
+from ikwen.core.models import Application, Service
+from ikwen.core.utils import add_database_to_settings
+from carplot.models import DeviceType, SMSCommand, VehicleType, IS_IKWEN
+
+logger = logging.getLogger(__name__)
+
+# Threads pushing to the tenant databases. Those of the admin saves are kept from a save to the next
+# with their connections, which stay open as long as the CONN_MAX_AGE of the tenant databases allows
+PROPAGATION_WORKERS = getattr(settings, 'CARPLOT_PROPAGATION_WORKERS', 8)
+# Push catalogue changes made in the admin to the tenant databases
+PROPAGATE_CATALOGUE = getattr(settings, 'CARPLOT_PROPAGATE_CATALOGUE', IS_IKWEN)
+# Catalogue models in dependency order: SMSCommand references DeviceType
+CATALOGUE_MODELS = (DeviceType, SMSCommand, VehicleType)
+
+PropagationResult = namedtuple('PropagationResult', 'database created updated deleted error duration')
+
+_registration_lock = threading.Lock()
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+
+def get_tenant_databases():
+    """
+    Databases of the services of the carplot application, registered in settings.DATABASES
+    """
+    app = Application.objects.get(slug='carplot')
+    databases = []
+    for database in Service.objects.filter(app=app).values_list('database', flat=True):
+        if not database or database == 'default':
+            continue
+        if database not in settings.DATABASES:
+            # Not thread safe: done under a lock, before the fan-out
+            with _registration_lock:
+                if database not in settings.DATABASES:
+                    add_database_to_settings(database)
+        databases.append(database)
+    return databases
+
+
+def _get_values(obj):
+    return dict((field.attname, getattr(obj, field.attname)) for field in obj._meta.fields if not field.primary_key)
+
+
+def push_to_database(database, changes, keep_connection=False):
+    """
+    Applies catalogue changes to a tenant database in a single transaction:
+    per model, one query to find the existing rows, one bulk insert and one update per existing row.
+
+    @param changes: list of (model, objects to create or update, primary keys to delete)
+    @param keep_connection: whether the thread pushes again later and can reuse its connection
+    this function returns a PropagationResult
+    """
+    start = time.time()
+    created, updated, deleted = 0, 0, 0
+    try:
+        with transaction.atomic(using=database):
+            for model, objects, deleted_ids in changes:
+                manager = model.objects.using(database)
+                if objects:
+                    existing = set(manager.filter(pk__in=[obj.pk for obj in objects]).values_list('pk', flat=True))
+                    manager.bulk_create([model(pk=obj.pk, **_get_values(obj)) for obj in objects
+                                         if obj.pk not in existing])
+                    for obj in objects:
+                        if obj.pk in existing:
+                            manager.filter(pk=obj.pk).update(**_get_values(obj))
+                    created += len(objects) - len(existing)
+                    updated += len(existing)
+                if deleted_ids:
+                    deleted += manager.filter(pk__in=deleted_ids).count()
+                    manager.filter(pk__in=deleted_ids).delete()
+        error = None
+    except Exception as e:
+        logger.exception("Catalogue propagation to %s failed", database)
+        created, updated, deleted, error = 0, 0, 0, str(e)
+    finally:
+        # Worker threads do not go through the request cycle that closes connections
+        if keep_connection:
+            connections[database].close_if_unusable_or_obsolete()
+        else:
+            connections[database].close()
+    return PropagationResult(database, created, updated, deleted, error, time.time() - start)
+
+
+def propagate(changes, databases=None, workers=PROPAGATION_WORKERS):
+    """
+    Pushes catalogue changes to all the tenant databases from a bounded pool of threads.
+
+    @param changes: list of (model, objects to create or update, primary keys to delete)
+    @param databases: aliases of the databases to update; those of the carplot services if None
+    this function returns the list of PropagationResult, one per database
+    """
+    if databases is None:
+        databases = get_tenant_databases()
+    if not databases:
+        return []
+    pool = ThreadPool(min(workers, len(databases)))
+    try:
+        return pool.map(lambda database: push_to_database(database, changes), databases)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _get_shared_pool():
+    global _shared_pool
+    with _shared_pool_lock:
+        if _shared_pool is None:
+            _shared_pool = ThreadPool(PROPAGATION_WORKERS)
+        return _shared_pool
+
+
+def propagate_catalogue(databases=None, workers=PROPAGATION_WORKERS):
+    """
+    Pushes all the DeviceType, SMSCommand and VehicleType rows to the tenant databases
+    """
+    changes = [(model, list(model.objects.all()), None) for model in CATALOGUE_MODELS]
+    return propagate(changes, databases, workers)
+
+
+def propagate_in_background(model, objects=None, deleted_ids=None):
+    """
+    Propagates the change of an admin save or delete without holding the request. The tenant
+    databases are registered on the calling thread, the pushes run in the threads of a shared pool.
+    """
+    if not PROPAGATE_CATALOGUE:
+        return
+    databases = get_tenant_databases()
+    if not databases:
+        return
+    changes = [(model, objects or [], deleted_ids)]
+
+    def log_errors(results):
+        for result in results:
+            if result.error:
+                logger.error("%s not propagated to %s: %s", model.__name__, result.database, result.error)
+
+    # push_to_database reports its errors in its result, nothing is raised to the pool
+    _get_shared_pool().map_async(lambda database: push_to_database(database, changes, True), databases,
+                                 callback=log_errors)
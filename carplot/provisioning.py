@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import csv
+import json
+import time
+from collections import namedtuple
+
+from django.core.exceptions import ValidationError
+from django.db import transaction, DatabaseError
+
+from carplot.catalogue import invalidate_device_type
+from carplot.markers import invalidate_marker_index
+from carplot.models import Device, DeviceType, GTS, Vehicle
+from carplot.queries import MAX_QUERY_PARAMS, update_rows
+from carplot.search import invalidate_index
+
+# MySQL does not allow varchars as keys so opengts devices get a default integer device_type_id
+GTS_DEVICE_TYPE_ID = 5
+GTS_UPDATED_FIELDS = ('vehicleID', 'description', 'displayName', 'imeiNumber', 'simPhoneNumber')
+# Fields of the existing app devices written by a batch
+BATCH_UPDATED_FIELDS = ('displayName', 'simPhoneNumber', 'device_type_id', 'accountID', 'uniqueID', 'vehicleID',
+                        'deviceID', 'lastUpdateTime')
+# Column names accepted in batch files, mapped to Device fields
+COLUMN_ALIASES = {
+    'imei': 'imeiNumber',
+    'sim': 'simPhoneNumber',
+    'type': 'device_type',
+    'name': 'displayName',
+}
+
+ProvisioningReport = namedtuple('ProvisioningReport', 'created updated errors duration')
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _get_devices_by_imei(imeis):
+    devices = {}
+    for chunk in _chunks(imeis, MAX_QUERY_PARAMS):
+        devices.update((device.imeiNumber, device) for device in Device.objects.filter(imeiNumber__in=chunk))
+    return devices
+
+
+def _invalidate_owner_indexes(device_ids):
+    """
+    Batches are written without post_save: the search and marker indexes of the owners of the
+    vehicles using the devices are invalidated here instead.
+    """
+    owner_ids = set()
+    for chunk in _chunks(device_ids, MAX_QUERY_PARAMS):
+        owner_ids.update(Vehicle.objects.filter(device__in=chunk).values_list('owner', flat=True))
+    for owner_id in owner_ids:
+        invalidate_index(owner_id)
+        invalidate_marker_index(owner_id)
+
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def read_batch(data, batch_format):
+    """
+    Parses a CSV or JSON batch of devices into a list of dicts keyed by Device field names
+
+    @param data: content of the batch file as UTF-8 encoded bytes
+    """
+    if batch_format == 'json':
+        rows = json.loads(data.decode('utf-8'))
+    elif bytes is str:
+        # Python 2 csv module only reads bytes, cells are decoded once split
+        rows = list(csv.DictReader(data.splitlines()))
+    else:
+        rows = list(csv.DictReader(data.decode('utf-8').splitlines()))
+    return [dict((COLUMN_ALIASES.get(_decode(key).strip(), _decode(key).strip()), _decode(value or '').strip())
+                 for key, value in row.items() if key) for row in rows]
+
+
+def _set_gts_ids(device, account_id):
+    """
+    The account of a device is only set once: later changes made by another admin do not move it.
+    """
+    if not device.accountID:
+        device.accountID = account_id
+    device.uniqueID = 'tk_%s' % device.imeiNumber
+    device.vehicleID = 'tk_%s' % device.imeiNumber
+    device.deviceID = str(device.id)
+
+
+def _copy_for_gts(device, account_id):
+    values = dict((field.attname, getattr(device, field.attname)) for field in Device._meta.fields)
+    values.update({'id': None, 'device_type_id': GTS_DEVICE_TYPE_ID, 'accountID': device.accountID or account_id})
+    return Device(**values)
+
+
+def upsert_gts_devices(devices, account_id):
+    """
+    Creates or updates the opengts copy of app devices in a single transaction:
+    one query to find the existing rows, one bulk insert and one batched update of the existing rows.
+    """
+    devices = dict((device.deviceID, device) for device in devices)
+    with transaction.atomic(using=GTS):
+        existing = set(Device.objects.using(GTS).filter(deviceID__in=list(devices.keys()))
+                       .values_list('deviceID', flat=True))
+        Device.objects.using(GTS).bulk_create([_copy_for_gts(device, account_id)
+                                               for device_id, device in devices.items() if device_id not in existing])
+        values = dict((device_id, dict((field, getattr(devices[device_id], field)) for field in GTS_UPDATED_FIELDS))
+                      for device_id in existing)
+        update_rows(Device.objects.using(GTS), 'deviceID', values, GTS_UPDATED_FIELDS)
+
+
+def provision_device(device, account_id):
+    """
+    Completes a device saved in the app database with its opengts identifiers and mirrors it in opengts.
+    """
+    _set_gts_ids(device, account_id)
+    Device.objects.filter(pk=device.pk).update(accountID=device.accountID, uniqueID=device.uniqueID,
+                                               vehicleID=device.vehicleID, deviceID=device.deviceID,
+                                               lastUpdateTime=int(time.time()))
+    upsert_gts_devices([device], account_id)
+
+
+def provision_devices(rows, account_id):
+    """
+    Creates or updates in both databases the devices of a batch, matched on their IMEI.
+
+    @param rows: dicts with imeiNumber, simPhoneNumber, device_type (name or id) and displayName
+    @param account_id: accountID of the devices in opengts
+    this function returns a ProvisioningReport of: devices created, devices updated,
+    list of (row number, error message) and duration in seconds. Row 0 is for the batch as a whole.
+    """
+    start = time.time()
+    device_types = {}
+    for device_type in DeviceType.objects.all():
+        device_types[device_type.name] = device_type
+        device_types[str(device_type.id)] = device_type
+    errors = []
+    valid_rows = {}
+    for i, row in enumerate(rows, 1):
+        imei = row.get('imeiNumber')
+        if not imei or not row.get('displayName'):
+            errors.append((i, "imeiNumber and displayName are required"))
+        elif imei in valid_rows:
+            errors.append((i, "IMEI %s appears twice in the batch" % imei))
+        elif row.get('device_type') and row['device_type'] not in device_types:
+            errors.append((i, "Unknown device type %s" % row['device_type']))
+        else:
+            valid_rows[imei] = i, row
+    existing = _get_devices_by_imei(list(valid_rows.keys()))
+    new_devices, changed_devices = [], []
+    now = int(time.time())
+    for imei, (i, row) in sorted(valid_rows.items(), key=lambda item: item[1][0]):
+        device = existing.get(imei) or Device(imeiNumber=imei)
+        device.displayName = row['displayName']
+        device.simPhoneNumber = row.get('simPhoneNumber', device.simPhoneNumber)
+        if row.get('device_type'):
+            device.device_type = device_types[row['device_type']]
+        _set_gts_ids(device, account_id)
+        device.lastUpdateTime = now
+        if device.pk is None:
+            # Unique stand-in until the primary key the opengts deviceID is made of is known
+            device.deviceID = device.uniqueID
+        try:
+            # A failing row is reported without stopping the batch. Uniqueness was checked on the
+            # IMEI above and device types against the loaded ones, sparing a query per row
+            device.full_clean(exclude=['device_type'], validate_unique=False)
+        except ValidationError as e:
+            errors.append((i, "IMEI %s: %s" % (imei, e)))
+            continue
+        if device.pk is None:
+            new_devices.append(device)
+        else:
+            changed_devices.append(device)
+    try:
+        with transaction.atomic():
+            Device.objects.bulk_create(new_devices)
+            # bulk_create does not set the primary keys on every backend
+            created = _get_devices_by_imei([device.imeiNumber for device in new_devices])
+            for device in new_devices:
+                device.pk = created[device.imeiNumber].pk
+                device.deviceID = str(device.pk)
+            update_rows(Device.objects.all(), 'pk',
+                        dict((device.pk, {'deviceID': device.deviceID}) for device in new_devices), ('deviceID',))
+            update_rows(Device.objects.all(), 'pk',
+                        dict((device.pk, dict((field, getattr(device, field)) for field in BATCH_UPDATED_FIELDS))
+                             for device in changed_devices), BATCH_UPDATED_FIELDS)
+    except DatabaseError as e:
+        errors.append((0, "Batch not saved: %s" % e))
+        return ProvisioningReport(0, 0, errors, time.time() - start)
+    devices = new_devices + changed_devices
+    if devices:
+        try:
+            upsert_gts_devices(devices, account_id)
+        except DatabaseError as e:
+            # The devices are saved in the app, reconcile_devices will mirror them once opengts is back
+            errors.append((0, "opengts not updated, run reconcile_devices: %s" % e))
+        invalidate_device_type(*[device.id for device in devices])
+        _invalidate_owner_indexes([device.id for device in devices])
+    return ProvisioningReport(len(new_devices), len(changed_devices), errors, time.time() - start)
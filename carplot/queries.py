@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import re
+import sqlite3
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Case, F, Q, Value, When
+
+from carplot.models import EventData, GTS
+
+QUERY_CHUNK_SIZE = getattr(settings, 'CARPLOT_QUERY_CHUNK_SIZE', 2000)
+# Bound of the parameters of a statement, SQLite refusing more than 999 before 3.32
+MAX_QUERY_PARAMS = getattr(settings, 'CARPLOT_MAX_QUERY_PARAMS', 900)
+EVENT_FIELDS = ('deviceID', 'creationTime', 'timestamp', 'latitude', 'longitude', 'speedKPH', 'heading',
+                'altitude', 'odometerKM', 'address')
+# Whether the database filters positions that did not move with the LAG window function.
+# Detected from the backend when None; set it to False for servers older than MySQL 8.0.2 or MariaDB 10.2.
+SQL_WINDOW_FUNCTIONS = getattr(settings, 'CARPLOT_SQL_WINDOW_FUNCTIONS', None)
+
+# Columns of EventData read to draw tracks and follow devices live; the same as the archived events
+# Order in which the events of a device are read; EventData is unique on (deviceID, timestamp, statusCode)
+CURSOR_FIELDS = ('creationTime', 'timestamp', 'statusCode')
+
+POSITION_FIELDS = ('deviceID', 'creationTime', 'timestamp', 'statusCode', 'latitude', 'longitude', 'speedKPH',
+                   'heading', 'address')
+Position = namedtuple('Position', POSITION_FIELDS)
+
+
+def get_row_cursor(row):
+    return tuple(row[field] for field in CURSOR_FIELDS)
+
+
+def get_after_cursor_q(cursor):
+    creation_time, timestamp, status_code = cursor
+    return Q(creationTime__gt=creation_time) | Q(creationTime=creation_time, timestamp__gt=timestamp) | \
+        Q(creationTime=creation_time, timestamp=timestamp, statusCode__gt=status_code)
+
+
+def after_cursor(positions, cursor):
+    """
+    Keeps the events that come after cursor in (creationTime, timestamp, statusCode) order
+    """
+    return positions.filter(get_after_cursor_q(cursor))
+
+
+def _with_cursor_fields(fields, cursor_fields=CURSOR_FIELDS):
+    """
+    Columns to read for fields, followed by the columns of the keyset that fields miss
+    """
+    return tuple(fields) + tuple(field for field in cursor_fields if field not in fields)
+
+
+def iter_event_data(device_ids, start_date=None, end_date=None, chunk_size=QUERY_CHUNK_SIZE, using=GTS,
+                    fields=EVENT_FIELDS, cursor=None):
+    """
+    Yields as dicts the EventData of each device in chronological order.
+    Rows are read chunk by chunk with a (creationTime, timestamp, statusCode) keyset so that
+    memory use does not depend on the number of rows read. statusCode is part of it since
+    EventData is unique on it: a device can send several events at the same second.
+
+    @param fields: EventData fields to read
+    @param cursor: (creationTime, timestamp, statusCode) after which the events are read
+    """
+    columns = _with_cursor_fields(fields)
+    for device_id in device_ids:
+        positions = EventData.objects.using(using).filter(deviceID=device_id)
+        if start_date is not None:
+            positions = positions.filter(creationTime__gte=start_date)
+        if end_date is not None:
+            positions = positions.filter(creationTime__lt=end_date)
+        positions = positions.order_by(*CURSOR_FIELDS).values_list(*columns)
+        chunk = after_cursor(positions, cursor) if cursor else positions
+        while True:
+            rows = list(chunk[:chunk_size])
+            for row in rows:
+                yield dict(zip(fields, row))
+            if len(rows) < chunk_size:
+                break
+            chunk = after_cursor(positions, get_row_cursor(dict(zip(columns, rows[-1]))))
+
+
+def iter_fleet_event_data(device_ids, start_date, end_date, chunk_size=QUERY_CHUNK_SIZE, using=GTS,
+                          fields=EVENT_FIELDS):
+    """
+    Yields as dicts the EventData of many devices interleaved in chronological order, read with
+    a single deviceID__in query per chunk. The keyset also holds the deviceID since several
+    devices can send events at the same second.
+
+    @param fields: EventData fields to read
+    """
+    keyset = ('creationTime', 'timestamp', 'deviceID', 'statusCode')
+    columns = _with_cursor_fields(fields, keyset)
+    positions = EventData.objects.using(using).filter(deviceID__in=device_ids, creationTime__gte=start_date,
+                                                      creationTime__lt=end_date)
+    positions = positions.order_by(*keyset).values_list(*columns)
+    chunk = positions
+    while True:
+        rows = list(chunk[:chunk_size])
+        for row in rows:
+            yield dict(zip(fields, row))
+        if len(rows) < chunk_size:
+            break
+        last = dict(zip(columns, rows[-1]))
+        creation_time, timestamp, device_id = last['creationTime'], last['timestamp'], last['deviceID']
+        chunk = positions.filter(Q(creationTime__gt=creation_time) |
+                                 Q(creationTime=creation_time, timestamp__gt=timestamp) |
+                                 Q(creationTime=creation_time, timestamp=timestamp, deviceID__gt=device_id) |
+                                 Q(creationTime=creation_time, timestamp=timestamp, deviceID=device_id,
+                                   statusCode__gt=last['statusCode']))
+
+
+def iter_positions(positions, chunk_size=QUERY_CHUNK_SIZE):
+    """
+    Reads an EventData queryset as Position tuples: only POSITION_FIELDS are fetched,
+    without building model instances nor caching the results in the queryset.
+    """
+    for row in positions.values_list(*POSITION_FIELDS).iterator():
+        yield Position._make(row)
+
+
+def update_rows(queryset, key_field, values, fields):
+    """
+    Writes different values in many rows with a CASE per field, in as few UPDATE as the
+    parameters allow instead of one per row. Returns the number of rows updated.
+
+    @param key_field: field the rows are matched on
+    @param values: dict of key -> dict of field -> value
+    """
+    keys = list(values.keys())
+    chunk_size = max(1, MAX_QUERY_PARAMS // (2 * len(fields) + 1))
+    count = 0
+    for i in range(0, len(keys), chunk_size):
+        chunk = keys[i:i + chunk_size]
+        updates = {}
+        for field in fields:
+            whens = [When(**{key_field: key, 'then': Value(values[key][field])}) for key in chunk]
+            updates[field] = Case(*whens, default=F(field), output_field=queryset.model._meta.get_field(field))
+        count += queryset.filter(**{'%s__in' % key_field: chunk}).update(**updates)
+    return count
+
+
+class MoveFilter(object):
+    """
+    Skips null coordinates and positions that did not move since the previous one, which is
+    any position sharing its latitude or its longitude with the previous position read.
+    last keeps the last position read, kept or not, so that filtering can go on from another source.
+    """
+    def __init__(self, last=None):
+        self.last = last
+
+    def filter(self, positions):
+        for position in positions:
+            last = self.last
+            self.last = position
+            if position.latitude == 0.0 or position.longitude == 0.0:
+                continue
+            if last is not None and (position.latitude == last.latitude or position.longitude == last.longitude):
+                continue
+            yield position
+
+
+_window_support = {}
+
+
+def _mysql_supports_window_functions(server_info):
+    """
+    MySQL has window functions from 8.0.2, MariaDB from 10.2. MariaDB may report itself
+    as "5.5.5-10.1.48-MariaDB" to old clients, so its version is the one before "-MariaDB".
+    """
+    if 'mariadb' in server_info.lower():
+        match = re.search(r'(\d+)\.(\d+)\.\d+-mariadb', server_info, re.IGNORECASE)
+        return match is not None and (int(match.group(1)), int(match.group(2))) >= (10, 2)
+    match = re.search(r'(\d+)\.(\d+)\.(\d+)', server_info)
+    return match is not None and tuple(int(part) for part in match.groups()) >= (8, 0, 2)
+
+
+def supports_window_functions(using=GTS):
+    if SQL_WINDOW_FUNCTIONS is not None:
+        return SQL_WINDOW_FUNCTIONS
+    if using not in _window_support:
+        connection = connections[using]
+        if connection.vendor == 'postgresql':
+            supported = True
+        elif connection.vendor == 'sqlite':
+            supported = sqlite3.sqlite_version_info >= (3, 25, 0)
+        elif connection.vendor == 'mysql':
+            connection.ensure_connection()
+            supported = _mysql_supports_window_functions(connection.connection.get_server_info())
+        else:
+            supported = False
+        _window_support[using] = supported
+    return _window_support[using]
+
+
+def _get_moved_positions_sql(connection, device_id, start_date, end_date, cursor, last):
+    """
+    The previous coordinates of every row are read with LAG over the whole period before the
+    outer query filters, so that a position is compared with the previous one read, kept or not.
+    """
+    qn = connection.ops.quote_name
+    columns = ', '.join(qn(field) for field in POSITION_FIELDS)
+    order = ', '.join(qn(field) for field in CURSOR_FIELDS)
+    conditions, params = ['%s = %%s' % qn('deviceID')], [device_id]
+    if start_date is not None:
+        conditions.append('%s >= %%s' % qn('creationTime'))
+        params.append(start_date)
+    if end_date is not None:
+        conditions.append('%s < %%s' % qn('creationTime'))
+        params.append(end_date)
+    if cursor is not None:
+        conditions.append('(%(time)s > %%s OR (%(time)s = %%s AND %(timestamp)s > %%s) OR '
+                          '(%(time)s = %%s AND %(timestamp)s = %%s AND %(status)s > %%s))' %
+                          {'time': qn('creationTime'), 'timestamp': qn('timestamp'), 'status': qn('statusCode')})
+        params.extend([cursor[0], cursor[0], cursor[1], cursor[0], cursor[1], cursor[2]])
+    if last is None:
+        moved = '(prev_lat IS NULL OR (%(lat)s <> prev_lat AND %(lng)s <> prev_lng))'
+    else:
+        # The first row is compared with the position read before the query
+        moved = '%(lat)s <> COALESCE(prev_lat, %%s) AND %(lng)s <> COALESCE(prev_lng, %%s)'
+        params.extend([last.latitude, last.longitude])
+    sql = ('SELECT %(columns)s FROM ('
+           'SELECT %(columns)s, LAG(%(lat)s) OVER (ORDER BY %(order)s) AS prev_lat, '
+           'LAG(%(lng)s) OVER (ORDER BY %(order)s) AS prev_lng FROM %(table)s WHERE %(conditions)s'
+           ') moves WHERE %(lat)s <> 0 AND %(lng)s <> 0 AND ' + moved + ' ORDER BY %(order)s') % {
+        'columns': columns, 'order': order, 'lat': qn('latitude'), 'lng': qn('longitude'),
+        'table': qn(EventData._meta.db_table), 'conditions': ' AND '.join(conditions)
+    }
+    return sql, params
+
+
+def iter_moved_positions(device_id, start_date=None, end_date=None, using=GTS, cursor=None, last=None,
+                         chunk_size=QUERY_CHUNK_SIZE):
+    """
+    Yields as Position the events of a device in chronological order, skipping null coordinates
+    and positions that did not move, like MoveFilter. The filtering is done by the database
+    when it supports window functions, saving the transfer and the decoding of the rows dropped.
+
+    @param cursor: (creationTime, timestamp, statusCode) after which the events are read
+    @param last: position read just before the cursor, that the first event is compared with
+    """
+    if not supports_window_functions(using):
+        positions = EventData.objects.using(using).filter(deviceID=device_id)
+        if start_date is not None:
+            positions = positions.filter(creationTime__gte=start_date)
+        if end_date is not None:
+            positions = positions.filter(creationTime__lt=end_date)
+        if cursor is not None:
+            positions = after_cursor(positions, cursor)
+        positions = positions.order_by(*CURSOR_FIELDS)
+        for position in MoveFilter(last).filter(iter_positions(positions, chunk_size)):
+            yield position
+        return
+    connection = connections[using]
+    sql, params = _get_moved_positions_sql(connection, device_id, start_date, end_date, cursor, last)
+    with connection.cursor() as db_cursor:
+        db_cursor.execute(sql, params)
+        while True:
+            rows = db_cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield Position._make(row)
+
+
+def iter_sampled_positions(device_id, start_date, end_date, bucket, using=GTS):
+    """
+    Yields as Position the first event with coordinates of each time bucket of bucket seconds, in
+    chronological order, so that a long period is read with a bounded number of rows spread over
+    all of it. The buckets are made by the database, which only returns the rows kept.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    table = qn(EventData._meta.db_table)
+    creation_time, lat, lng, device = qn('creationTime'), qn('latitude'), qn('longitude'), qn('deviceID')
+    sql = ('SELECT %(columns)s FROM %(table)s e JOIN ('
+           'SELECT MIN(%(time)s) AS first_time FROM %(table)s WHERE %(device)s = %%s AND %(time)s >= %%s '
+           'AND %(time)s < %%s AND %(lat)s <> 0 AND %(lng)s <> 0 GROUP BY %(time)s - %(time)s %%%% %%s'
+           ') buckets ON e.%(time)s = buckets.first_time '
+           'WHERE e.%(device)s = %%s AND e.%(lat)s <> 0 AND e.%(lng)s <> 0 ORDER BY %(order)s') % {
+        'columns': ', '.join('e.%s' % qn(field) for field in POSITION_FIELDS),
+        'order': ', '.join('e.%s' % qn(field) for field in CURSOR_FIELDS),
+        'table': table, 'time': creation_time, 'device': device, 'lat': lat, 'lng': lng
+    }
+    last_time = None
+    with connection.cursor() as db_cursor:
+        db_cursor.execute(sql, [device_id, start_date, end_date, bucket, device_id])
+        while True:
+            rows = db_cursor.fetchmany(QUERY_CHUNK_SIZE)
+            if not rows:
+                break
+            for row in rows:
+                position = Position._make(row)
+                # Events of the same second as the first one of the bucket
+                if position.creationTime != last_time:
+                    last_time = position.creationTime
+                    yield position
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import json
+import time
+from collections import namedtuple
+
+from django.conf import settings
+
+from carplot.models import Device, Watermark, GTS
+from carplot.provisioning import GTS_UPDATED_FIELDS, upsert_gts_devices
+
+RECONCILE_CHUNK_SIZE = getattr(settings, 'CARPLOT_RECONCILE_CHUNK_SIZE', 500)
+WATERMARK_JOB = 'reconcile'
+
+# Kinds of divergence
+MISSING_IN_GTS = 'missing_in_gts'
+FIELD_MISMATCH = 'field_mismatch'
+MISSING_IDS = 'missing_ids'
+ORPHAN_IN_GTS = 'orphan_in_gts'
+
+Divergence = namedtuple('Divergence', 'kind device_id imei fields')
+
+
+class ReconcileReport(object):
+    def __init__(self):
+        self.scanned = 0
+        self.divergences = []
+        self.fixed = 0
+        self.chunks = 0
+        self.completed = False
+        self.incremental = False
+        self.duration = 0
+
+
+def _diff_chunk(devices):
+    """
+    Compares a chunk of app devices with their opengts copy.
+    Returns the divergences found and the devices to upsert in opengts.
+    """
+    divergences = []
+    to_upsert = []
+    device_ids = [str(device.id) for device in devices]
+    gts_devices = dict((values[0], values[1:]) for values in
+                       Device.objects.using(GTS).filter(deviceID__in=device_ids)
+                       .values_list('deviceID', *GTS_UPDATED_FIELDS))
+    for device in devices:
+        device_id = str(device.id)
+        if device.deviceID != device_id or device.vehicleID != 'tk_%s' % device.imeiNumber:
+            divergences.append(Divergence(MISSING_IDS, device_id, device.imeiNumber, ('deviceID', 'vehicleID')))
+            device.deviceID = device_id
+            device.uniqueID = device.vehicleID = 'tk_%s' % device.imeiNumber
+        gts_values = gts_devices.get(device_id)
+        if gts_values is None:
+            divergences.append(Divergence(MISSING_IN_GTS, device_id, device.imeiNumber, ()))
+            to_upsert.append(device)
+            continue
+        fields = tuple(field for field, gts_value in zip(GTS_UPDATED_FIELDS, gts_values)
+                       if getattr(device, field) != gts_value)
+        if fields:
+            divergences.append(Divergence(FIELD_MISMATCH, device_id, device.imeiNumber, fields))
+            to_upsert.append(device)
+    return divergences, to_upsert
+
+
+def _find_orphans(account_id, chunk_size):
+    """
+    Keyset scan of the opengts devices of the account that have no app counterpart
+    """
+    orphans = []
+    gts_devices = Device.objects.using(GTS).filter(accountID=account_id).order_by('deviceID')\
+        .values_list('deviceID', 'imeiNumber')
+    last_id = None
+    while True:
+        chunk = gts_devices.filter(deviceID__gt=last_id) if last_id is not None else gts_devices
+        rows = list(chunk[:chunk_size])
+        if not rows:
+            break
+        known = set(str(pk) for pk in Device.objects.filter(pk__in=[row[0] for row in rows])
+                    .values_list('pk', flat=True))
+        orphans.extend(Divergence(ORPHAN_IN_GTS, device_id, imei, ())
+                       for device_id, imei in rows if device_id not in known)
+        last_id = rows[-1][0]
+    return orphans
+
+
+def _reconcile_chunk(report, chunk, account_id, dry_run):
+    divergences, to_upsert = _diff_chunk(chunk)
+    report.divergences.extend(divergences)
+    if not dry_run:
+        for divergence in divergences:
+            if divergence.kind == MISSING_IDS:
+                Device.objects.filter(pk=divergence.device_id)\
+                    .update(deviceID=divergence.device_id, uniqueID='tk_%s' % divergence.imei,
+                            vehicleID='tk_%s' % divergence.imei)
+        if to_upsert:
+            upsert_gts_devices(to_upsert, account_id)
+        report.fixed += len(set(divergence.device_id for divergence in divergences))
+    report.scanned += len(chunk)
+    report.chunks += 1
+
+
+def _get_watermark():
+    """
+    Fleet wide Watermark of the reconciliation. Its state holds the primary key where an unfinished walk
+    stopped with the time the walk started, and the start time of the last complete walk; the next runs
+    only diff the devices changed since.
+    """
+    watermark = Watermark.objects.filter(job=WATERMARK_JOB, device=None).first()
+    if watermark is None:
+        watermark = Watermark(job=WATERMARK_JOB)
+    state = json.loads(watermark.state) if watermark.state else {}
+    return watermark, state
+
+
+def _save_watermark(watermark, state):
+    watermark.state = json.dumps(state)
+    watermark.save()
+
+
+def reconcile_devices(account_id, dry_run=False, chunk_size=RECONCILE_CHUNK_SIZE, max_chunks=None, full=False):
+    """
+    Brings the opengts copy of the app devices in line, chunk by chunk. The app database is the reference;
+    opengts devices without app counterpart are only reported.
+
+    The first run walks the whole table in primary key order. The primary key of the last chunk processed
+    is kept as a watermark so that a walk stopped by max_chunks resumes where it stopped. Once a walk
+    completes, the time it started is kept, and the next runs only diff the app devices whose
+    lastUpdateTime is newer. Changes made directly in opengts and orphans are only found by full walks.
+
+    @param account_id: opengts accountID used for the devices missing in opengts and the orphan scan
+    @param dry_run: only report the divergences, without fixing anything
+    @param full: walk the whole table even if a previous walk completed
+    this function returns a ReconcileReport
+    """
+    start = time.time()
+    report = ReconcileReport()
+    watermark, state = _get_watermark()
+    since = None if full else state.get('reconciled_on')
+    if since is not None:
+        report.incremental = True
+        changed = list(Device.objects.filter(lastUpdateTime__gte=since).order_by('pk').values_list('pk', flat=True))
+        for i in range(0, len(changed), chunk_size):
+            if max_chunks is not None and report.chunks >= max_chunks:
+                break
+            chunk = list(Device.objects.filter(pk__in=changed[i:i + chunk_size]).order_by('pk'))
+            _reconcile_chunk(report, chunk, account_id, dry_run)
+        else:
+            report.completed = True
+        if report.completed and not dry_run:
+            state['reconciled_on'] = int(start)
+            _save_watermark(watermark, state)
+        report.duration = time.time() - start
+        return report
+
+    last_pk, walk_start = None, int(start)
+    if not dry_run and state.get('walk'):
+        last_pk, walk_start = state['walk']
+    devices = Device.objects.order_by('pk')
+    while max_chunks is None or report.chunks < max_chunks:
+        chunk = devices.filter(pk__gt=last_pk) if last_pk is not None else devices
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            report.completed = True
+            break
+        _reconcile_chunk(report, chunk, account_id, dry_run)
+        last_pk = chunk[-1].pk
+        if not dry_run:
+            state['walk'] = last_pk, walk_start
+            _save_watermark(watermark, state)
+    if report.completed:
+        if not dry_run:
+            state.pop('walk', None)
+            # Devices changed while the walk ran are picked up by the next run
+            state['reconciled_on'] = walk_start
+            _save_watermark(watermark, state)
+        report.divergences.extend(_find_orphans(account_id, chunk_size))
+    report.duration = time.time() - start
+    return report
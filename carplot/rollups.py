@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import json
+import time
+from datetime import datetime, timedelta
+
+from carplot.archive import get_archived_until, iter_archived_events
+from carplot.queries import iter_event_data, get_row_cursor, CURSOR_FIELDS
+from carplot.geofence import distance_between
+from carplot.models import DailyRollup, Device, EventData, Watermark, GTS
+from carplot.trips import STOP_SPEED, MAX_EVENT_GAP
+
+ROLLUP_FIELDS = ('creationTime', 'timestamp', 'statusCode', 'latitude', 'longitude', 'speedKPH',
+                 'odometerKM')
+ROLLUP_COUNTERS = ('event_count', 'distance', 'speed_sum', 'moving_count', 'moving_duration')
+WATERMARK_JOB = 'rollups'
+
+
+class RollupAccumulator(object):
+    """
+    Accumulates the chronological events of a device into per day aggregates.
+    last holds the previous event so that distance and moving time carry across runs.
+    """
+    def __init__(self, last=None):
+        self.last = last
+        self.days = {}
+
+    def feed(self, creation_time, lat, lng, speed, odometer):
+        day = datetime.fromtimestamp(creation_time).date()
+        rollup = self.days.get(day)
+        if rollup is None:
+            rollup = dict((counter, 0) for counter in ROLLUP_COUNTERS)
+            rollup.update({'max_speed': 0, 'max_odometer': 0})
+            self.days[day] = rollup
+        rollup['event_count'] += 1
+        rollup['max_odometer'] = max(rollup['max_odometer'], odometer or 0)
+        if speed > STOP_SPEED:
+            rollup['max_speed'] = max(rollup['max_speed'], speed)
+            rollup['speed_sum'] += speed
+            rollup['moving_count'] += 1
+        last = self.last
+        if last and 0 < creation_time - last[0] <= MAX_EVENT_GAP:
+            last_time, last_lat, last_lng, last_speed, last_odometer = last
+            if odometer and last_odometer and odometer >= last_odometer:
+                rollup['distance'] += odometer - last_odometer
+            elif lat and lng and last_lat and last_lng:
+                rollup['distance'] += distance_between(last_lat, last_lng, lat, lng) / 1000
+            if speed > STOP_SPEED or last_speed > STOP_SPEED:
+                rollup['moving_duration'] += creation_time - last_time
+        self.last = [creation_time, lat, lng, speed, odometer]
+
+
+def _save(device, days, merge):
+    """
+    Writes the aggregates of the accumulator, adding them to the existing rows if merge is True.
+    """
+    if not days:
+        return
+    existing = dict((rollup.day, rollup) for rollup in
+                    DailyRollup.objects.filter(device=device, day__in=list(days.keys())))
+    created = []
+    for day, values in days.items():
+        rollup = existing.get(day)
+        if rollup is None:
+            created.append(DailyRollup(device=device, day=day, **values))
+            continue
+        for counter in ROLLUP_COUNTERS:
+            setattr(rollup, counter, (getattr(rollup, counter) if merge else 0) + values[counter])
+        for maximum in ('max_speed', 'max_odometer'):
+            setattr(rollup, maximum, max(getattr(rollup, maximum) if merge else 0, values[maximum]))
+        rollup.save()
+    DailyRollup.objects.bulk_create(created)
+
+
+def update_device_rollups(device):
+    """
+    Adds the events the device sent since the previous run to its daily rollups.
+    Returns the number of events processed.
+    """
+    watermark, created = Watermark.objects.get_or_create(job=WATERMARK_JOB, device=device)
+    accumulator = RollupAccumulator(json.loads(watermark.state) if watermark.state else None)
+    cursor = None if created else watermark.cursor
+    count = 0
+    for row in iter_event_data([str(device.id)], fields=ROLLUP_FIELDS, cursor=cursor):
+        accumulator.feed(row['creationTime'], row['latitude'], row['longitude'], row['speedKPH'], row['odometerKM'])
+        cursor = get_row_cursor(row)
+        count += 1
+    _save(device, accumulator.days, merge=True)
+    if cursor:
+        watermark.creationTime, watermark.timestamp, watermark.statusCode = cursor
+    watermark.state = json.dumps(accumulator.last)
+    watermark.save()
+    return count
+
+
+def update_all_rollups():
+    """
+    Runs update_device_rollups on every active device. Returns the number of events processed and the duration.
+    """
+    start = time.time()
+    count = 0
+    for device in Device.objects.filter(isActive=True):
+        count += update_device_rollups(device)
+    return count, time.time() - start
+
+
+def _get_previous_event(device_id, before, using=GTS):
+    """
+    Event of the device preceding before, as RollupAccumulator.last, from the archives if the database
+    no longer has it. Archived events do not hold the odometer, the distance is then measured.
+    """
+    rows = EventData.objects.using(using).filter(deviceID=device_id, creationTime__lt=before)\
+        .order_by(*['-%s' % field for field in CURSOR_FIELDS])\
+        .values_list('creationTime', 'latitude', 'longitude', 'speedKPH', 'odometerKM')[:1]
+    for row in rows:
+        return list(row)
+    last = None
+    for event in iter_archived_events(device_id, before - MAX_EVENT_GAP, before):
+        last = [event.creationTime, event.latitude, event.longitude, event.speedKPH, 0]
+    return last
+
+
+def rebuild_device_rollups(device, start_day, end_day):
+    """
+    Recomputes from the raw events the rollups of the device from start_day to end_day included.
+    Events the incremental update did not reach yet are left to it. If it never ran, it is started
+    after the last event rebuilt so that it does not add the rebuilt events a second time.
+    The days holding archived events are kept as they are: the archives do not hold the odometer,
+    and the database only part of the day.
+
+    this function returns the first day rebuilt, after end_day if every day of the range is archived
+    """
+    archived_until = get_archived_until(str(device.id))
+    if archived_until is not None:
+        start_day = max(start_day, datetime.fromtimestamp(archived_until).date() + timedelta(days=1))
+    if start_day > end_day:
+        return start_day
+    start_date = int(time.mktime(start_day.timetuple()))
+    end_date = int(time.mktime((end_day + timedelta(days=1)).timetuple()))
+    watermark = Watermark.objects.filter(job=WATERMARK_JOB, device=device).first()
+    cursor = None
+    if watermark is not None:
+        cursor = watermark.cursor
+        end_date = min(end_date, watermark.creationTime + 1)
+    # Seeded like the incremental update, so that the first interval of start_day counts the same
+    accumulator = RollupAccumulator(_get_previous_event(str(device.id), start_date))
+    last_cursor = None
+    for row in iter_event_data([str(device.id)], start_date, end_date, fields=ROLLUP_FIELDS):
+        if cursor is not None and get_row_cursor(row) > cursor:
+            # Events of the watermark second not reached yet are left to the incremental update
+            break
+        accumulator.feed(row['creationTime'], row['latitude'], row['longitude'], row['speedKPH'], row['odometerKM'])
+        last_cursor = get_row_cursor(row)
+    DailyRollup.objects.filter(device=device, day__gte=start_day, day__lte=end_day)\
+        .exclude(day__in=list(accumulator.days.keys())).delete()
+    _save(device, accumulator.days, merge=False)
+    if watermark is None and last_cursor is not None:
+        creation_time, timestamp, status_code = last_cursor
+        Watermark.objects.get_or_create(job=WATERMARK_JOB, device=device, defaults={
+            'creationTime': creation_time, 'timestamp': timestamp, 'statusCode': status_code,
+            'state': json.dumps(accumulator.last)})
+    return start_day
+
+
+def get_fleet_report(device_ids, start_day, end_day):
+    """
+    Builds a fleet report from the rollups of the devices between start_day and end_day included.
+
+    this function returns a dict of: totals per day, totals per device and totals of the period
+    """
+    rollups = DailyRollup.objects.filter(device__in=device_ids, day__gte=start_day, day__lte=end_day)\
+        .values_list('device', 'day', 'distance', 'max_speed', 'moving_duration', 'event_count')
+    empty = {'distance': 0, 'max_speed': 0, 'moving_duration': 0, 'event_count': 0}
+    days = {}
+    devices = {}
+    total = dict(empty)
+    for device_id, day, distance, max_speed, moving_duration, event_count in rollups:
+        for stats in (days.setdefault(day.isoformat(), dict(empty)),
+                      devices.setdefault(str(device_id), dict(empty)), total):
+            stats['distance'] += distance
+            stats['max_speed'] = max(stats['max_speed'], max_speed)
+            stats['moving_duration'] += moving_duration
+            stats['event_count'] += event_count
+    return {'days': days, 'devices': devices, 'total': total}
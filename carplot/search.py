@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import heapq
+import math
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models.signals import pre_save, post_save, post_delete
+
+from ikwen.foundation.core.utils import to_dict
+from carplot.models import Device, Vehicle
+from carplot.versions import get_version, bump_version
+
+SEARCH_LIMIT = getattr(settings, 'CARPLOT_SEARCH_LIMIT', 20)
+# Minimum share of the trigrams of the query a field must contain to be a fuzzy match
+TRIGRAM_THRESHOLD = getattr(settings, 'CARPLOT_SEARCH_TRIGRAM_THRESHOLD', 0.4)
+# Indexed fields with their weight; ties on the match quality are broken by the field weight
+VEHICLE_FIELDS = (('name', 1.0), ('description', 0.8))
+DEVICE_FIELDS = (('displayName', 0.9), ('imeiNumber', 0.7), ('simPhoneNumber', 0.7))
+# Number of owner indexes kept by a process, the least recently searched are dropped first
+SEARCH_MAX_INDEXES = getattr(settings, 'CARPLOT_SEARCH_MAX_INDEXES', 200)
+
+
+def normalize(text):
+    """
+    Lowercases text and drops accents and punctuation so that "Toyota-Hilux É" matches "toyota hilux e"
+    """
+    text = unicodedata.normalize('NFKD', u'%s' % (text or ''))
+    text = u''.join(c if c.isalnum() else u' ' for c in text if not unicodedata.combining(c))
+    return u' '.join(text.lower().split())
+
+
+def get_trigrams(text):
+    text = u'  %s ' % text
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+
+class OwnerIndex(object):
+    """
+    In memory index of the vehicles of an owner on their name, description and the
+    displayName, IMEI and SIM number of their device.
+
+    Every field is indexed with each of its word suffixes ("toyota hilux", "hilux") in a
+    sorted list, so that prefix lookups are a bisect and a scan. Fields are also split in
+    trigrams for fuzzy lookups when nothing starts with the query.
+    Changes and searches of a published index are made holding its lock.
+    """
+    def __init__(self, version):
+        self.version = version
+        self.entries = {}
+        self.phrases = []
+        self.trigrams = {}
+        self.lock = threading.Lock()
+
+    def _get_phrases(self, vehicle_id, fields):
+        for text, weight in fields:
+            words = text.split()
+            for i in range(len(words)):
+                # At the start of the field a match is worth more than further in it
+                yield u' '.join(words[i:]), vehicle_id, weight, i == 0
+
+    def add(self, vehicle, device, sort=True):
+        self.remove(vehicle.id)
+        fields = [(normalize(getattr(vehicle, name)), weight) for name, weight in VEHICLE_FIELDS]
+        fields += [(normalize(getattr(device, name)), weight) for name, weight in DEVICE_FIELDS]
+        fields = [(text, weight) for text, weight in fields if text]
+        self.entries[vehicle.id] = ([(text, get_trigrams(text), weight) for text, weight in fields],
+                                    to_dict(vehicle), vehicle.device_id)
+        for phrase in self._get_phrases(vehicle.id, fields):
+            if sort:
+                insort(self.phrases, phrase)
+            else:
+                self.phrases.append(phrase)
+        for text, weight in fields:
+            for trigram in get_trigrams(text):
+                self.trigrams.setdefault(trigram, set()).add(vehicle.id)
+
+    def remove(self, vehicle_id):
+        entry = self.entries.pop(vehicle_id, None)
+        if entry is None:
+            return
+        # Only the phrases of the vehicle are looked up, the others are left in place
+        for phrase in self._get_phrases(vehicle_id, [(text, weight) for text, trigrams, weight in entry[0]]):
+            i = bisect_left(self.phrases, phrase)
+            if i < len(self.phrases) and self.phrases[i] == phrase:
+                del self.phrases[i]
+        for text, trigrams, weight in entry[0]:
+            for trigram in trigrams:
+                self.trigrams.get(trigram, set()).discard(vehicle_id)
+
+    def _search_prefix(self, query):
+        scores = {}
+        i = bisect_left(self.phrases, (query,))
+        while i < len(self.phrases) and self.phrases[i][0].startswith(query):
+            phrase, vehicle_id, weight, is_start = self.phrases[i]
+            if is_start:
+                score = 1.0 if phrase == query else 0.9
+            else:
+                score = 0.8
+            score *= weight
+            if score > scores.get(vehicle_id, 0):
+                scores[vehicle_id] = score
+            i += 1
+        return scores
+
+    def _search_trigrams(self, query):
+        """
+        Fields sharing at least TRIGRAM_THRESHOLD of the trigrams of the query. Only the postings
+        of the rarest trigrams are read: a field sharing enough trigrams contains one of them.
+        """
+        query_trigrams = get_trigrams(query)
+        postings = sorted((self.trigrams.get(trigram, ()) for trigram in query_trigrams), key=len)
+        minimum = int(math.ceil(TRIGRAM_THRESHOLD * len(query_trigrams)))
+        candidates = set()
+        for posting in postings[:len(postings) - minimum + 1]:
+            candidates.update(posting)
+        scores = {}
+        for vehicle_id in candidates:
+            for text, trigrams, weight in self.entries[vehicle_id][0]:
+                shared = len(query_trigrams & trigrams)
+                if shared >= minimum:
+                    score = 0.6 * weight * shared / float(len(query_trigrams))
+                    if score > scores.get(vehicle_id, 0):
+                        scores[vehicle_id] = score
+        return scores
+
+    def search(self, keyword, limit=SEARCH_LIMIT):
+        """
+        this function returns a list of (score, vehicle dict, device id) ranked by decreasing score
+        """
+        query = normalize(keyword)
+        if not query:
+            return []
+        with self.lock:
+            scores = self._search_prefix(query) or self._search_trigrams(query)
+            best = heapq.nsmallest(limit, scores.items(),
+                                   key=lambda item: (-item[1], self.entries[item[0]][1].get('name')))
+            return [(score, self.entries[vehicle_id][1], self.entries[vehicle_id][2]) for vehicle_id, score in best]
+
+
+def _get_version_key(owner_id):
+    return 'carplot:search_version:%s' % owner_id
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def build_index(owner_id, version):
+    index = OwnerIndex(version)
+    vehicles = list(Vehicle.objects.filter(owner=owner_id))
+    devices = Device.objects.in_bulk([vehicle.device_id for vehicle in vehicles])
+    for vehicle in vehicles:
+        device = devices.get(vehicle.device_id)
+        if device:
+            index.add(vehicle, device, sort=False)
+    index.phrases.sort()
+    return index
+
+
+def get_index(owner_id):
+    """
+    Index of the vehicles of an owner, built once per process. Its version is shared
+    through the cache so that the processes rebuild the indexes changed by another one.
+    """
+    version = get_version(_get_version_key(owner_id))
+    with _indexes_lock:
+        index = _indexes.pop(owner_id, None)
+        if index is not None:
+            _indexes[owner_id] = index
+    if index is None or index.version != version:
+        index = build_index(owner_id, version)
+        with _indexes_lock:
+            _indexes.pop(owner_id, None)
+            _indexes[owner_id] = index
+            while len(_indexes) > SEARCH_MAX_INDEXES:
+                _indexes.popitem(last=False)
+    return index
+
+
+def search_vehicles(owner_id, keyword, limit=SEARCH_LIMIT):
+    """
+    Ranked vehicles of an owner matching keyword, serialized like Vehicle.to_dict.
+    Devices of the hits are fetched in a single query so that their position is up to date.
+    """
+    hits = get_index(owner_id).search(keyword, limit)
+    devices = Device.objects.in_bulk([device_id for score, vehicle_dict, device_id in hits])
+    response = []
+    for score, vehicle_dict, device_id in hits:
+        device = devices.get(device_id)
+        if device:
+            vehicle_dict = dict(vehicle_dict, device=device.to_dict())
+            response.append(vehicle_dict)
+    return response
+
+
+def _update_index(owner_id, change):
+    """
+    Tells the other processes that the index of the owner changed. The change is applied
+    to the local index if it had not missed any previous change, else the index is dropped
+    to be rebuilt on the next search.
+
+    @param change: function applying the change to an OwnerIndex
+    """
+    version = bump_version(_get_version_key(owner_id))
+    with _indexes_lock:
+        index = _indexes.get(owner_id)
+    if index is not None:
+        with index.lock:
+            if index.version == version - 1:
+                change(index)
+                index.version = version
+                return
+            if index.version >= version:
+                # Built after the change
+                return
+    with _indexes_lock:
+        if _indexes.get(owner_id) is index:
+            # Stale, the next search rebuilds it
+            _indexes.pop(owner_id, None)
+
+
+def invalidate_index(owner_id):
+    """
+    Has every process rebuild the index of the owner, for changes saved without the model signals.
+    """
+    bump_version(_get_version_key(owner_id))
+
+
+def update_vehicle(vehicle, device=None):
+    device = device or Device.objects.get(pk=vehicle.device_id)
+    _update_index(vehicle.owner_id, lambda index: index.add(vehicle, device))
+
+
+def remove_vehicle(vehicle, owner_id=None):
+    _update_index(owner_id or vehicle.owner_id, lambda index: index.remove(vehicle.id))
+
+
+def _on_vehicle_saving(sender, instance, **kwargs):
+    if instance.pk is None:
+        instance._search_owner_id = None
+        return
+    owner_ids = list(Vehicle.objects.filter(pk=instance.pk).values_list('owner', flat=True))
+    instance._search_owner_id = owner_ids[0] if owner_ids else None
+
+
+def _on_vehicle_saved(sender, instance, **kwargs):
+    previous_owner_id = getattr(instance, '_search_owner_id', None)
+    if previous_owner_id is not None and previous_owner_id != instance.owner_id:
+        remove_vehicle(instance, previous_owner_id)
+    update_vehicle(instance)
+
+
+def _on_vehicle_deleted(sender, instance, **kwargs):
+    remove_vehicle(instance)
+
+
+def _on_device_saved(sender, instance, using, **kwargs):
+    if using != 'default':
+        return
+    for vehicle in Vehicle.objects.filter(device=instance.pk):
+        update_vehicle(vehicle, instance)
+
+
+pre_save.connect(_on_vehicle_saving, sender=Vehicle)
+post_save.connect(_on_vehicle_saved, sender=Vehicle)
+post_delete.connect(_on_vehicle_deleted, sender=Vehicle)
+post_save.connect(_on_device_saved, sender=Device)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import atexit
+import logging
+import threading
+import time
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+import requests
+from django.conf import settings
+from django.db.models import F
+from django.utils.http import urlquote_plus
+
+from carplot.models import OperatorProfile
+
+logger = logging.getLogger(__name__)
+
+SMS_WORKERS = getattr(settings, 'CARPLOT_SMS_WORKERS', 4)
+SMS_RETRIES = getattr(settings, 'CARPLOT_SMS_RETRIES', 3)
+SMS_RETRY_DELAY = getattr(settings, 'CARPLOT_SMS_RETRY_DELAY', 2)
+SMS_TIMEOUT = getattr(settings, 'CARPLOT_SMS_TIMEOUT', 10)
+# Maximum number of requests per second sent to the SMS gateway
+SMS_RATE_LIMIT = getattr(settings, 'CARPLOT_SMS_RATE_LIMIT', 5)
+# Seconds the process waits at exit for the SMS being sent
+SMS_SHUTDOWN_TIMEOUT = getattr(settings, 'CARPLOT_SMS_SHUTDOWN_TIMEOUT', SMS_TIMEOUT)
+
+
+def build_sms_url(config, recipient, text):
+    """
+    Fills the placeholders of the gateway URL of the operator, each value being URL encoded
+    so that spaces, "&" or accents in a command or a password do not break the query.
+    """
+    url = config.sms_api_script_url
+    url = url.replace('$username', urlquote_plus(config.sms_api_username))
+    url = url.replace('$password', urlquote_plus(config.sms_api_password))
+    url = url.replace('$sender', urlquote_plus(config.company_name))
+    url = url.replace('$recipient', urlquote_plus(recipient))
+    url = url.replace('$text', urlquote_plus(text))
+    return url
+
+
+def reserve_sms_quota(config, count=1):
+    """
+    Atomically takes count SMS from the remaining sms_limit of the operator.
+    Returns False without taking anything if not enough SMS remain.
+    """
+    return OperatorProfile.objects.filter(pk=config.pk, sms_limit__gte=count)\
+        .update(sms_limit=F('sms_limit') - count) > 0
+
+
+def release_sms_quota(config, count=1):
+    OperatorProfile.objects.filter(pk=config.pk).update(sms_limit=F('sms_limit') + count)
+
+
+class RateLimiter(object):
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_slot = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class SMSDispatcher(object):
+    """
+    Sends SMS through the gateway from a pool of worker threads sharing a pooled HTTP session,
+    so that views only enqueue and return. The quota of an SMS that could not be sent after
+    all retries is given back to the operator, as is the quota of the SMS still queued when
+    the process exits.
+    """
+    def __init__(self, workers=SMS_WORKERS, retries=SMS_RETRIES, rate_limit=SMS_RATE_LIMIT):
+        self.retries = retries
+        self.queue = Queue()
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.sent = 0
+        self.failed = 0
+        self.counters_lock = threading.Lock()
+        self.stopping = False
+        for i in range(workers):
+            worker = threading.Thread(target=self._work, name='carplot-sms-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+    def _work(self):
+        while True:
+            config, url = self.queue.get()
+            try:
+                if self._send(url):
+                    with self.counters_lock:
+                        self.sent += 1
+                else:
+                    with self.counters_lock:
+                        self.failed += 1
+                    release_sms_quota(config)
+            except Exception:
+                logger.exception("SMS dispatch failed")
+            finally:
+                self.queue.task_done()
+
+    def _send(self, url):
+        for attempt in range(self.retries):
+            if attempt > 0:
+                time.sleep(SMS_RETRY_DELAY * attempt)
+            if self.stopping:
+                break
+            self.rate_limiter.wait()
+            try:
+                response = self.session.get(url, timeout=SMS_TIMEOUT)
+                if response.status_code < 500:
+                    return response.ok
+            except requests.RequestException:
+                logger.warning("SMS gateway unreachable, attempt %d/%d", attempt + 1, self.retries)
+        return False
+
+    def send(self, config, sms_command, devices):
+        """
+        Reserves the quota then queues sms_command for every device having a SIM phone number.
+        Returns the number of SMS queued, 0 if the quota is not enough for all of them.
+        """
+        phones = [device.simPhoneNumber for device in devices if device.simPhoneNumber]
+        if not phones or not reserve_sms_quota(config, len(phones)):
+            return 0
+        for phone in phones:
+            self.queue.put((config, build_sms_url(config, phone, sms_command.sms_content)))
+        return len(phones)
+
+    def join(self):
+        self.queue.join()
+
+    def shutdown(self, timeout=SMS_SHUTDOWN_TIMEOUT):
+        """
+        Gives back the quota of the SMS still queued, then waits up to timeout seconds
+        for the ones being sent. Their retries are abandoned and their quota given back.
+        Worker threads are daemons, so nothing queued survives the process.
+
+        this function returns the number of SMS whose quota was given back
+        """
+        self.stopping = True
+        released = 0
+        while True:
+            try:
+                config, url = self.queue.get_nowait()
+            except Empty:
+                break
+            try:
+                release_sms_quota(config)
+                released += 1
+            except Exception:
+                logger.exception("SMS quota could not be given back")
+            finally:
+                self.queue.task_done()
+        deadline = time.time() + timeout
+        while self.queue.unfinished_tasks and time.time() < deadline:
+            time.sleep(0.1)
+        if released:
+            logger.warning("%d queued SMS dropped at exit, their quota was given back", released)
+        return released
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = SMSDispatcher()
+            atexit.register(_dispatcher.shutdown)
+        return _dispatcher
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import time
+from collections import namedtuple
+
+from django.conf import settings
+
+from carplot.markers import refresh_marker_positions
+from carplot.models import Device, GTS
+
+SYNC_BATCH_SIZE = getattr(settings, 'CARPLOT_SYNC_BATCH_SIZE', 500)
+
+SyncReport = namedtuple('SyncReport', 'scanned changed duration')
+
+
+def _chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def sync_last_positions(devices=None, batch_size=SYNC_BATCH_SIZE):
+    """
+    Mirrors lastValidLatitude/lastValidLongitude of opengts devices into the app Device table.
+
+    Positions are pulled from opengts with one deviceID__in query per batch and only
+    the devices whose position actually changed are written back.
+
+    @param devices: queryset or list of app Device to synchronize. All active devices if None
+    @param batch_size: number of deviceID sent in a single opengts query
+    this function returns a SyncReport of: scanned devices, changed devices and duration in seconds
+    """
+    start = time.time()
+    if devices is None:
+        devices = Device.objects.filter(isActive=True)
+    if hasattr(devices, 'values_list'):
+        rows = devices.values_list('id', 'lastValidLatitude', 'lastValidLongitude')
+    else:
+        rows = [(device.id, device.lastValidLatitude, device.lastValidLongitude) for device in devices]
+    local_positions = dict((str(pk), (lat, lng)) for pk, lat, lng in rows)
+    moved = {}
+    for device_ids in _chunks(list(local_positions.keys()), batch_size):
+        gts_positions = Device.objects.using(GTS).filter(deviceID__in=device_ids)\
+            .values_list('deviceID', 'lastValidLatitude', 'lastValidLongitude')
+        for device_id, lat, lng in gts_positions:
+            if local_positions.get(device_id) == (lat, lng):
+                continue
+            Device.objects.filter(pk=device_id).update(lastValidLatitude=lat, lastValidLongitude=lng)
+            local_positions[device_id] = (lat, lng)
+            moved[device_id] = (lat, lng)
+    if moved:
+        refresh_marker_positions(moved)
+    return SyncReport(len(local_positions), len(moved), time.time() - start)
@@ -0,0 +1,1140 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import json
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+from datetime import date, timedelta
+
+from django.contrib.auth.models import Permission
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.db import models
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+from ikwen.accesscontrol.models import Member
+from carplot import archive, geocoding, icons, live, markers, playback, queries, search, sms, views
+from carplot.archive import archive_device, get_sampled_history, iter_archived_events, get_archive_path, get_month, \
+    HEADER, ARCHIVE_MAGIC, LEGACY_COLUMNS
+from carplot.catalogue import get_catalogue, invalidate_catalogue, _get_version_key
+from carplot.health import check_device_health, get_non_functional_devices
+from carplot.geocoding import fill_addresses, get_account_id
+from carplot.geofence import Zone, ZoneIndex, load_zone_index, sweep_device, meters_to_degrees, POINT_RADIUS, \
+    POLYGON, BOUNDED_RECT, ENTER, EXIT
+from carplot.live import EventPoller, get_cursor
+from carplot.markers import get_markers, get_marker_index, invalidate_marker_index, refresh_marker_positions
+from carplot.models import DailyRollup, Device, DeviceHealth, DeviceType, EventData, Geozone, OperatorProfile, SMSCommand, Trip, \
+    Vehicle, VehicleType, Watermark, GTS
+from carplot.propagation import propagate, propagate_catalogue
+from carplot.provisioning import provision_device, provision_devices, read_batch
+from carplot.sms import SMSDispatcher
+from carplot.search import get_index, search_vehicles
+from carplot.reconcile import reconcile_devices, MISSING_IN_GTS, FIELD_MISMATCH, MISSING_IDS, ORPHAN_IN_GTS
+from carplot.rollups import update_device_rollups, rebuild_device_rollups
+from carplot.playback import Resampler, iter_playback, iter_raw_windows, _decorate
+from carplot.export import export_csv, EXPORT_FIELDS
+from carplot.queries import MoveFilter, Position, iter_event_data, iter_fleet_event_data, iter_moved_positions, \
+    _mysql_supports_window_functions
+from carplot.tracks import simplify_track, zoom_to_tolerance
+from carplot.trips import TripSegmenter, segment_device, MAX_EVENT_GAP
+from carplot.wire import encode_columnar, COORDINATE_SCALE
+
+
+def _point(lat, lng, speed=50, heading=90):
+    return {'latitude': lat, 'longitude': lng, 'speed': speed, 'heading': heading}
+
+
+def _position(lat, lng, creation_time=0):
+    return Position('1', creation_time, creation_time, 0, lat, lng, 0, 0, '')
+
+
+def _row(creation_time, lat, lng, speed=0, heading=0, device_id='a', status_code=61714):
+    return {'deviceID': device_id, 'creationTime': creation_time, 'timestamp': creation_time,
+            'statusCode': status_code, 'latitude': lat, 'longitude': lng, 'speedKPH': speed, 'heading': heading}
+
+
+def _create_event(device_id, creation_time, lat=4.05, lng=9.7, speed=0, heading=0, status_code=61714,
+                  timestamp=None, account_id='owner'):
+    return EventData.objects.using(GTS).create(
+        accountID=account_id, deviceID=device_id, creationTime=creation_time, statusCode=status_code,
+        timestamp=creation_time if timestamp is None else timestamp, latitude=lat, longitude=lng,
+        speedKPH=speed, heading=heading, gpsAge=0, altitude=0, transportID='', inputMask=0, outputMask=0,
+        seatbeltMask=0, address='', dataSource='', rawData='', distanceKM=0, odometerKM=0, odometerOffsetKM=0,
+        geozoneIndex=0, geozoneID=0)
+
+
+def _create_vehicle(owner, imei):
+    vehicle_type, created = VehicleType.objects.get_or_create(name='car')
+    device = Device.objects.create(imeiNumber=imei, displayName='TK %s' % imei)
+    provision_device(device, owner.username)
+    return Vehicle.objects.create(name='Vehicle %s' % imei, type=vehicle_type, owner=owner,
+                                  device=Device.objects.get(pk=device.pk))
+
+
+def _create_geozone(account_id, geozone_id, zone_type, vertices, radius=0, **kwargs):
+    values = dict((field.attname, '' if isinstance(field, (models.CharField, models.TextField)) else 0)
+                  for field in Geozone._meta.fields if not field.primary_key)
+    values.update({'accountID': account_id, 'geozoneID': geozone_id, 'zoneType': zone_type, 'radius': radius,
+                   'isActive': True, 'reverseGeocode': 1})
+    for i, (lat, lng) in enumerate(vertices, 1):
+        values['latitude%d' % i], values['longitude%d' % i] = lat, lng
+    values.update(kwargs)
+    return Geozone.objects.using(GTS).create(**values)
+
+
+class ExportTestCase(SimpleTestCase):
+    def test_csv_of_non_ascii_addresses(self):
+        row = dict((field, 0) for field in EXPORT_FIELDS)
+        row['address'] = u'Yaound\xe9'
+        header, line = export_csv([row])
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        self.assertEqual(u'Yaound\xe9', line.strip().split(',')[-1])
+
+
+class TracksTestCase(SimpleTestCase):
+    def test_zoom_to_tolerance_halves_with_each_zoom_level(self):
+        self.assertAlmostEqual(zoom_to_tolerance(10), 2 * zoom_to_tolerance(11))
+
+    def test_short_tracks_are_returned_as_is(self):
+        points = [_point(0, 0), _point(0, 0.001)]
+        self.assertEqual(points, simplify_track(points, 10))
+
+    def test_straight_line_keeps_only_its_ends(self):
+        points = [_point(0, i * 0.0001) for i in range(100)]
+        simplified = simplify_track(points, 5)
+        self.assertEqual([points[0], points[-1]], simplified)
+
+    def test_deviation_over_tolerance_is_kept(self):
+        points = [_point(0, i * 0.0001) for i in range(100)]
+        # About 111m off the line, far over the tolerance
+        points[50] = _point(0.001, 50 * 0.0001)
+        self.assertIn(points[50], simplify_track(points, 10))
+
+    def test_stops_are_kept(self):
+        points = [_point(0, i * 0.0001, speed=0 if 40 <= i < 60 else 50) for i in range(100)]
+        simplified = simplify_track(points, 50)
+        self.assertIn(points[40], simplified)
+        self.assertIn(points[60], simplified)
+
+
+class WireTestCase(SimpleTestCase):
+    def test_encode_columnar(self):
+        points = [
+            {'latitude': 4.05, 'longitude': 9.7, 'creationTime': 1000, 'speed': 12.34, 'heading': 90,
+             'address': '', 'icon': 'north.png'},
+            {'latitude': 4.050001, 'longitude': 9.699, 'creationTime': 1010, 'speed': 0, 'heading': 0,
+             'address': 'Akwa', 'icon': 'static.png'},
+            {'latitude': 4.06, 'longitude': 9.71, 'creationTime': 1030, 'speed': 40, 'heading': 180,
+             'address': '', 'icon': 'north.png'},
+        ]
+        encoded = encode_columnar(points, 'LT 123', 'Truck / LT 123')
+        self.assertEqual(3, encoded['count'])
+        self.assertEqual([1000, 10, 20], encoded['epoch'])
+        self.assertEqual(['north.png', 'static.png'], encoded['icons'])
+        self.assertEqual([0, 1, 0], encoded['icon'])
+        self.assertEqual({1: 'Akwa'}, encoded['address'])
+        self.assertEqual([12.3, 0, 40], encoded['speed'])
+        lat, lng = 0, 0
+        for i, point in enumerate(points):
+            lat += encoded['lat'][i]
+            lng += encoded['lng'][i]
+            self.assertAlmostEqual(point['latitude'], lat / float(COORDINATE_SCALE), places=6)
+            self.assertAlmostEqual(point['longitude'], lng / float(COORDINATE_SCALE), places=6)
+
+
+class GeofenceTestCase(SimpleTestCase):
+    def test_polygon_contains(self):
+        zone = Zone('square', POLYGON, [(0, 0), (0, 1), (1, 1), (1, 0)])
+        self.assertTrue(zone.contains(0.5, 0.5))
+        self.assertFalse(zone.contains(1.5, 0.5))
+        self.assertFalse(zone.contains(0.5, -0.1))
+
+    def test_bounded_rect_contains(self):
+        zone = Zone('rect', BOUNDED_RECT, [(0, 0), (1, 1)])
+        self.assertTrue(zone.contains(0.2, 0.9))
+        self.assertFalse(zone.contains(1.2, 0.9))
+
+    def test_point_radius_contains(self):
+        zone = Zone('circle', POINT_RADIUS, [(4.0, 9.7)], 100)
+        self.assertTrue(zone.contains(4.0 + meters_to_degrees(50), 9.7))
+        self.assertFalse(zone.contains(4.0 + meters_to_degrees(150), 9.7))
+
+    def test_zone_index_finds_the_zones_of_a_point(self):
+        zones = [Zone('west', POLYGON, [(0, 0), (0, 0.1), (0.1, 0.1), (0.1, 0)]),
+                 Zone('east', POLYGON, [(0, 0.05), (0, 0.2), (0.1, 0.2), (0.1, 0.05)])]
+        index = ZoneIndex(zones)
+        self.assertEqual({'west'}, index.find(0.05, 0.01))
+        self.assertEqual({'west', 'east'}, index.find(0.05, 0.07))
+        self.assertEqual(set(), index.find(0.5, 0.5))
+
+    def test_large_zones_use_few_cells(self):
+        zones = [Zone('country', BOUNDED_RECT, [(0, 0), (10, 10)]), Zone('town', BOUNDED_RECT, [(4, 9), (4.05, 9.05)])]
+        index = ZoneIndex(zones)
+        self.assertLessEqual(sum(len(cells) for cells in index.grids.values()), 2 * 64)
+        self.assertEqual({'country', 'town'}, index.find(4.01, 9.01))
+        self.assertEqual({'country'}, index.find(9.9, 0.1))
+        self.assertEqual(set(), index.find(10.5, 0.1))
+
+
+class TripSegmenterTestCase(SimpleTestCase):
+    def test_trip_then_stop(self):
+        segmenter = TripSegmenter()
+        for i in range(11):
+            segmenter.feed(i * 60, 0.0, 1 + i * 0.001, 50)
+        for t in range(660, 1261, 60):
+            segmenter.feed(t, 0.0, 1.01, 0)
+        segmenter.feed(1320, 0.0, 1.011, 50)
+        trip, stop = segmenter.segments
+        self.assertEqual(Trip.TRIP, trip['kind'])
+        self.assertEqual((0, 600), (trip['start_time'], trip['end_time']))
+        self.assertAlmostEqual(1.112, trip['distance'], places=2)
+        self.assertEqual(50, trip['max_speed'])
+        self.assertEqual(Trip.STOP, stop['kind'])
+        self.assertEqual((660, 1320), (stop['start_time'], stop['end_time']))
+
+    def test_short_stop_counts_as_idle_time(self):
+        segmenter = TripSegmenter()
+        for t in range(0, 301, 60):
+            segmenter.feed(t, 0.0, 1 + t * 0.00001, 50)
+        for t in (360, 420, 480):
+            segmenter.feed(t, 0.0, 1.003, 0)
+        segmenter.feed(540, 0.0, 1.004, 50)
+        self.assertEqual([], segmenter.segments)
+        self.assertEqual(180, segmenter.get_state()['trip']['idle'])
+
+    def test_gap_closes_the_trip(self):
+        segmenter = TripSegmenter()
+        segmenter.feed(0, 0.0, 1.0, 50)
+        segmenter.feed(60, 0.0, 1.001, 50)
+        resume = 60 + MAX_EVENT_GAP + 1
+        segmenter.feed(resume, 0.0, 1.002, 50)
+        trip, stop = segmenter.segments
+        self.assertEqual(60, trip['end_time'])
+        self.assertEqual((60, resume), (stop['start_time'], stop['end_time']))
+
+    def test_short_stop_before_the_first_trip_is_not_recorded(self):
+        segmenter = TripSegmenter()
+        segmenter.feed(0, 0.0, 1.0, 0)
+        segmenter.feed(60, 0.0, 1.0, 50)
+        self.assertEqual([], segmenter.segments)
+
+    def test_state_resumes_segmentation(self):
+        segmenter = TripSegmenter()
+        segmenter.feed(0, 0.0, 1.0, 50)
+        resumed = TripSegmenter(segmenter.get_state())
+        resumed.feed(60, 0.0, 1.001, 50)
+        self.assertEqual(0, resumed.get_state()['trip']['start'][0])
+
+
+class ResamplerTestCase(SimpleTestCase):
+    def _resample(self, rows, start_date, end_date, step, max_gap, device_ids=('a',)):
+        resampler = Resampler(device_ids, start_date, end_date, step, max_gap)
+        frames = []
+        for row in rows:
+            frames.extend(resampler.feed(row))
+        frames.extend(resampler.flush())
+        return frames
+
+    def test_interpolation_between_close_positions(self):
+        rows = [_row(0, 0.0, 0.0, 10, 350), _row(100, 1.0, 2.0, 30, 10)]
+        frames = self._resample(rows, 0, 200, 50, 300)
+        self.assertEqual([0, 50, 100, 150], [frame[0] for frame in frames])
+        lat, lng, speed, heading = frames[1][1]['a']
+        self.assertAlmostEqual(0.5, lat)
+        self.assertAlmostEqual(1.0, lng)
+        self.assertAlmostEqual(20, speed)
+        # Shortest arc from 350° to 10° goes through North
+        self.assertAlmostEqual(0, heading)
+        # Held at the last position with its speed after it
+        self.assertEqual((1.0, 2.0, 30, 10), frames[3][1]['a'])
+
+    def test_position_is_held_still_after_a_gap(self):
+        rows = [_row(0, 0.0, 0.0, 10), _row(100, 1.0, 2.0, 30)]
+        frames = self._resample(rows, 0, 100, 50, 40)
+        self.assertEqual((0.0, 0.0, 0, 0), frames[1][1]['a'])
+
+    def test_device_without_position_yet_is_none(self):
+        rows = [_row(100, 1.0, 2.0, device_id='a')]
+        frames = self._resample(rows, 0, 150, 50, 300, ('a', 'b'))
+        self.assertIsNone(frames[0][1]['a'])
+        self.assertIsNone(frames[2][1]['b'])
+        self.assertEqual(1.0, frames[2][1]['a'][0])
+
+
+class PlaybackTestCase(TestCase):
+    def test_streams_keep_their_own_index(self):
+        streams = [iter([_row(1, 1, 1)]), iter([_row(1, 1, 1)]), iter([_row(2, 1, 1)])]
+        decorated = [_decorate(stream, i) for i, stream in enumerate(streams)]
+        self.assertEqual([0, 1, 2], [next(stream)[1] for stream in decorated])
+
+    def test_window_must_be_positive(self):
+        for window in (0, -60):
+            self.assertRaises(ValueError, list, iter_playback({'a': {}}, 0, 3600, None, window))
+
+    def test_events_of_the_same_second_are_kept(self):
+        rows = [_row(10, 1, 1, status_code=61714), _row(10, 1, 1, status_code=61722)]
+        iter_fleet_event_data = playback.iter_fleet_event_data
+        playback.iter_fleet_event_data = lambda device_ids, start_date, end_date, fields: iter(rows)
+        try:
+            self.assertEqual(rows, list(playback.iter_playback_rows([], 0, 100)))
+        finally:
+            playback.iter_fleet_event_data = iter_fleet_event_data
+
+    def test_empty_windows_are_skipped(self):
+        rows = [_row(10, 1, 1), _row(10 ** 9, 2, 2)]
+        iter_playback_rows = playback.iter_playback_rows
+        playback.iter_playback_rows = lambda device_ids, start_date, end_date: iter(rows)
+        try:
+            lines = [json.loads(line) for line in iter_raw_windows(['a'], 0, 10 ** 9 + 1, 1)]
+        finally:
+            playback.iter_playback_rows = iter_playback_rows
+        self.assertEqual([10, 10 ** 9], [line['start'] for line in lines])
+
+    def test_malformed_step_and_window_are_rejected(self):
+        Member.objects.create_user('owner', 'secret')
+        self.client.login(username='owner', password='secret')
+        for params in ({'step': 'abc'}, {'window': '1h'}, {'window': '0'}):
+            params['string_date'] = '01/05/2016 12:00 - 07/05/2016 11:00'
+            self.assertEqual(400, self.client.get(reverse('fleet_playback'), params).status_code)
+
+
+class MoveFilterTestCase(SimpleTestCase):
+    def test_null_coordinates_are_skipped(self):
+        positions = [_position(0.0, 9.7), _position(4.0, 0.0), _position(4.1, 9.8)]
+        self.assertEqual([positions[2]], list(MoveFilter().filter(positions)))
+
+    def test_positions_that_did_not_move_are_skipped(self):
+        positions = [_position(4.0, 9.7, 0), _position(4.0, 9.7, 10), _position(4.0, 9.8, 20),
+                     _position(4.1, 9.9, 30)]
+        self.assertEqual([positions[0], positions[3]], list(MoveFilter().filter(positions)))
+
+    def test_comparison_goes_on_from_the_last_position_read(self):
+        move_filter = MoveFilter()
+        list(move_filter.filter([_position(4.0, 9.7, 0), _position(0.0, 0.0, 10)]))
+        self.assertEqual(10, move_filter.last.creationTime)
+        # Compared with the null position read last, not with the last one kept
+        following = _position(4.0, 9.8, 20)
+        self.assertEqual([following], list(MoveFilter(move_filter.last).filter([following])))
+
+
+class GeocodingTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        geocoding._geocoders.clear()
+
+    def test_zone_name_resolves_for_a_provisioned_device(self):
+        device = Device.objects.create(imeiNumber='356000000000001', displayName='TK 1')
+        provision_device(device, 'owner')
+        _create_geozone('owner', 'depot', POLYGON, [(4.0, 9.7), (4.0, 9.8), (4.1, 9.8), (4.1, 9.7)],
+                        streetAddress='Depot', city='Douala')
+        _create_geozone('other', 'market', POLYGON, [(4.0, 9.7), (4.0, 9.8), (4.1, 9.8), (4.1, 9.7)],
+                        streetAddress='Market', city='Douala')
+        device = Device.objects.get(pk=device.pk)
+        points = fill_addresses([{'latitude': 4.05, 'longitude': 9.75, 'address': ''}], get_account_id(device))
+        self.assertEqual('Depot, Douala', points[0]['address'])
+
+    def test_account_of_devices_provisioned_without_it_is_read_from_opengts(self):
+        device = Device.objects.create(imeiNumber='356000000000002', displayName='TK 2')
+        provision_device(device, 'owner')
+        Device.objects.filter(pk=device.pk).update(accountID='')
+        self.assertEqual('owner', get_account_id(Device.objects.get(pk=device.pk)))
+
+
+class ArchiveTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.archive_root = archive.ARCHIVE_ROOT
+        archive.ARCHIVE_ROOT = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(archive.ARCHIVE_ROOT)
+        archive.ARCHIVE_ROOT = self.archive_root
+
+    def test_events_of_the_same_second_are_archived(self):
+        _create_event('1', 1000, status_code=61714)
+        _create_event('1', 1000, status_code=61722)
+        _create_event('1', 5000)
+        count, size = archive_device('1', 2000)
+        self.assertEqual(2, count)
+        self.assertEqual([61714, 61722], [event.statusCode for event in iter_archived_events('1')])
+        self.assertEqual([5000], list(EventData.objects.using(GTS).values_list('creationTime', flat=True)))
+
+    def test_status_codes_above_the_signed_range_are_archived(self):
+        _create_event('1', 1000, status_code=0xF0000001)
+        archive_device('1', 2000)
+        self.assertEqual([0xF0000001], [event.statusCode for event in iter_archived_events('1')])
+
+    def test_archiving_again_merges_with_the_month_archived(self):
+        _create_event('1', 1000, status_code=61714)
+        archive_device('1', 2000)
+        _create_event('1', 1000, status_code=61722)
+        _create_event('1', 1500)
+        archive_device('1', 2000)
+        events = [(event.creationTime, event.statusCode) for event in iter_archived_events('1')]
+        self.assertEqual([(1000, 61714), (1000, 61722), (1500, 61714)], events)
+
+    def test_archives_without_status_code_are_read(self):
+        path = get_archive_path('1', get_month(1000))
+        os.makedirs(os.path.dirname(path))
+        columns = LEGACY_COLUMNS[1]
+        values = {'creationTime': 1000, 'timestamp': 998, 'latitude': 4.05, 'longitude': 9.7,
+                  'speedKPH': 20, 'heading': 90}
+        data = HEADER.pack(ARCHIVE_MAGIC, 1, 1) + b''.join(struct.pack('<' + typecode, values[name])
+                                                             for name, typecode in columns)
+        with open(path, 'wb') as f:
+            f.write(zlib.compress(data))
+        event, = iter_archived_events('1')
+        self.assertEqual((1000, 998, 0, 4.05, 9.7), event[1:6])
+
+    def test_sampled_history_reaches_the_end_of_the_period(self):
+        for i in range(20):
+            _create_event('1', 1000 + i * 10, lat=4.0 + i * 0.01, lng=9.0 + i * 0.01)
+        archive_device('1', 1050)
+        positions, truncated = get_sampled_history('1', 1000, 1200, 4)
+        self.assertTrue(truncated)
+        self.assertEqual([1000, 1050, 1100, 1150], [position.creationTime for position in positions])
+        positions, truncated = get_sampled_history('1', 1000, 1200, 100)
+        self.assertFalse(truncated)
+        self.assertEqual(20, len(positions))
+
+
+class QueriesTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        for status_code in (61714, 61722, 61730):
+            _create_event('1', 1000, status_code=status_code)
+        _create_event('1', 1010, lat=4.06, lng=9.71)
+
+    def test_events_of_the_same_second_are_not_skipped_across_chunks(self):
+        rows = list(iter_event_data(['1'], chunk_size=1, fields=('creationTime',)))
+        self.assertEqual([{'creationTime': 1000}] * 3 + [{'creationTime': 1010}], rows)
+
+    def test_cursor_holds_the_status_code(self):
+        rows = list(iter_event_data(['1'], fields=('statusCode',), cursor=(1000, 1000, 61714)))
+        self.assertEqual([61722, 61730, 61714], [row['statusCode'] for row in rows])
+
+    def test_fleet_events_of_the_same_second_are_not_skipped_across_chunks(self):
+        _create_event('2', 1000)
+        rows = list(iter_fleet_event_data(['1', '2'], 0, 2000, chunk_size=1, fields=('deviceID', 'statusCode')))
+        self.assertEqual([('1', 61714), ('1', 61722), ('1', 61730), ('2', 61714), ('1', 61714)],
+                         [(row['deviceID'], row['statusCode']) for row in rows])
+
+    def test_moved_positions_after_a_cursor_of_the_same_second(self):
+        # Filtered by the database with LAG, then in Python
+        for supported in (True, False):
+            queries._window_support[GTS] = supported
+            positions = list(iter_moved_positions('1', cursor=(1000, 1000, 61722)))
+            self.assertEqual([(1000, 61730), (1010, 61714)],
+                             [(position.creationTime, position.statusCode) for position in positions])
+        queries._window_support.clear()
+
+
+class LiveTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.owner = Member.objects.create_user('owner', 'secret')
+        self.vehicle = _create_vehicle(self.owner, '356000000000001')
+        self.client.login(username='owner', password='secret')
+
+    def _get_since(self, cursor):
+        response = self.client.get(reverse('device_position_since'),
+                                   {'device_id': self.vehicle.device_id, 'cursor': cursor})
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_events_of_the_same_second_are_not_skipped_across_batches(self):
+        device_id = str(self.vehicle.device_id)
+        for status_code in (61714, 61722, 61730):
+            _create_event(device_id, 1000, status_code=status_code)
+        batch_size = views.LIVE_BATCH_SIZE
+        views.LIVE_BATCH_SIZE = 1
+        try:
+            cursors, response = [], {'cursor': '999,999,0', 'has_more': True}
+            while response['has_more']:
+                response = self._get_since(response['cursor'])
+                cursors.append(response['cursor'])
+        finally:
+            views.LIVE_BATCH_SIZE = batch_size
+        self.assertEqual(['1000,1000,61714', '1000,1000,61722', '1000,1000,61730'], cursors)
+
+    def test_cursor_without_status_code_covers_its_second(self):
+        device_id = str(self.vehicle.device_id)
+        _create_event(device_id, 1000, status_code=61722)
+        _create_event(device_id, 1010)
+        self.assertEqual('1010,1010,61714', self._get_since('1000,1000')['cursor'])
+
+    def test_history_of_another_user_is_not_served(self):
+        Member.objects.create_user('other', 'secret')
+        self.client.login(username='other', password='secret')
+        response = self.client.get(reverse('device_position'), {'device_id': self.vehicle.device_id})
+        self.assertEqual(404, response.status_code)
+
+    def test_malformed_cursor_is_rejected(self):
+        for cursor in ('abc', '1,2,3,4'):
+            response = self.client.get(reverse('device_position_since'),
+                                       {'device_id': self.vehicle.device_id, 'cursor': cursor})
+            self.assertEqual(400, response.status_code)
+            response = self.client.get(reverse('device_position_stream'), {'cursor': cursor})
+            self.assertEqual(400, response.status_code)
+
+
+class _Poller(EventPoller):
+    """
+    Poller without its thread: tests poll it by hand
+    """
+    def start(self):
+        pass
+
+
+class EventPollerTestCase(TestCase):
+    multi_db = True
+
+    def test_devices_are_read_from_their_own_cursor(self):
+        _create_event('a', 1000, timestamp=990)
+        _create_event('b', 1000, timestamp=995)
+        poller = _Poller()
+        cursors = {'a': (1000, 990, 61714), 'b': (1000, 995, 61714)}
+        self.assertEqual([], poller.wait(cursors, 0))
+        _create_event('b', 1000, timestamp=998)
+        poller.poll_once()
+        event, = poller.wait(cursors, 0)
+        cursors['b'] = get_cursor(event)
+        # Inserted after the event of b, with an older timestamp
+        _create_event('a', 1000, timestamp=992)
+        poller.poll_once()
+        event, = poller.wait(cursors, 0)
+        self.assertEqual(('a', 992), (event.deviceID, event.timestamp))
+
+    def test_no_device_returns_at_once(self):
+        self.assertEqual([], _Poller().wait({}, 60))
+
+    def test_idle_device_does_not_hold_back_the_others(self):
+        _create_event('a', 1000)
+        _create_event('b', 1000)
+        poller = _Poller(batch_size=2)
+        poller.wait({'a': (1000, 1000, 61714), 'b': (1000, 1000, 61714)}, 0)
+        for creation_time in (1001, 1002, 1003):
+            _create_event('a', creation_time)
+        self.assertEqual(3, poller.poll_once())
+        # Only the new events of a would be read again from the cursor of the idle b
+        with self.assertNumQueries(1, using=GTS):
+            self.assertEqual(0, poller.poll_once())
+
+
+class StreamTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.owner = Member.objects.create_user('owner', 'secret')
+        self.client.login(username='owner', password='secret')
+        self.poller = live._poller
+        live._poller = _Poller()
+
+    def tearDown(self):
+        live._poller = self.poller
+
+    def _stream(self, cursor=None, timeout=0):
+        params = {'timeout': timeout}
+        if cursor:
+            params['cursor'] = cursor
+        response = self.client.get(reverse('device_position_stream'), params)
+        return json.loads(response.content.decode('utf-8'))
+
+    def test_fleet_without_vehicles_is_answered_at_once(self):
+        start = time.time()
+        response = self._stream('1000,1000,0', timeout=25)
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual({}, response['event_data'])
+
+    def test_late_events_of_a_device_are_not_skipped(self):
+        device_a = str(_create_vehicle(self.owner, '356000000000001').device_id)
+        device_b = str(_create_vehicle(self.owner, '356000000000002').device_id)
+        _create_event(device_a, 1000, timestamp=990, lat=4.01, lng=9.71)
+        _create_event(device_b, 1000, timestamp=995, lat=4.02, lng=9.72)
+        response = self._stream()
+        self.assertEqual(set([device_a, device_b]), set(response['event_data'].keys()))
+        # Inserted after the event of b, with an older timestamp
+        _create_event(device_a, 1000, timestamp=992, lat=4.03, lng=9.73)
+        response = self._stream(response['cursor'])
+        self.assertEqual([device_a], list(response['event_data'].keys()))
+        self.assertEqual('%s:1000,992,61714;%s:1000,995,61714' % tuple(sorted([device_a, device_b])),
+                         response['cursor'])
+
+
+class RollupsTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.archive_root = archive.ARCHIVE_ROOT
+        archive.ARCHIVE_ROOT = tempfile.mkdtemp()
+        self.device = Device.objects.create(imeiNumber='356000000000001', displayName='TK 1')
+        self.device_id = str(self.device.id)
+        self.day = date(2020, 1, 10)
+        self.day_start = int(time.mktime(self.day.timetuple()))
+
+    def tearDown(self):
+        shutil.rmtree(archive.ARCHIVE_ROOT)
+        archive.ARCHIVE_ROOT = self.archive_root
+
+    def _drive(self, start, count):
+        for i in range(count):
+            _create_event(self.device_id, start + i * 60, lat=4.0 + i * 0.001, lng=9.7 + i * 0.001, speed=40)
+
+    def _get_counts(self):
+        return dict(DailyRollup.objects.filter(device=self.device).values_list('day', 'event_count'))
+
+    def test_archived_days_are_kept(self):
+        self._drive(self.day_start + 3600, 5)
+        self._drive(self.day_start + 86400 + 3600, 3)
+        update_device_rollups(self.device)
+        archive_device(self.device_id, self.day_start + 86400)
+        first_day = rebuild_device_rollups(self.device, self.day, self.day + timedelta(days=1))
+        self.assertEqual(self.day + timedelta(days=1), first_day)
+        self.assertEqual({self.day: 5, self.day + timedelta(days=1): 3}, self._get_counts())
+
+    def test_rebuild_stops_at_the_watermark(self):
+        self._drive(self.day_start + 3600, 3)
+        update_device_rollups(self.device)
+        # Same second as the watermark, not rolled up yet
+        _create_event(self.device_id, self.day_start + 3600 + 120, status_code=61722)
+        rebuild_device_rollups(self.device, self.day, self.day)
+        self.assertEqual({self.day: 3}, self._get_counts())
+        update_device_rollups(self.device)
+        self.assertEqual({self.day: 4}, self._get_counts())
+
+    def test_update_after_a_first_rebuild_does_not_count_twice(self):
+        self._drive(self.day_start + 3600, 3)
+        rebuild_device_rollups(self.device, self.day, self.day)
+        self.assertEqual({self.day: 3}, self._get_counts())
+        self._drive(self.day_start + 7200, 2)
+        update_device_rollups(self.device)
+        self.assertEqual({self.day: 5}, self._get_counts())
+
+    def test_rebuild_matches_the_incremental_update(self):
+        # Drives across midnight
+        self._drive(self.day_start - 180, 6)
+        update_device_rollups(self.device)
+        expected = list(DailyRollup.objects.filter(device=self.device).order_by('day')
+                        .values_list('day', 'distance', 'moving_duration'))
+        rebuild_device_rollups(self.device, self.day, self.day)
+        self.assertEqual(expected, list(DailyRollup.objects.filter(device=self.device).order_by('day')
+                                        .values_list('day', 'distance', 'moving_duration')))
+
+    def test_report_days_must_be_positive(self):
+        Member.objects.create_user('owner', 'secret')
+        self.client.login(username='owner', password='secret')
+        for days in ('0', '-3', 'abc'):
+            self.assertEqual(400, self.client.get(reverse('fleet_report'), {'days': days}).status_code)
+
+
+class SegmentDeviceTestCase(TestCase):
+    multi_db = True
+
+    def test_run_stopped_before_its_watermark_is_saved_is_done_again(self):
+        device = Device.objects.create(imeiNumber='356000000000001', displayName='TK 1')
+        for i in range(11):
+            _create_event(str(device.id), i * 60, lat=4.0, lng=9.7 + i * 0.001, speed=50)
+        for t in range(660, 1261, 60):
+            _create_event(str(device.id), t, lat=4.0, lng=9.71)
+        _create_event(str(device.id), 1320, lat=4.0, lng=9.711, speed=50)
+        self.assertEqual(2, segment_device(device))
+        # As if the watermark of the run had not been saved
+        Watermark.objects.filter(device=device).delete()
+        self.assertEqual(2, segment_device(device))
+        self.assertEqual([(Trip.TRIP, 0), (Trip.STOP, 660)],
+                         list(Trip.objects.filter(device=device).order_by('start_time')
+                              .values_list('kind', 'start_time')))
+
+    def test_trips_need_a_well_formed_period(self):
+        owner = Member.objects.create_user('owner', 'secret')
+        vehicle = _create_vehicle(owner, '356938035643809')
+        self.client.login(username='owner', password='secret')
+        for params in ({}, {'string_date': '01/05/2016'}, {'string_date': 'yesterday - today'}):
+            params['device_id'] = vehicle.device_id
+            self.assertEqual(400, self.client.get(reverse('device_trips'), params).status_code)
+
+
+class GeofenceSweepTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.device = Device.objects.create(imeiNumber='356000000000001', displayName='TK 1')
+        self.device_id = str(self.device.id)
+        _create_geozone('owner', 'depot', POLYGON, [(4.0, 9.7), (4.0, 9.8), (4.1, 9.8), (4.1, 9.7)])
+
+    def _sweep(self, since=None):
+        return [(transition.geozone_id, transition.event, transition.creation_time)
+                for transition in sweep_device(load_zone_index('owner'), self.device, since)]
+
+    def test_first_sweep_starts_from_the_latest_event(self):
+        _create_event(self.device_id, 1000, lat=3.0, lng=9.0)
+        _create_event(self.device_id, 1060, lat=4.05, lng=9.75)
+        self.assertEqual([], self._sweep())
+        _create_event(self.device_id, 1120, lat=4.06, lng=9.75)
+        _create_event(self.device_id, 1180, lat=3.0, lng=9.0)
+        self.assertEqual([('depot', EXIT, 1180)], self._sweep())
+        self.assertEqual([], self._sweep())
+
+    def test_first_sweep_since(self):
+        _create_event(self.device_id, 1000, lat=3.0, lng=9.0)
+        _create_event(self.device_id, 1060, lat=4.05, lng=9.75)
+        self.assertEqual([('depot', ENTER, 1060)], self._sweep(since=1000))
+        self.assertEqual([], self._sweep())
+
+    def test_positions_with_a_null_coordinate_are_skipped(self):
+        _create_event(self.device_id, 1000, lat=4.05, lng=9.75)
+        _create_event(self.device_id, 1060, lat=0.0, lng=9.75)
+        _create_event(self.device_id, 1120, lat=4.05, lng=0.0)
+        _create_event(self.device_id, 1180, lat=4.06, lng=9.75)
+        self.assertEqual([('depot', ENTER, 1000)], self._sweep(since=1000))
+
+
+class CatalogueTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.device_type = DeviceType.objects.create(name='tracker')
+        SMSCommand.objects.create(action='stop', sms_content='stop123456', device_type=self.device_type)
+
+    def _get_actions(self):
+        return sorted(command['action'] for command in get_catalogue(self.device_type.id))
+
+    def test_invalidation_rebuilds_the_catalogue(self):
+        self.assertEqual(['stop'], self._get_actions())
+        SMSCommand.objects.create(action='resume', sms_content='resume123456', device_type=self.device_type)
+        self.assertEqual(['stop'], self._get_actions())
+        invalidate_catalogue(self.device_type.id)
+        self.assertEqual(['resume', 'stop'], self._get_actions())
+
+    def test_evicted_version_does_not_serve_a_stale_catalogue(self):
+        self.assertEqual(['stop'], self._get_actions())
+        SMSCommand.objects.create(action='resume', sms_content='resume123456', device_type=self.device_type)
+        cache.delete(_get_version_key(self.device_type.id))
+        invalidate_catalogue(self.device_type.id)
+        self.assertEqual(['resume', 'stop'], self._get_actions())
+
+
+class SearchTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        search._indexes.clear()
+        self.owner = Member.objects.create_user('owner', 'secret')
+        self.other = Member.objects.create_user('other', 'secret')
+        self.vehicle = _create_vehicle(self.owner, '356938035643809')
+
+    def _get_names(self, owner, keyword):
+        return [vehicle['name'] for vehicle in search_vehicles(owner.id, keyword)]
+
+    def test_update_is_applied_to_the_index(self):
+        index = get_index(self.owner.id)
+        self.vehicle.name = 'Hilux'
+        self.vehicle.save()
+        self.assertIs(index, get_index(self.owner.id))
+        self.assertEqual(['Hilux'], self._get_names(self.owner, 'hilux'))
+        self.assertEqual([], self._get_names(self.owner, 'vehicle 356938035643809'))
+
+    def test_evicted_version_does_not_serve_a_stale_index(self):
+        index = get_index(self.owner.id)
+        cache.delete(search._get_version_key(self.owner.id))
+        self.vehicle.name = 'Hilux'
+        self.vehicle.save()
+        self.assertNotEqual(index.version, 1)
+        self.assertEqual(['Hilux'], self._get_names(self.owner, 'hilux'))
+
+    def test_owner_change_removes_the_vehicle_from_the_previous_owner(self):
+        self.assertEqual(['Vehicle 356938035643809'], self._get_names(self.owner, 'vehicle'))
+        self.assertEqual([], self._get_names(self.other, 'vehicle'))
+        version = get_index(self.owner.id).version
+        self.vehicle.owner = self.other
+        self.vehicle.save()
+        self.assertEqual(version + 1, get_index(self.owner.id).version)
+        self.assertEqual([], self._get_names(self.owner, 'vehicle'))
+        self.assertEqual(['Vehicle 356938035643809'], self._get_names(self.other, 'vehicle'))
+
+    def test_least_recently_searched_indexes_are_evicted(self):
+        max_indexes = search.SEARCH_MAX_INDEXES
+        search.SEARCH_MAX_INDEXES = 1
+        try:
+            get_index(self.owner.id)
+            get_index(self.other.id)
+        finally:
+            search.SEARCH_MAX_INDEXES = max_indexes
+        self.assertEqual([self.other.id], list(search._indexes))
+
+
+class MarkersTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = Member.objects.create_user('owner', 'secret')
+        self.vehicle = _create_vehicle(self.owner, '356938035643809')
+        self.device_id = str(self.vehicle.device_id)
+        Device.objects.filter(pk=self.vehicle.device_id).update(lastValidLatitude=4.0, lastValidLongitude=9.0)
+
+    def test_devices_without_position_have_no_marker(self):
+        Device.objects.filter(pk=self.vehicle.device_id).update(lastValidLatitude=None, lastValidLongitude=None)
+        self.assertEqual([], get_markers(self.owner.id))
+        refresh_marker_positions({self.device_id: (4.05, 9.7)})
+        self.assertEqual([(4.05, 9.7)], [(marker['latitude'], marker['longitude'])
+                                         for marker in get_markers(self.owner.id)])
+        refresh_marker_positions({self.device_id: (None, None)})
+        self.assertEqual([], get_markers(self.owner.id))
+
+    def test_refresh_does_not_restore_an_invalidated_index(self):
+        get_marker_index(self.owner.id)
+        remove_from_bucket = markers._remove_from_bucket
+
+        def invalidate_meanwhile(index, vehicle_id):
+            Vehicle.objects.filter(pk=self.vehicle.pk).update(name='Hilux')
+            invalidate_marker_index(self.owner.id)
+            remove_from_bucket(index, vehicle_id)
+        markers._remove_from_bucket = invalidate_meanwhile
+        try:
+            refresh_marker_positions({self.device_id: (4.05, 9.7)})
+        finally:
+            markers._remove_from_bucket = remove_from_bucket
+        self.assertEqual(['Hilux'], [marker['name'] for marker in get_markers(self.owner.id)])
+
+    def test_malformed_viewport_is_rejected(self):
+        self.client.login(username='owner', password='secret')
+        for params in ({}, {'bbox': '3,9,5', 'zoom': '10'}, {'bbox': '3,9,5,10', 'zoom': 'far'}):
+            self.assertEqual(400, self.client.get(reverse('fleet_markers'), params).status_code)
+
+
+class _Response(object):
+    def __init__(self, status_code):
+        self.status_code = status_code
+        self.ok = status_code < 400
+
+
+class _Gateway(object):
+    """
+    Stands for the HTTP session of SMSDispatcher, answering every request with status_code
+    """
+    def __init__(self, status_code=200):
+        self.status_code = status_code
+        self.urls = []
+
+    def get(self, url, timeout=None):
+        self.urls.append(url)
+        return _Response(self.status_code)
+
+
+class SMSTestCase(TransactionTestCase):
+    # Worker threads write through their own connection, the data must be committed
+    multi_db = True
+
+    def setUp(self):
+        self.config = OperatorProfile.objects.create(company_name='carplot', sms_limit=5,
+                                                     sms_api_script_url='http://gateway/$recipient/$text')
+        device_type = DeviceType.objects.create(name='tracker')
+        self.sms_command = SMSCommand.objects.create(action='stop', sms_content='stop123456', device_type=device_type)
+        self.devices = [Device(simPhoneNumber='677000001'), Device(simPhoneNumber='677000002'), Device()]
+        self.retry_delay = sms.SMS_RETRY_DELAY
+        sms.SMS_RETRY_DELAY = 0
+
+    def tearDown(self):
+        sms.SMS_RETRY_DELAY = self.retry_delay
+
+    def _get_sms_limit(self):
+        return OperatorProfile.objects.get(pk=self.config.pk).sms_limit
+
+    def _get_dispatcher(self, workers=1, status_code=200):
+        dispatcher = SMSDispatcher(workers=workers, retries=2, rate_limit=0)
+        dispatcher.session = _Gateway(status_code)
+        return dispatcher
+
+    def test_sms_are_sent_to_the_devices_having_a_phone_number(self):
+        dispatcher = self._get_dispatcher()
+        self.assertEqual(2, dispatcher.send(self.config, self.sms_command, self.devices))
+        dispatcher.join()
+        self.assertEqual(['http://gateway/677000001/stop123456', 'http://gateway/677000002/stop123456'],
+                         sorted(dispatcher.session.urls))
+        self.assertEqual(2, dispatcher.sent)
+        self.assertEqual(3, self._get_sms_limit())
+
+    def test_url_values_are_encoded(self):
+        self.assertEqual('http://gateway/%2B237677000001/stop+1%26x%3D2',
+                         sms.build_sms_url(self.config, '+237677000001', 'stop 1&x=2'))
+
+    def test_quota_is_given_back_when_the_gateway_keeps_failing(self):
+        dispatcher = self._get_dispatcher(status_code=503)
+        dispatcher.send(self.config, self.sms_command, self.devices[:1])
+        dispatcher.join()
+        self.assertEqual(2, len(dispatcher.session.urls))
+        self.assertEqual(1, dispatcher.failed)
+        self.assertEqual(5, self._get_sms_limit())
+
+    def test_quota_is_not_taken_beyond_the_limit(self):
+        OperatorProfile.objects.filter(pk=self.config.pk).update(sms_limit=1)
+        dispatcher = self._get_dispatcher()
+        self.assertEqual(0, dispatcher.send(self.config, self.sms_command, self.devices))
+        self.assertEqual(1, self._get_sms_limit())
+
+    def test_shutdown_gives_back_the_quota_of_queued_sms(self):
+        dispatcher = self._get_dispatcher(workers=0)
+        dispatcher.send(self.config, self.sms_command, self.devices)
+        self.assertEqual(3, self._get_sms_limit())
+        self.assertEqual(2, dispatcher.shutdown(timeout=0))
+        self.assertEqual([], dispatcher.session.urls)
+        self.assertEqual(5, self._get_sms_limit())
+
+    def test_devices_without_phone_number_are_reported(self):
+        owner = Member.objects.create_user('owner', 'secret')
+        vehicle = _create_vehicle(owner, '356938035643809')
+        self.client.login(username='owner', password='secret')
+
+        class Service(object):
+            config = self.config
+        get_service_instance = views.get_service_instance
+        views.get_service_instance = Service
+        try:
+            response = self.client.get(reverse('send_sms'), {'sms_id': self.sms_command.id,
+                                                             'device_id': vehicle.device_id})
+        finally:
+            views.get_service_instance = get_service_instance
+        self.assertEqual({'No_phone': True}, json.loads(response.content.decode('utf-8')))
+        self.assertEqual(5, self._get_sms_limit())
+
+
+class IconAtlasTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        cache.clear()
+        self.owner = Member.objects.create_user('owner', 'secret')
+        self.client.login(username='owner', password='secret')
+        self.vehicle = _create_vehicle(self.owner, '356938035643809')
+        _create_event(str(self.vehicle.device_id), 1000000, speed=30)
+
+    def test_track_keeps_icon_urls_when_the_atlas_cannot_be_built(self):
+        VehicleType.objects.filter(pk=self.vehicle.type_id).update(static_icon_img='device_img/missing.png')
+        response = self.client.get(reverse('device_position'), {'device_id': self.vehicle.device_id,
+                                                                'icons': 'atlas'})
+        self.assertEqual(200, response.status_code)
+        response = json.loads(response.content.decode('utf-8'))
+        self.assertNotIn('atlas', response)
+        self.assertTrue(response['event_data'][0]['icon'].endswith('device_img/missing.png'))
+
+    def test_failed_atlas_is_not_built_again_at_every_request(self):
+        VehicleType.objects.filter(pk=self.vehicle.type_id).update(static_icon_img='device_img/missing.png')
+        self.assertIsNone(icons.get_icon_atlas(self.vehicle.type_id))
+        build_icon_atlas = icons.build_icon_atlas
+        icons.build_icon_atlas = None
+        try:
+            self.assertIsNone(icons.get_icon_atlas(self.vehicle.type_id))
+        finally:
+            icons.build_icon_atlas = build_icon_atlas
+
+
+class WindowSupportTestCase(SimpleTestCase):
+    def test_mysql_versions(self):
+        self.assertTrue(_mysql_supports_window_functions('8.0.2'))
+        self.assertTrue(_mysql_supports_window_functions('8.0.36-0ubuntu0.22.04.1'))
+        self.assertFalse(_mysql_supports_window_functions('5.7.44-log'))
+
+    def test_mariadb_versions(self):
+        self.assertFalse(_mysql_supports_window_functions('10.1.48-MariaDB'))
+        self.assertFalse(_mysql_supports_window_functions('5.5.5-10.1.48-MariaDB-0ubuntu0.18.04.1'))
+        self.assertTrue(_mysql_supports_window_functions('5.5.5-10.2.44-MariaDB'))
+        self.assertTrue(_mysql_supports_window_functions('10.6.12-MariaDB-0ubuntu0.22.04.1'))
+
+
+class ProvisioningTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.device_type = DeviceType.objects.create(name='tracker')
+
+    def test_read_batch(self):
+        csv_data = u'imei,sim,type,name\n356938035643809, 677000001 ,tracker,Camion Équipe\n'.encode('utf-8')
+        json_data = json.dumps([{'imei': '356938035643809', 'sim': '677000001', 'type': 'tracker',
+                                 'name': u'Camion Équipe'}]).encode('utf-8')
+        expected = [{'imeiNumber': '356938035643809', 'simPhoneNumber': '677000001', 'device_type': 'tracker',
+                     'displayName': u'Camion Équipe'}]
+        self.assertEqual(expected, read_batch(csv_data, 'csv'))
+        self.assertEqual(expected, read_batch(json_data, 'json'))
+
+    def test_devices_are_created_then_updated_in_both_databases(self):
+        rows = [{'imeiNumber': '356938035643809', 'simPhoneNumber': '677000001', 'device_type': 'tracker',
+                 'displayName': 'TK 1'}]
+        report = provision_devices(rows, 'owner')
+        self.assertEqual((1, 0, []), report[:3])
+        device = Device.objects.get(imeiNumber='356938035643809')
+        self.assertEqual(('owner', str(device.id), self.device_type.id),
+                         (device.accountID, device.deviceID, device.device_type_id))
+        rows[0]['simPhoneNumber'] = '677000002'
+        report = provision_devices(rows, 'owner')
+        self.assertEqual((0, 1, []), report[:3])
+        gts_device = Device.objects.using(GTS).get(deviceID=str(device.id))
+        self.assertEqual(('owner', '677000002'), (gts_device.accountID, gts_device.simPhoneNumber))
+
+    def test_devices_stay_in_their_account(self):
+        rows = [{'imeiNumber': '356938035643809', 'displayName': 'TK 1'}]
+        provision_devices(rows, 'owner')
+        rows[0]['displayName'] = 'TK 1 bis'
+        provision_devices(rows, 'admin')
+        device = Device.objects.get(imeiNumber='356938035643809')
+        provision_device(device, 'admin')
+        gts_device = Device.objects.using(GTS).get(deviceID=str(device.id))
+        self.assertEqual(('owner', 'owner', 'TK 1 bis'),
+                         (Device.objects.get(pk=device.pk).accountID, gts_device.accountID, gts_device.displayName))
+
+    def test_indexes_of_the_owners_are_invalidated(self):
+        cache.clear()
+        owner = Member.objects.create_user('owner', 'secret')
+        vehicle = _create_vehicle(owner, '356938035643809')
+        Device.objects.filter(pk=vehicle.device_id).update(lastValidLatitude=4.0, lastValidLongitude=9.0)
+        get_index(owner.id)
+        get_marker_index(owner.id)
+        provision_devices([{'imeiNumber': '356938035643809', 'displayName': 'Camion'}], 'owner')
+        self.assertEqual(['Vehicle 356938035643809'],
+                         [found['name'] for found in search_vehicles(owner.id, 'camion')])
+        self.assertEqual(['Camion'], [marker['displayName'] for marker in get_markers(owner.id)])
+
+    def test_upload_without_a_supported_file_is_rejected(self):
+        admin = Member.objects.create_user('admin', 'secret')
+        admin.user_permissions.add(Permission.objects.get(codename='add_device'))
+        self.client.login(username='admin', password='secret')
+        self.assertEqual(400, self.client.post(reverse('upload_devices')).status_code)
+        upload = SimpleUploadedFile('devices.xls', b'imei,name\n356938035643809,TK 1\n')
+        self.assertEqual(400, self.client.post(reverse('upload_devices'), {'devices': upload}).status_code)
+        upload = SimpleUploadedFile('devices.json', b'[{"imei": ')
+        self.assertEqual(400, self.client.post(reverse('upload_devices'), {'devices': upload}).status_code)
+
+    def test_invalid_rows_are_reported_without_stopping_the_batch(self):
+        rows = [{'imeiNumber': '356938035643809', 'displayName': 'TK 1'},
+                {'imeiNumber': '356938035643809', 'displayName': 'TK 1 bis'},
+                {'imeiNumber': '356938035643810'},
+                {'imeiNumber': '356938035643811', 'displayName': 'TK 3', 'device_type': 'unknown'}]
+        report = provision_devices(rows, 'owner')
+        self.assertEqual(1, report.created)
+        self.assertEqual([2, 3, 4], [line for line, message in report.errors])
+        self.assertEqual(1, Device.objects.using(GTS).filter(accountID='owner').count())
+
+
+class ReconcileTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        cache.clear()
+        self.devices = []
+        for i in range(3):
+            device = Device.objects.create(imeiNumber='35693803564380%d' % i, displayName='TK %d' % i)
+            provision_device(device, 'owner')
+            self.devices.append(Device.objects.get(pk=device.pk))
+
+    def _get_divergences(self, report):
+        return sorted((divergence.kind, divergence.device_id) for divergence in report.divergences)
+
+    def test_divergences_are_reported_then_fixed(self):
+        first, second, third = [str(device.id) for device in self.devices]
+        Device.objects.using(GTS).filter(deviceID=first).delete()
+        Device.objects.using(GTS).filter(deviceID=second).update(displayName='Renamed')
+        Device.objects.filter(pk=third).update(deviceID='')
+        Device.objects.using(GTS).create(accountID='owner', deviceID='999999', imeiNumber='356938035643899',
+                                         displayName='Orphan')
+        expected = sorted([(MISSING_IN_GTS, first), (FIELD_MISMATCH, second), (MISSING_IDS, third),
+                           (ORPHAN_IN_GTS, '999999')])
+        report = reconcile_devices('owner', dry_run=True)
+        self.assertEqual(expected, self._get_divergences(report))
+        self.assertEqual(0, report.fixed)
+        report = reconcile_devices('owner')
+        self.assertEqual(expected, self._get_divergences(report))
+        self.assertEqual(3, report.fixed)
+        self.assertEqual('TK 1', Device.objects.using(GTS).get(deviceID=second).displayName)
+        self.assertEqual([(ORPHAN_IN_GTS, '999999')], self._get_divergences(reconcile_devices('owner', full=True)))
+
+    def test_stopped_walk_resumes_from_the_watermark(self):
+        report = reconcile_devices('owner', chunk_size=2, max_chunks=1)
+        self.assertEqual((2, False), (report.scanned, report.completed))
+        # The watermark does not live in the cache of the process
+        cache.clear()
+        report = reconcile_devices('owner', chunk_size=2)
+        self.assertEqual((1, True), (report.scanned, report.completed))
+
+    def test_completed_walk_is_followed_by_incremental_runs(self):
+        Device.objects.update(lastUpdateTime=0)
+        reconcile_devices('owner')
+        Device.objects.filter(pk=self.devices[0].pk).update(displayName='Renamed',
+                                                            lastUpdateTime=int(time.time()) + 1)
+        report = reconcile_devices('owner')
+        self.assertTrue(report.incremental)
+        self.assertEqual(1, report.scanned)
+        self.assertEqual([(FIELD_MISMATCH, str(self.devices[0].id))], self._get_divergences(report))
+
+
+class HealthTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        self.config = OperatorProfile.objects.create(maximum_latency=60000)
+        self.device_ids = [str(Device.objects.create(imeiNumber='35693803564380%d' % i, displayName='TK %d' % i,
+                                                     deviceID='tk_%d' % i).id) for i in range(3)]
+
+    def test_status_changes_are_recorded(self):
+        now = int(time.time())
+        recent, late, silent = self.device_ids
+        _create_event(recent, now - 10)
+        _create_event(late, now - 3600)
+        report = check_device_health(self.config)
+        self.assertEqual((3, 2, 3), report[:3])
+        self.assertEqual(set([late, silent]), get_non_functional_devices(self.device_ids))
+        _create_event(recent, now - 5)
+        _create_event(late, now - 1)
+        report = check_device_health(self.config)
+        self.assertEqual((3, 1, 1), report[:3])
+        self.assertEqual(set([silent]), get_non_functional_devices(self.device_ids))
+        self.assertEqual(now - 5, DeviceHealth.objects.get(device=recent).last_report)
+
+    def test_statuses_of_inactive_devices_are_dropped(self):
+        check_device_health(self.config)
+        Device.objects.filter(pk=self.device_ids[0]).update(isActive=False)
+        report = check_device_health(self.config)
+        self.assertEqual(2, report.scanned)
+        self.assertEqual(sorted(self.device_ids[1:]),
+                         sorted(str(pk) for pk in DeviceHealth.objects.values_list('device', flat=True)))
+
+
+class PropagationTestCase(TransactionTestCase):
+    # Pushes run in worker threads with their own connection, the data must be committed
+    multi_db = True
+
+    def setUp(self):
+        self.device_type = DeviceType.objects.create(name='tracker')
+        SMSCommand.objects.create(action='stop', sms_content='stop123456', device_type=self.device_type)
+        VehicleType.objects.create(name='car')
+
+    def _get_catalogue(self, database):
+        return (list(DeviceType.objects.using(database).values_list('id', 'name')),
+                list(SMSCommand.objects.using(database).values_list('action', 'device_type')),
+                list(VehicleType.objects.using(database).values_list('name', flat=True)))
+
+    def test_catalogue_is_created_then_updated(self):
+        result = propagate_catalogue([GTS])[0]
+        self.assertEqual((GTS, 3, 0, 0, None), result[:5])
+        self.assertEqual(self._get_catalogue('default'), self._get_catalogue(GTS))
+        DeviceType.objects.filter(pk=self.device_type.pk).update(name='tracker v2')
+        result = propagate_catalogue([GTS])[0]
+        self.assertEqual((GTS, 0, 3, 0, None), result[:5])
+        self.assertEqual('tracker v2', DeviceType.objects.using(GTS).get(pk=self.device_type.pk).name)
+
+    def test_deletions_are_propagated(self):
+        propagate_catalogue([GTS])
+        result = propagate([(SMSCommand, [], list(SMSCommand.objects.values_list('pk', flat=True)))], [GTS])[0]
+        self.assertEqual((0, 0, 1, None), result[1:5])
+        self.assertEqual(0, SMSCommand.objects.using(GTS).count())
+
+    def test_failing_database_is_reported_and_rolled_back(self):
+        invalid = DeviceType(pk=self.device_type.pk + 1, name=None)
+        result = propagate([(DeviceType, [self.device_type, invalid], None)], [GTS])[0]
+        self.assertEqual((0, 0, 0), result[1:4])
+        self.assertIsNotNone(result.error)
+        self.assertEqual(0, DeviceType.objects.using(GTS).count())
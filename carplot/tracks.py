@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import math
+
+from django.conf import settings
+
+# Heading variation in degrees from which a point is kept whatever the tolerance
+HEADING_CHANGE_THRESHOLD = getattr(settings, 'CARPLOT_HEADING_CHANGE_THRESHOLD', 45)
+# Number of positions from which a track to simplify is cut
+TRACK_MAX_POINTS = getattr(settings, 'CARPLOT_TRACK_MAX_POINTS', 100000)
+EARTH_RADIUS = 6371000.0
+# Ground resolution in meters of one pixel at zoom 0 on a web mercator map
+METERS_PER_PIXEL_AT_ZOOM_0 = 156543.03
+
+
+def zoom_to_tolerance(zoom):
+    """
+    Tolerance in meters matching one pixel at the given map zoom level.
+    """
+    return METERS_PER_PIXEL_AT_ZOOM_0 / 2 ** float(zoom)
+
+
+def _project(points):
+    """
+    Equirectangular projection of the points in meters, accurate enough at the scale of a trip.
+    """
+    if not points:
+        return []
+    ref_lat = math.radians(points[0]['latitude'])
+    cos_lat = math.cos(ref_lat)
+    return [(math.radians(point['longitude']) * cos_lat * EARTH_RADIUS,
+             math.radians(point['latitude']) * EARTH_RADIUS) for point in points]
+
+
+def _distance_to_segment(p, a, b):
+    dx, dy = b[0] - a[0], b[1] - a[1]
+    if dx == 0 and dy == 0:
+        return math.hypot(p[0] - a[0], p[1] - a[1])
+    t = max(0, min(1, ((p[0] - a[0]) * dx + (p[1] - a[1]) * dy) / (dx * dx + dy * dy)))
+    return math.hypot(p[0] - a[0] - t * dx, p[1] - a[1] - t * dy)
+
+
+def _heading_delta(h1, h2):
+    delta = abs((h1 or 0) - (h2 or 0)) % 360
+    return min(delta, 360 - delta)
+
+
+def _get_key_points(points):
+    """
+    Indexes of the points that must survive simplification: both ends,
+    beginning and end of stops, and sharp heading changes.
+    """
+    keys = set([0, len(points) - 1])
+    for i in range(1, len(points)):
+        prev, point = points[i - 1], points[i]
+        if (prev['speed'] > 0) != (point['speed'] > 0):
+            keys.add(i - 1)
+            keys.add(i)
+        elif point['speed'] > 0 and _heading_delta(prev['heading'], point['heading']) >= HEADING_CHANGE_THRESHOLD:
+            keys.add(i)
+    return sorted(keys)
+
+
+def _thin(xy, key_points, min_distance):
+    """
+    Radial distance pass: indexes of the points at least min_distance away from the previous point kept,
+    plus the key points. Dense stretches shrink in linear time before Douglas-Peucker, whose worst case is quadratic.
+    """
+    keys = set(key_points)
+    kept, last = [], None
+    for i, p in enumerate(xy):
+        if i in keys or math.hypot(p[0] - last[0], p[1] - last[1]) >= min_distance:
+            kept.append(i)
+            last = p
+    return kept
+
+
+def simplify_track(points, tolerance):
+    """
+    Douglas-Peucker simplification of a list of serialized positions, after a radial distance
+    pass with the same tolerance.
+
+    @param points: dicts with latitude, longitude, speed and heading keys in chronological order
+    @param tolerance: maximum distance in meters between the original and the simplified track
+    this function returns the list of points kept, in chronological order
+    """
+    if len(points) < 3:
+        return list(points)
+    xy = _project(points)
+    key_points = _get_key_points(points)
+    thinned = _thin(xy, key_points, tolerance)
+    keys = set(key_points)
+    points = [points[i] for i in thinned]
+    xy = [xy[i] for i in thinned]
+    key_points = [j for j, i in enumerate(thinned) if i in keys]
+    keep = [False] * len(points)
+    for i in key_points:
+        keep[i] = True
+    # Iterative to stay clear of the recursion limit on long tracks
+    stack = list(zip(key_points[:-1], key_points[1:]))
+    while stack:
+        first, last = stack.pop()
+        max_distance, index = 0, None
+        for i in range(first + 1, last):
+            distance = _distance_to_segment(xy[i], xy[first], xy[last])
+            if distance > max_distance:
+                max_distance, index = distance, i
+        if index is not None and max_distance > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import json
+import time
+
+from django.conf import settings
+
+from carplot.queries import iter_event_data, get_row_cursor
+from carplot.geofence import distance_between
+from carplot.models import Device, Trip, Watermark
+
+# Speed in km/h under which the vehicle is considered still
+STOP_SPEED = getattr(settings, 'CARPLOT_STOP_SPEED', 3)
+# Seconds a vehicle must stay still for a stop to be recorded, shorter ones count as idle time in the trip
+MIN_STOP_DURATION = getattr(settings, 'CARPLOT_MIN_STOP_DURATION', 300)
+# Seconds without any event after which the device is considered parked
+MAX_EVENT_GAP = getattr(settings, 'CARPLOT_MAX_EVENT_GAP', 600)
+TRIP_FIELDS = ('creationTime', 'timestamp', 'statusCode', 'latitude', 'longitude', 'speedKPH')
+WATERMARK_JOB = 'trips'
+
+
+class TripSegmenter(object):
+    """
+    Splits the chronological events of a device into trips and stops.
+    Its whole state is a JSON serializable dict so that segmentation can resume
+    where the previous run stopped.
+    """
+    def __init__(self, state=None):
+        state = state or {}
+        self.trip = state.get('trip')
+        self.still_since = state.get('still_since')
+        self.last = state.get('last')
+        self.segments = []
+
+    def get_state(self):
+        return {'trip': self.trip, 'still_since': self.still_since, 'last': self.last}
+
+    def _close_trip(self):
+        trip = self.trip
+        self.segments.append({
+            'kind': Trip.TRIP,
+            'start_time': trip['start'][0], 'start_latitude': trip['start'][1], 'start_longitude': trip['start'][2],
+            'end_time': trip['end'][0], 'end_latitude': trip['end'][1], 'end_longitude': trip['end'][2],
+            'distance': trip['distance'] / 1000,
+            'max_speed': trip['max_speed'],
+            'avg_speed': trip['speed_sum'] / trip['speed_count'] if trip['speed_count'] else 0,
+            'idle_duration': trip['idle'],
+        })
+        self.trip = None
+
+    def _add_stop(self, start, end_time):
+        self.segments.append({
+            'kind': Trip.STOP,
+            'start_time': start[0], 'start_latitude': start[1], 'start_longitude': start[2],
+            'end_time': end_time, 'end_latitude': start[1], 'end_longitude': start[2],
+            'idle_duration': end_time - start[0],
+        })
+
+    def feed(self, creation_time, lat, lng, speed):
+        if lat == 0.0 and lng == 0.0:
+            return
+        point = [creation_time, lat, lng]
+        last = self.last
+        if last and creation_time - last[0] > MAX_EVENT_GAP:
+            if self.trip:
+                self._close_trip()
+            self._add_stop(self.still_since or last, creation_time)
+            self.still_since = None
+            last = None
+        if speed > STOP_SPEED:
+            if self.still_since:
+                if self.trip:
+                    self.trip['idle'] += creation_time - self.still_since[0]
+                elif creation_time - self.still_since[0] >= MIN_STOP_DURATION:
+                    self._add_stop(self.still_since, creation_time)
+                self.still_since = None
+            if not self.trip:
+                self.trip = {'start': point, 'end': point, 'distance': 0, 'max_speed': 0,
+                             'speed_sum': 0, 'speed_count': 0, 'idle': 0}
+                last = None
+            trip = self.trip
+            if last:
+                trip['distance'] += distance_between(last[1], last[2], lat, lng)
+            trip['end'] = point
+            trip['max_speed'] = max(trip['max_speed'], speed)
+            trip['speed_sum'] += speed
+            trip['speed_count'] += 1
+        else:
+            if not self.still_since:
+                self.still_since = point
+            if self.trip and creation_time - self.still_since[0] >= MIN_STOP_DURATION:
+                self._close_trip()
+        self.last = point
+
+
+def _save(device, segments):
+    """
+    Writes the segments, updating those a previous run already wrote: the segments and the watermark
+    are not saved together, a run stopped in between is done again from the previous watermark.
+    """
+    if not segments:
+        return
+    # Looked up by the range of the run rather than by each start_time: the first run over the
+    # history of a device has more segments than a statement takes parameters
+    start_times = [segment['start_time'] for segment in segments]
+    existing = dict(((trip.start_time, trip.kind), trip) for trip in
+                    Trip.objects.filter(device=device, start_time__gte=min(start_times),
+                                        start_time__lte=max(start_times)))
+    created = []
+    for segment in segments:
+        trip = existing.get((segment['start_time'], segment['kind']))
+        if trip is None:
+            created.append(Trip(device=device, **segment))
+            continue
+        for field, value in segment.items():
+            setattr(trip, field, value)
+        trip.save()
+    Trip.objects.bulk_create(created)
+
+
+def segment_device(device):
+    """
+    Segments the events the device sent since the previous run and stores the trips and stops found.
+    Returns the number of segments recorded.
+    """
+    watermark, created = Watermark.objects.get_or_create(job=WATERMARK_JOB, device=device)
+    segmenter = TripSegmenter(json.loads(watermark.state) if watermark.state else None)
+    cursor = None if created else watermark.cursor
+    for row in iter_event_data([str(device.id)], fields=TRIP_FIELDS, cursor=cursor):
+        segmenter.feed(row['creationTime'], row['latitude'], row['longitude'], row['speedKPH'])
+        cursor = get_row_cursor(row)
+    _save(device, segmenter.segments)
+    if cursor:
+        watermark.creationTime, watermark.timestamp, watermark.statusCode = cursor
+    watermark.state = json.dumps(segmenter.get_state())
+    watermark.save()
+    return len(segmenter.segments)
+
+
+def segment_all_devices():
+    """
+    Runs segment_device on every active device. Returns the number of segments recorded and the duration.
+    """
+    start = time.time()
+    count = 0
+    for device in Device.objects.filter(isActive=True):
+        count += segment_device(device)
+    return count, time.time() - start
+
+
+def get_trips(device_id, start_time, end_time, kind=None):
+    """
+    Trips and stops of a device overlapping the [start_time, end_time[ interval, in chronological order
+    """
+    trips = Trip.objects.filter(device=device_id, start_time__lt=end_time, end_time__gte=start_time)
+    if kind:
+        trips = trips.filter(kind=kind)
+    return trips.order_by('start_time')
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+import threading
+import time
+
+from django.core.cache import cache
+
+_version_lock = threading.Lock()
+_last_version = 0
+
+
+def new_version():
+    # Seeded with the time, a version lost to an eviction never comes back to a previous value,
+    # even when reseeded within the same millisecond by this process
+    global _last_version
+    with _version_lock:
+        _last_version = max(_last_version + 1, int(time.time() * 1000))
+        return _last_version
+
+
+def get_version(key):
+    """
+    Version kept in the cache under key, that the cache keys of the versioned data are made of.
+    """
+    version = cache.get(key)
+    if version is None:
+        version = new_version()
+        if not cache.add(key, version, None):
+            # Seeded meanwhile by another request
+            version = cache.get(key) or version
+    return version
+
+
+def bump_version(key):
+    """
+    Moves the version kept under key on, so that the data cached under the previous one is no longer read.
+    Returns the new version.
+    """
+    try:
+        return cache.incr(key)
+    except ValueError:
+        # No version to bump: the next one must still differ from the one data may be cached under
+        version = new_version()
+        if not cache.add(key, version, None):
+            version = cache.get(key) or version
+        return version
@@ -2,11 +2,11 @@
 __author__ = 'Roddy Mbogning'
 
 import time
-from datetime import datetime
-import json
-from django.contrib.auth.decorators import login_required
+from datetime import datetime, timedelta
+from django.contrib.auth.decorators import login_required, permission_required
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.core.files.storage import default_storage
+from django.http import HttpResponse, StreamingHttpResponse, Http404
 from django.views.generic.base import TemplateView
 from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
@@ -16,10 +16,32 @@ from ikwen.core.views import BaseView
 from ikwen.core.utils import get_service_instance
 from conf import settings
 from carplot.models import EventData, Device, SMSCommand, Vehicle, OperatorProfile
-
-import requests
+from carplot.archive import get_sampled_history, get_latest_history
+from carplot.catalogue import get_device_catalogue, get_catalogue_stats
+from carplot.export import export_event_data, EXPORT_CONTENT_TYPES
+from carplot.geocoding import fill_addresses, get_account_id
+from carplot.health import get_non_functional_devices
+from carplot.icons import get_icon_table, get_heading_icon, get_icon_atlas, get_atlas_slot, get_atlas_path
+from carplot.live import get_poller, fetch_events_since, fetch_fleet_events_since, fetch_latest_event, \
+    get_cursor, parse_cursor, format_cursor, parse_cursors, format_cursors, TooManySubscribers, LIVE_BATCH_SIZE
+from carplot.markers import get_markers, get_clusters
+from carplot.metrics import dumps, phase, render_metrics, render_counter, METRICS_TOKEN
+from carplot.playback import iter_playback, PLAYBACK_WINDOW
+from carplot.provisioning import read_batch, provision_devices
+from carplot.queries import iter_positions, MoveFilter
+from carplot.rollups import get_fleet_report as build_fleet_report
+from carplot.search import search_vehicles
+from carplot.sms import get_dispatcher, build_sms_url
+from carplot.trips import get_trips
+from carplot.tracks import simplify_track, zoom_to_tolerance, TRACK_MAX_POINTS
+from carplot.wire import encode_columnar
 
 GTS = 'opengts'
+SEND_DATA_COUNT = getattr(settings, 'CARPLOT_SEND_DATA_COUNT', True)
+LIVE_TIMEOUT = getattr(settings, 'CARPLOT_LIVE_TIMEOUT', 25)
+# Name the positions without address with carplot.geocoding. Off by default: the first request
+# of each account builds the index of its Geozones, which takes long for accounts with many zones
+REVERSE_GEOCODE = getattr(settings, 'CARPLOT_REVERSE_GEOCODE', False)
 # 2368541 1462407550
 
 
@@ -41,23 +63,14 @@ class Home(BaseView):
     def get_context_data(self, **kwargs):
         context = super(Home, self).get_context_data(**kwargs)
         user = self.request.user
-        vehicles = Vehicle.objects.filter(status=Vehicle.ACTIVE, owner=user)
-        update_vehicles_last_position(vehicles)
-        markers = [
-            {
-                'name': vehicle.name,
-                'description': vehicle.description,
-                'vehicle_img': vehicle.photo.url,
-                'latitude': vehicle.device.lastValidLatitude,
-                'longitude': vehicle.device.lastValidLongitude,
-                'displayName': vehicle.device.displayName,
-                'icon': vehicle.type.static_icon_img.url,
-                'photo': vehicle.photo.url,
-            }
-            for vehicle in vehicles if
-            vehicle.device.lastValidLatitude != 0.0 and vehicle.device.lastValidLatitude != 0.0]
-        context['markers'] = json.dumps(markers)
-        context['vehicles'] = Vehicle.objects.filter(status=Vehicle.ACTIVE, owner=user)
+        # Positions are mirrored from opengts by the sync_positions command and kept in the marker index
+        with phase('markers'):
+            markers = get_markers(user.id)
+        context['markers'] = dumps(markers)
+        vehicles = list(Vehicle.objects.filter(status=Vehicle.ACTIVE, owner=user))
+        context['vehicles'] = vehicles
+        # Kept up to date by the check_device_health command
+        context['non_functional_devices'] = get_non_functional_devices([vehicle.device_id for vehicle in vehicles])
         return context
 
 
@@ -74,10 +87,8 @@ class AdminHome(BaseView):
 @login_required
 def get_sms_command(request, *args, **kwargs):
     device_id = request.GET.get('device_id')
-    device = Device.objects.get(id=device_id)
-    sms_commands = SMSCommand.objects.filter(device_type=device.device_type)
-    response = [sms_command.to_dict() for sms_command in sms_commands]
-    return HttpResponse(json.dumps({'sms_command': response}), 'content-type: text/json', **kwargs)
+    response = get_device_catalogue(device_id)
+    return HttpResponse(dumps({'sms_command': response}), 'content-type: text/json', **kwargs)
 
 
 @login_required
@@ -88,6 +99,14 @@ def get_device_event_data(request, *args, **kwargs):
     @param member: Member object to whom vehicule belongs to or the owner
     @param device_id: Id of the vehicle object in the database
     @param string_date: string format date sent from the client eg: 01/05/2016 12:00 - 07/05/2016 11:00
+    @param zoom: map zoom level. If set, the whole period is returned as a track simplified for that zoom
+    @param tolerance: simplification tolerance in meters; takes precedence over zoom.
+                      Periods holding more than TRACK_MAX_POINTS positions are sampled over their whole
+                      length before simplification, truncated is then true in the response
+    @param format: "columnar" to get event data as delta encoded parallel arrays, see carplot.wire
+    @param icons: "atlas" to get the icon of each point as a slot of the icon atlas of the vehicle type
+                  described in the response, instead of an URL. Icons stay URLs and the response has no
+                  atlas if it could not be built
     @param string_start_date: building from the string format date
     @param string_end_date: building from the string format date
     @param positions: queryset of even data happened during the period choosen by the client
@@ -97,17 +116,32 @@ def get_device_event_data(request, *args, **kwargs):
     member = request.user
     device_id = request.GET.get('device_id')
     string_date = request.GET.get('string_date')
+    response_format = request.GET.get('format')
+    use_atlas = request.GET.get('icons') == 'atlas'
+    zoom = request.GET.get('zoom')
+    tolerance = request.GET.get('tolerance')
+    if tolerance:
+        tolerance = float(tolerance)
+    elif zoom:
+        tolerance = zoom_to_tolerance(zoom)
+    else:
+        tolerance = None
     string_start_date = None
     string_end_date = None
+    try:
+        vehicle = Vehicle.objects.get(owner=member, device=device_id)
+    except Vehicle.DoesNotExist:
+        raise Http404()
     device = Device.objects.get(pk=device_id)
     if string_date:
         dates_list = retrieve_dates_from_interval(string_date)
         string_start_date = dates_list[0]
         string_end_date = dates_list[1]
-    vehicle = Vehicle.objects.get(device=device)
+    icon_table = get_icon_table(vehicle.type_id)
     positions = EventData.objects.using('opengts').filter(deviceID=device_id)
     # positions = EventData.objects.using('opengts')
-    data_count = positions.count()
+    # Counting the whole history is expensive, live clients should poll device_position_since instead
+    data_count = positions.count() if SEND_DATA_COUNT else None
     start_date, end_date = None, None
     if string_start_date is not None:
         start_date = int(time.mktime(datetime.strptime(string_start_date, '%d-%m-%Y %H:%M').timetuple()))
@@ -125,39 +159,208 @@ def get_device_event_data(request, *args, **kwargs):
         end_date_dt = datetime(end_date_dtime.year, end_date_dtime.month, end_date_dtime.day, 0)
         start_date = int(time.mktime(end_date_dt.timetuple()))
         positions = positions.filter(Q(creationTime__gte=start_date) & Q(creationTime__lt=end_date))
-    if not start_date and not end_date and len(positions)>0:
-        positions = [positions.order_by('-creationTime')[0]]
+    truncated = False
+    if not start_date and not end_date:
+        positions = iter_positions(positions.order_by('-creationTime')[:1])
+        points = list(iter_track_points(positions, icon_table))
+    elif tolerance is not None:
+        points, truncated = get_simplified_track(device_id, start_date, end_date, icon_table, tolerance)
+    else:
+        points = get_latest_track(device_id, start_date, end_date, icon_table)
+    if REVERSE_GEOCODE:
+        fill_addresses(points, get_account_id(device))
+    response = {'data_count': data_count, 'truncated': truncated}
+    atlas = get_icon_atlas(vehicle.type_id) if use_atlas else None
+    if atlas is not None:
+        for point in points:
+            point['icon'] = get_atlas_slot(atlas, point['speed'], point['heading'])
+        response['atlas'] = atlas
+    if response_format == 'columnar':
+        event_data = encode_columnar(points, device.displayName, vehicle.name + " / " + device.displayName)
+    else:
+        event_data = [to_map_point(point, device, vehicle) for point in points]
+    response['event_data'] = event_data
+    return HttpResponse(dumps(response), 'content-type: text/json', **kwargs)
+
+
+@login_required
+def get_fleet_markers(request, *args, **kwargs):
+    """
+    Markers of the vehicles of the user within the map viewport, grouped in clusters below
+    CLUSTER_MAX_ZOOM so that large fleets stay light to transfer and draw.
+
+    @param bbox: viewport as "south,west,north,east" in degrees
+    @param zoom: map zoom level
+    this function return a JSON objet of: clusters with their count and centroid, and markers
+    """
+    try:
+        south, west, north, east = [float(value) for value in request.GET.get('bbox', '').split(',')]
+        zoom = int(request.GET.get('zoom', ''))
+    except ValueError:
+        return HttpResponse(dumps({'error': 'bbox must be "south,west,north,east" and zoom an integer'}),
+                            'content-type: text/json', status=400)
+    clusters, markers = get_clusters(request.user.id, south, west, north, east, zoom)
+    return HttpResponse(dumps({'clusters': clusters, 'markers': markers}), 'content-type: text/json', **kwargs)
+
+
+@login_required
+def get_device_event_data_since(request, *args, **kwargs):
+    """
+    Get the event data a device sent after a cursor. This is used during the live display
+    instead of comparing the data_count of get_device_event_data.
+
+    @param device_id: Id of the device object in the database
+    @param cursor: "creationTime,timestamp,statusCode" of the last event data received by the client.
+                   Only the latest event data is returned if not set
+    this function return a JSON objet of: event data, the new cursor and whether more event data are pending
+    """
+    device_id = request.GET.get('device_id')
+    try:
+        cursor = parse_cursor(request.GET.get('cursor'))
+    except ValueError as e:
+        return HttpResponse(dumps({'error': str(e)}), 'content-type: text/json', status=400)
+    try:
+        vehicle = Vehicle.objects.get(owner=request.user, device=device_id)
+    except Vehicle.DoesNotExist:
+        raise Http404()
+    device = Device.objects.get(pk=device_id)
+    icon_table = get_icon_table(vehicle.type_id)
+    if cursor:
+        positions = fetch_events_since([device_id], cursor, LIVE_BATCH_SIZE + 1)
+        has_more = len(positions) > LIVE_BATCH_SIZE
+        positions = positions[:LIVE_BATCH_SIZE]
+    else:
+        latest = fetch_latest_event(device_id)
+        positions = [latest] if latest else []
+        has_more = False
+    if positions:
+        cursor = get_cursor(positions[-1])
+    event_data = serialize_positions(positions, device, vehicle, icon_table)
+    response = {'event_data': event_data, 'cursor': format_cursor(cursor), 'has_more': has_more}
+    return HttpResponse(dumps(response), 'content-type: text/json', **kwargs)
+
+
+@login_required
+def stream_device_event_data(request, *args, **kwargs):
+    """
+    Long-poll version of get_device_event_data_since served from the shared EventPoller.
+    The request is held until the device, or the whole fleet of the user if device_id is
+    not set, sends event data after the cursor or until timeout seconds elapse.
+
+    @param device_id: Id of the device object in the database
+    @param cursor: "deviceID:creationTime,timestamp,statusCode" of the last event data received by the client
+                   for each device, separated by ";". The latest event data of the devices without cursor
+                   is returned at once.
+    @param timeout: maximum number of seconds to hold the request
+    this function return a JSON objet of: event data grouped by device id and the new cursors
+    """
+    device_id = request.GET.get('device_id')
+    if device_id:
+        vehicles = Vehicle.objects.filter(owner=request.user, device=device_id)
     else:
-        # Order by -creationTime and grab the first 1000,
-        # that is equivalent to grab the 1000 latest eventData
-        positions = list(positions.order_by('-creationTime')[:1000])
-        positions = reversed(positions)
-    event_data = []
-
-    late_lat = 0.0
-    late_lng = 0.0
+        vehicles = Vehicle.objects.filter(status=Vehicle.ACTIVE, owner=request.user)
+    vehicles = dict((str(vehicle.device_id), vehicle) for vehicle in vehicles)
+    try:
+        cursors = parse_cursors(request.GET.get('cursor'), list(vehicles.keys()))
+        timeout = min(float(request.GET.get('timeout', LIVE_TIMEOUT)), LIVE_TIMEOUT)
+    except ValueError as e:
+        return HttpResponse(dumps({'error': str(e)}), 'content-type: text/json', status=400)
+    cursors = dict((device_id, cursor) for device_id, cursor in cursors.items() if device_id in vehicles)
+    missing = [device_id for device_id in vehicles.keys() if device_id not in cursors]
+    if missing:
+        # Devices new to the client are answered at once with their latest event data
+        positions = []
+        for device_id in missing:
+            position = fetch_latest_event(device_id)
+            if position:
+                positions.append(position)
+            else:
+                # OpenGTS stamps creationTime on insertion, events of the device can only come after now
+                cursors[device_id] = int(time.time()), 0, 0
+    else:
+        try:
+            positions = get_poller().wait(cursors, timeout)
+        except TooManySubscribers:
+            return HttpResponse(dumps({'error': 'Too many subscribers'}), 'content-type: text/json', status=503)
+        if positions is None:
+            positions = fetch_fleet_events_since(cursors)
+    positions_by_device = {}
+    for position in positions:
+        positions_by_device.setdefault(position.deviceID, []).append(position)
+        cursors[position.deviceID] = get_cursor(position)
+    event_data = {}
+    for device_id, device_positions in positions_by_device.items():
+        vehicle = vehicles[device_id]
+        icon_table = get_icon_table(vehicle.type_id)
+        event_data[device_id] = serialize_positions(device_positions, vehicle.device, vehicle, icon_table)
+    response = {'event_data': event_data, 'cursor': format_cursors(cursors)}
+    return HttpResponse(dumps(response), 'content-type: text/json', **kwargs)
+
+
+def get_latest_track(device_id, start_date, end_date, icon_table):
+    # Grab the 1000 latest eventData, from the archives if the database does not have enough
+    positions = get_latest_history(device_id, start_date, end_date, 1000)
+    return list(iter_track_points(positions, icon_table))
+
+
+def get_simplified_track(device_id, start_date, end_date, icon_table, tolerance):
+    """
+    Reads the positions of the period, archived or not, then simplifies the track,
+    keeping stops and heading changes, so that the whole period fits in a few hundred points.
+    Periods holding more than TRACK_MAX_POINTS positions are sampled from start to end so that
+    a wide period can not hold the worker.
+
+    this function returns the points kept and whether the period was sampled
+    """
+    positions, truncated = get_sampled_history(device_id, start_date, end_date, TRACK_MAX_POINTS)
+    points = list(iter_map_points(positions, icon_table))
+    return simplify_track(points, tolerance), truncated
+
+
+def iter_track_points(positions, icon_table):
+    """
+    Turns positions into the points drawn on the map, skipping null coordinates
+    and points that did not move since the previous one.
+    """
+    return iter_map_points(MoveFilter().filter(positions), icon_table)
+
+
+def iter_map_points(positions, icon_table):
     for position in positions:
         if position.speedKPH > 0:
-            icon_url = get_the_right_icon(position, device)
+            icon_url = get_heading_icon(icon_table, position.heading)
         else:
-            icon_url = vehicle.type.static_icon_img.url
-        if late_lat != position.latitude and late_lng != position.longitude:
-            if position.latitude != 0.0 and position.longitude != 0.0:
-                pos = {
-                    'latitude': position.latitude,
-                    'longitude': position.longitude,
-                    'displayName': device.displayName,
-                    'dateTime': change_date_to_string(datetime.fromtimestamp(position.creationTime)),
-                    'speed': position.speedKPH,
-                    'heading': position.heading,
-                    'address': position.address,
-                    'description': vehicle.name + " / " + device.displayName,
-                    'icon': icon_url
-                }
-                event_data.append(pos)
-        late_lat = position.latitude
-        late_lng = position.longitude
-    return HttpResponse(json.dumps({'event_data': event_data, 'data_count': data_count}), 'content-type: text/json', **kwargs)
+            icon_url = icon_table['static']
+        yield {
+            'latitude': position.latitude,
+            'longitude': position.longitude,
+            'creationTime': position.creationTime,
+            'speed': position.speedKPH,
+            'heading': position.heading,
+            'address': position.address,
+            'icon': icon_url
+        }
+
+
+def to_map_point(point, device, vehicle):
+    return {
+        'latitude': point['latitude'],
+        'longitude': point['longitude'],
+        'displayName': device.displayName,
+        'dateTime': change_date_to_string(datetime.fromtimestamp(point['creationTime'])),
+        'speed': point['speed'],
+        'heading': point['heading'],
+        'address': point['address'],
+        'description': vehicle.name + " / " + device.displayName,
+        'icon': point['icon']
+    }
+
+
+def serialize_positions(positions, device, vehicle, icon_table):
+    points = list(iter_track_points(positions, icon_table))
+    if REVERSE_GEOCODE:
+        fill_addresses(points, get_account_id(device))
+    return [to_map_point(point, device, vehicle) for point in points]
 
 
 def change_date_to_string(date_to_stringify):
@@ -177,77 +380,229 @@ def retrieve_dates_from_interval(string_date):
     return dates
 
 
+@login_required
+def export_device_event_data(request, *args, **kwargs):
+    """
+    Streams the event data of one or many devices of the user as a file download.
+
+    @param device_id: Id of a device; can be repeated. All the active vehicles of the user if not set
+    @param string_date: string format date sent from the client eg: 01/05/2016 12:00 - 07/05/2016 11:00
+    @param format: csv, geojson or ndjson
+    """
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in EXPORT_CONTENT_TYPES:
+        return HttpResponse(dumps({'error': 'Unsupported format %s' % export_format}),
+                            'content-type: text/json', status=400)
+    vehicles = Vehicle.objects.filter(owner=request.user)
+    device_ids = request.GET.getlist('device_id')
+    if device_ids:
+        vehicles = vehicles.filter(device__in=device_ids)
+    else:
+        vehicles = vehicles.filter(status=Vehicle.ACTIVE)
+    device_ids = [str(vehicle.device_id) for vehicle in vehicles]
+    start_date, end_date = None, None
+    string_date = request.GET.get('string_date')
+    if string_date:
+        string_start_date, string_end_date = retrieve_dates_from_interval(string_date)
+        start_date = int(time.mktime(datetime.strptime(string_start_date, '%d-%m-%Y %H:%M').timetuple()))
+        end_date = int(time.mktime(datetime.strptime(string_end_date, '%d-%m-%Y %H:%M').timetuple()))
+    chunks = export_event_data(device_ids, export_format, start_date, end_date)
+    response = StreamingHttpResponse(chunks, content_type=EXPORT_CONTENT_TYPES[export_format])
+    response['Content-Disposition'] = 'attachment; filename="event_data.%s"' % export_format
+    return response
+
+
+@login_required
+def get_fleet_playback(request, *args, **kwargs):
+    """
+    Streams as NDJSON the history of many devices of the user over a period so that they can be
+    replayed together: a header line describing the devices, then a line per time window.
+
+    @param device_id: Id of a device; repeated for every device to replay
+    @param string_date: string format date sent from the client eg: 01/05/2016 12:00 - 07/05/2016 11:00
+    @param step: if set, tracks are interpolated on a common time grid of step seconds,
+                 otherwise the positions are sent as they were recorded
+    @param window: length in seconds of the time windows
+    """
+    vehicles = Vehicle.objects.filter(owner=request.user, device__in=request.GET.getlist('device_id'))
+    vehicles = list(vehicles)
+    devices = Device.objects.in_bulk([vehicle.device_id for vehicle in vehicles])
+    described = {}
+    for vehicle in vehicles:
+        device = devices[vehicle.device_id]
+        described[str(device.id)] = {
+            'displayName': device.displayName,
+            'description': vehicle.name + " / " + device.displayName,
+            'icon': get_icon_table(vehicle.type_id)['static'],
+        }
+    string_date = request.GET.get('string_date')
+    if not string_date:
+        return HttpResponse(dumps({'error': 'string_date is required'}), 'content-type: text/json', status=400)
+    try:
+        string_start_date, string_end_date = retrieve_dates_from_interval(string_date)
+        start_date = int(time.mktime(datetime.strptime(string_start_date, '%d-%m-%Y %H:%M').timetuple()))
+        end_date = int(time.mktime(datetime.strptime(string_end_date, '%d-%m-%Y %H:%M').timetuple()))
+    except ValueError:
+        return HttpResponse(dumps({'error': 'Malformed string_date %s' % string_date}),
+                            'content-type: text/json', status=400)
+    try:
+        step = request.GET.get('step')
+        step = int(step) if step else None
+        window = int(request.GET.get('window', PLAYBACK_WINDOW))
+        # Checked before the response starts streaming, iter_playback only raises once iterated
+        if window <= 0:
+            raise ValueError()
+    except ValueError:
+        return HttpResponse(dumps({'error': 'step and window must be whole numbers of seconds, window a positive one'}),
+                            'content-type: text/json', status=400)
+    lines = iter_playback(described, start_date, end_date, step, window)
+    return StreamingHttpResponse(lines, content_type=EXPORT_CONTENT_TYPES['ndjson'])
+
+
+@login_required
+def get_device_trips(request, *args, **kwargs):
+    """
+    Get the trips and stops of a device computed by carplot.trips over a period.
+
+    @param device_id: Id of the device object in the database
+    @param string_date: string format date sent from the client eg: 01/05/2016 12:00 - 07/05/2016 11:00
+    @param kind: Trip or Stop to get only one kind of segment
+    """
+    device_id = request.GET.get('device_id')
+    if not Vehicle.objects.filter(owner=request.user, device=device_id).exists():
+        raise Http404()
+    string_date = request.GET.get('string_date')
+    if not string_date:
+        return HttpResponse(dumps({'error': 'string_date is required'}), 'content-type: text/json', status=400)
+    try:
+        string_start_date, string_end_date = retrieve_dates_from_interval(string_date)
+        start_date = int(time.mktime(datetime.strptime(string_start_date, '%d-%m-%Y %H:%M').timetuple()))
+        end_date = int(time.mktime(datetime.strptime(string_end_date, '%d-%m-%Y %H:%M').timetuple()))
+    except ValueError:
+        return HttpResponse(dumps({'error': 'Malformed string_date %s' % string_date}),
+                            'content-type: text/json', status=400)
+    trips = get_trips(device_id, start_date, end_date, request.GET.get('kind'))
+    response = [trip.to_dict() for trip in trips]
+    return HttpResponse(dumps({'trips': response}), 'content-type: text/json', **kwargs)
+
+
+@login_required
+def get_fleet_report(request, *args, **kwargs):
+    """
+    Get the daily statistics of the active vehicles of the user from the rollups of carplot.rollups.
+
+    @param days: number of days of the report, ending today. Default is 30
+    this function return a JSON objet of: totals per day, totals per device and totals of the period
+    """
+    try:
+        days = int(request.GET.get('days', 30))
+    except ValueError:
+        days = 0
+    if days <= 0:
+        return HttpResponse(dumps({'error': 'days must be a positive number'}), 'content-type: text/json',
+                            status=400)
+    end_day = timezone.now().date()
+    start_day = end_day - timedelta(days=days - 1)
+    vehicles = Vehicle.objects.filter(status=Vehicle.ACTIVE, owner=request.user)
+    device_ids = [vehicle.device_id for vehicle in vehicles]
+    report = build_fleet_report(device_ids, start_day, end_day)
+    return HttpResponse(dumps(report), 'content-type: text/json', **kwargs)
+
+
+@permission_required('carplot.add_device')
+def upload_devices(request, *args, **kwargs):
+    """
+    Creates or updates the devices of an uploaded CSV or JSON batch, see carplot.provisioning.
+
+    @param devices: uploaded file; CSV with imei, sim, type and name columns or JSON list of objects
+    this function return a JSON objet of: devices created, devices updated, errors per row and duration
+    """
+    upload = request.FILES.get('devices')
+    if upload is None:
+        return HttpResponse(dumps({'error': 'devices file is required'}), 'content-type: text/json', status=400)
+    batch_format = upload.name.rsplit('.', 1)[-1].lower()
+    if batch_format not in ('csv', 'json'):
+        return HttpResponse(dumps({'error': 'Unsupported format %s, send a .csv or .json file' % upload.name}),
+                            'content-type: text/json', status=400)
+    try:
+        rows = read_batch(upload.read(), batch_format)
+    except ValueError as e:
+        return HttpResponse(dumps({'error': 'Unreadable %s file: %s' % (batch_format, e)}),
+                            'content-type: text/json', status=400)
+    report = provision_devices(rows, request.user.username)
+    response = {
+        'created': report.created,
+        'updated': report.updated,
+        'errors': [{'row': line, 'message': message} for line, message in report.errors],
+        'duration': report.duration
+    }
+    return HttpResponse(dumps(response), 'content-type: text/json', **kwargs)
+
+
 @login_required
 def search(request, *args, **kwargs):
     keyword = request.GET.get('query')
     user = request.user
-    vehicles = Vehicle.objects.filter(name__icontains=keyword, owner=user)
-    response = [device.to_dict() for device in vehicles]
-    return HttpResponse(json.dumps({'response': response}), 'content-type: text/json', **kwargs)
+    response = search_vehicles(user.id, keyword)
+    return HttpResponse(dumps({'response': response}), 'content-type: text/json', **kwargs)
 
 
 @login_required
 def send_smsCommand(request, *args, **kwargs):
-    service = get_service_instance()
-    config = service.config
-    if config.sms_limit > 0:
-        device_id = request.GET.get('device_id')
-        sms_id = request.GET.get('sms_id')
-        device = Device.objects.get(id=device_id)
-        sms_command = SMSCommand.objects.get(id=sms_id)
-        phone = device.simPhoneNumber
-        message = sms_command.sms_content
-        url = construct_sms_sending_url(phone, message)
-        requests.get(url)
-        config.sms_limit -= 1
-        config.save()
-        return HttpResponse(json.dumps({'success': True}), 'content-type: text/json', **kwargs)
+    """
+    Queues an SMS command for one or many devices; the SMS are sent in background by carplot.sms.
+
+    @param sms_id: Id of the SMSCommand to send
+    @param device_id: Id of a device of the user; can be repeated to send the command to many devices at once
+    @param fleet: if set, the command is sent to all the active vehicles of the user
+    this function return a JSON objet of: success and the number of SMS queued, No_phone if none of the devices
+                         has a SIM phone number or No_SMS if the quota is not enough
+    """
+    config = get_service_instance().config
+    sms_command = SMSCommand.objects.get(id=request.GET.get('sms_id'))
+    vehicles = Vehicle.objects.filter(owner=request.user)
+    if request.GET.get('fleet'):
+        vehicles = vehicles.filter(status=Vehicle.ACTIVE)
+    else:
+        vehicles = vehicles.filter(device__in=request.GET.getlist('device_id'))
+    devices = list(Device.objects.in_bulk([vehicle.device_id for vehicle in vehicles]).values())
+    if not [device for device in devices if device.simPhoneNumber]:
+        return HttpResponse(dumps({'No_phone': True}), 'content-type: text/json', **kwargs)
+    queued = get_dispatcher().send(config, sms_command, devices)
+    if queued:
+        return HttpResponse(dumps({'success': True, 'queued': queued}), 'content-type: text/json', **kwargs)
     else:
-        return HttpResponse(json.dumps({'No_SMS': True}), 'content-type: text/json', **kwargs)
+        return HttpResponse(dumps({'No_SMS': True}), 'content-type: text/json', **kwargs)
+
+
+def icon_atlas(request, vehicle_type_id, digest, *args, **kwargs):
+    """
+    Serves the icon atlas of a vehicle type. Its name changes with its content, so browsers can keep it forever.
+    """
+    path = get_atlas_path(vehicle_type_id, digest)
+    if not default_storage.exists(path):
+        raise Http404()
+    with default_storage.open(path, 'rb') as f:
+        response = HttpResponse(f.read(), 'image/png')
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+
+def metrics(request, *args, **kwargs):
+    """
+    Exposes the request histograms of carplot.metrics in Prometheus text format.
+    Reserved to staff, or to scrapers passing CARPLOT_METRICS_TOKEN as token when it is set.
+    """
+    if not (request.user.is_staff or (METRICS_TOKEN and request.GET.get('token') == METRICS_TOKEN)):
+        return HttpResponse(status=403)
+    catalogue_stats = get_catalogue_stats()
+    output = render_metrics()
+    output += render_counter('carplot_sms_catalogue_hits_total', "SMS catalogue cache hits", catalogue_stats['hits'])
+    output += render_counter('carplot_sms_catalogue_misses_total', "SMS catalogue cache misses",
+                             catalogue_stats['misses'])
+    return HttpResponse(output, 'text/plain; version=0.0.4')
 
 
 def construct_sms_sending_url(recipient, text):
-    service = get_service_instance()
-    config = service.config
-    url = config.sms_api_script_url
-    username = config.sms_api_username
-    password = config.sms_api_password
-    sender = config.company_name
-    url = url.replace('$username', username)
-    url = url.replace('$password', password)
-    url = url.replace('$sender', sender)
-    url = url.replace('$recipient', recipient)
-    url = url.replace('$text', text)
-    return url
-
-
-def get_the_right_icon(event, device):
-    icon_url = ""
-    vehicle = Vehicle.objects.get(device=device)
-    if event.heading == 0 :
-        icon_url = vehicle.type.active_icon_img_north.url
-    elif event.heading > 0 and event.heading < 90:
-        icon_url = vehicle.type.active_icon_img_north_east.url
-    elif event.heading == 90:
-        icon_url = vehicle.type.active_icon_img_east.url
-    elif event.heading > 90 and event.heading < 180:
-        icon_url = vehicle.type.active_icon_img_south_east.url
-    elif event.heading == 180:
-        icon_url = vehicle.type.active_icon_img_south.url
-    elif event.heading > 180 and event.heading < 270:
-        icon_url = vehicle.type.active_icon_img_south_west.url
-    elif (event.heading == 270):
-        icon_url = vehicle.type.active_icon_img_west.url
-    elif event.heading > 270 and event.heading < 379:
-        icon_url = vehicle.type.active_icon_img_north_west.url
-    return icon_url
-
-
-def update_vehicles_last_position(vehicles):
-    for vehicle in vehicles:
-        gts_device = Device.objects.using('opengts').get(deviceID=vehicle.device.id)
-        mongo_device = vehicle.device
-        if gts_device.lastValidLatitude != mongo_device.lastValidLatitude or gts_device.lastValidLongitude != mongo_device.lastValidLongitude:
-            mongo_device.lastValidLatitude = gts_device.lastValidLatitude
-            mongo_device.lastValidLongitude = gts_device.lastValidLongitude
-            mongo_device.save()
\ No newline at end of file
+    return build_sms_url(get_service_instance().config, recipient, text)
+
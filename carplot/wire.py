@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+# Coordinates are sent as integers of millionth of degree, about 0.1m at the equator
+COORDINATE_SCALE = 1000000
+
+
+def _delta_encode(values):
+    encoded = []
+    previous = 0
+    for value in values:
+        encoded.append(value - previous)
+        previous = value
+    return encoded
+
+
+def encode_columnar(points, display_name, description):
+    """
+    Encodes track points as parallel arrays instead of one dict per point.
+
+    lat, lng and epoch are delta encoded: the first value is absolute and the next ones are
+    differences with the previous value; lat and lng are in millionth of degree. icon holds
+    for each point the index of its URL in icons. Only the non empty addresses are sent,
+    keyed by point index.
+    """
+    icons = []
+    icon_indexes = {}
+    icon = []
+    addresses = {}
+    for i, point in enumerate(points):
+        url = point['icon']
+        if url not in icon_indexes:
+            icon_indexes[url] = len(icons)
+            icons.append(url)
+        icon.append(icon_indexes[url])
+        if point['address']:
+            addresses[i] = point['address']
+    return {
+        'format': 'columnar',
+        'count': len(points),
+        'displayName': display_name,
+        'description': description,
+        'icons': icons,
+        'lat': _delta_encode([int(round(point['latitude'] * COORDINATE_SCALE)) for point in points]),
+        'lng': _delta_encode([int(round(point['longitude'] * COORDINATE_SCALE)) for point in points]),
+        'epoch': _delta_encode([point['creationTime'] for point in points]),
+        'speed': [round(point['speed'], 1) for point in points],
+        'heading': [round(point['heading'], 1) for point in points],
+        'icon': icon,
+        'address': addresses,
+    }
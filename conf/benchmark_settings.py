@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+# Settings of the benchmark suite: SQLite stand-ins for the default and opengts databases.
+#   python manage.py migrate --run-syncdb --settings=conf.benchmark_settings
+#   python manage.py migrate --run-syncdb --database=opengts --settings=conf.benchmark_settings
+#   python manage.py generate_fleet --settings=conf.benchmark_settings
+#   python manage.py run_benchmarks --settings=conf.benchmark_settings
+
+import os
+
+from conf.settings import *
+
+BENCHMARK_DB_DIR = os.environ.get('CARPLOT_BENCHMARK_DB_DIR', '/tmp')
+
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BENCHMARK_DB_DIR, 'carplot_benchmark.sqlite3'),
+    },
+    'opengts': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BENCHMARK_DB_DIR, 'carplot_benchmark_gts.sqlite3'),
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+MIDDLEWARE_CLASSES = tuple(MIDDLEWARE_CLASSES) + ('carplot.metrics.MetricsMiddleware',)
+
+DEBUG = False
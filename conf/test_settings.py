@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+__author__ = 'Roddy Mbogning'
+
+# Settings of the test suite: SQLite stand-ins for the default and opengts databases.
+#   python manage.py test carplot --settings=conf.test_settings
+
+import os
+import tempfile
+
+from conf.settings import *
+
+# On files, so that the SMS and propagation worker threads share the test databases.
+# Their names must differ too, else Django takes opengts for a mirror of default.
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(tempfile.gettempdir(), 'carplot.sqlite3'),
+        'TEST': {'NAME': os.path.join(tempfile.gettempdir(), 'test_carplot.sqlite3')},
+    },
+    'opengts': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(tempfile.gettempdir(), 'opengts.sqlite3'),
+        'TEST': {'NAME': os.path.join(tempfile.gettempdir(), 'test_opengts.sqlite3')},
+    },
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
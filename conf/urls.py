@@ -3,7 +3,10 @@ from django.conf.urls import patterns, include, url
 from django.contrib import admin
 from django.contrib.auth.decorators import login_required
 
-from carplot.views import Home, AdminHome, get_sms_command,get_device_event_data, IframeAdmin, search, send_smsCommand
+from carplot.views import Home, AdminHome, get_sms_command,get_device_event_data, \
+    get_device_event_data_since, stream_device_event_data, export_device_event_data, get_device_trips, \
+    get_fleet_report, get_fleet_markers, get_fleet_playback, upload_devices, icon_atlas, metrics, IframeAdmin, \
+    search, send_smsCommand
 
 admin.autodiscover()
 
@@ -19,6 +22,16 @@ urlpatterns = patterns(
 
     url(r'^(?P<model_name>[-\w]+)/$', login_required(IframeAdmin.as_view()), name='iframe_admin'),
     url(r'^device_position$', get_device_event_data, name='device_position'),
+    url(r'^device_position_since$', get_device_event_data_since, name='device_position_since'),
+    url(r'^device_position_stream$', stream_device_event_data, name='device_position_stream'),
+    url(r'^export_event_data$', export_device_event_data, name='export_event_data'),
+    url(r'^device_trips$', get_device_trips, name='device_trips'),
+    url(r'^fleet_report$', get_fleet_report, name='fleet_report'),
+    url(r'^fleet_markers$', get_fleet_markers, name='fleet_markers'),
+    url(r'^fleet_playback$', get_fleet_playback, name='fleet_playback'),
+    url(r'^upload_devices$', upload_devices, name='upload_devices'),
     url(r'^get_sms_command$', get_sms_command, name='get_sms_command'),
     url(r'^send_sms_command$', send_smsCommand, name='send_sms_command'),
+    url(r'^icon_atlas/(?P<vehicle_type_id>\w+)/(?P<digest>[0-9a-f]+)\.png$', icon_atlas, name='icon_atlas'),
+    url(r'^metrics$', metrics, name='metrics'),
 )